@@ -1,2 +1,2 @@
 from version import __version__
-__all__ = ["tdvp_gen", "tdvp_uniform", "matmul", "nullspace", "version"]
+__all__ = ["tdvp_gen", "tdvp_uniform", "tdvp_sandwich", "tdvp_common", "matmul", "nullspace", "symmetry", "version"]
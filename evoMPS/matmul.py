@@ -319,9 +319,17 @@ def H(m, out=None):
         out = sp.conjugate(m.T, out)
         return out
     
-def randomize_cmplx(x, a=-0.5, b=0.5, aj=-0.5, bj=0.5):        
-    x[:] = (((b - a) * sp.random.ranf(x.shape) + a) 
-            + 1.j * ((bj - aj) * sp.random.ranf(x.shape) + aj))
+def randomize_cmplx(x, a=-0.5, b=0.5, aj=-0.5, bj=0.5):
+    """Fills x with uniformly distributed random numbers, with real parts 
+    in [a, b) and imaginary parts in [aj, bj).
+    
+    If x has a real dtype, only the real parts are generated.
+    """
+    if sp.iscomplexobj(x):
+        x[:] = (((b - a) * sp.random.ranf(x.shape) + a) 
+                + 1.j * ((bj - aj) * sp.random.ranf(x.shape) + aj))
+    else:
+        x[:] = (b - a) * sp.random.ranf(x.shape) + a
     return x
 
 def sqrtmh(A, ret_evd=False, evd=None):
@@ -567,4 +575,93 @@ def bicgstab_iso(A, x, b, MVop, VVop, max_itr=500, atol=1E-14, rtol=1E-14):
         
     convg = i < max_itr - 1
     
-    return x, convg
\ No newline at end of file
+    return x, convg
+    
+def fom_multishift(MVop, b, shifts, m=30, max_itr=100, tol=1E-14):
+    """Implements the restarted Full Orthogonalization Method (FOM) for a 
+    set of shifted linear systems.
+    
+    Solves (shifts[i] * 1 - A) x[i] = b for all i at once.
+    
+    Since the Krylov subspaces generated by A and by shifts[i] * 1 - A are
+    identical, a single Arnoldi process serves all the systems. The FOM
+    residuals for the different shifts remain collinear, so that this is 
+    also true after a restart. Each cycle thus requires m applications of 
+    A, regardless of the number of shifts.
+    
+    Parameters
+    ----------
+    MVop : function(ndarray)
+        The matrix-vector multiplication operation A v.
+    b : ndarray
+        The b vector.
+    shifts : sequence of complex
+        The shifts.
+    m : int
+        The dimension of the Krylov subspace before restarting.
+    max_itr : int
+        Maximum number of restart cycles.
+    tol : float
+        Tolerance for the residual norm, relative to the norm of b.
+        
+    Returns
+    -------
+    x : ndarray
+        The solutions x[i].
+    convg : bool
+        Whether the algorithm converged for all shifts.
+    itr : int
+        The number of applications of A.
+    """
+    shifts = sp.asarray(shifts)
+    n = b.shape[0]
+    
+    x = sp.zeros((len(shifts), n), dtype=sp.complex128)
+    
+    beta = la.norm(b)
+    if beta == 0:
+        return x, True, 0
+    
+    V = sp.empty((m + 1, n), dtype=sp.complex128)
+    H = sp.zeros((m + 1, m), dtype=sp.complex128)
+    
+    V[0] = b / beta
+    c = sp.ones(len(shifts), dtype=sp.complex128) * beta #residuals = c * V[0]
+    
+    itr = 0
+    for k in xrange(max_itr):
+        H.fill(0)
+        breakdown = False
+        for j in xrange(m):
+            w = MVop(V[j])
+            itr += 1
+            for i in xrange(j + 1): #modified Gram-Schmidt
+                H[i, j] = sp.vdot(V[i], w)
+                w -= H[i, j] * V[i]
+            H[j + 1, j] = la.norm(w)
+            if H[j + 1, j] < tol * beta: #invariant subspace found
+                breakdown = True
+                break
+            V[j + 1] = w / H[j + 1, j]
+        j += 1
+        
+        I = sp.eye(j, dtype=H.dtype)
+        for i in xrange(len(shifts)):
+            if abs(c[i]) < tol * beta:
+                continue
+            z = la.solve(shifts[i] * I - H[:j, :j], c[i] * I[:, 0])
+            x[i] += z.dot(V[:j])
+            c[i] = H[j, j - 1] * z[-1] #new residual, along V[j]
+            
+        if breakdown:
+            c.fill(0) #the solutions are exact
+            break
+            
+        if sp.all(abs(c) < tol * beta):
+            break
+        
+        V[0] = V[j]
+        
+    convg = sp.all(abs(c) < tol * beta)
+    
+    return x, convg, itr
@@ -94,17 +94,25 @@ def nullspace(A, atol=1e-13, rtol=0):
     ns = vh[nnz:].conj().T
     return ns
     
-def nullspace_qr(A):
+def nullspace_qr(A, tol=None):
     """Compute an approximate basis for the nullspace of A.
 
     The algorithm used by this function is based on the QR
     decomposition of `A`.
+    
+    By default, A is assumed to have full rank, so that the dimension of 
+    the nullspace is known in advance. If tol is given, the rank is instead
+    estimated using a QR decomposition with column pivoting, which is 
+    rank-revealing: Diagonal entries of R smaller than tol * abs(R[0, 0]) 
+    are considered to be zero.
 
     Parameters
     ----------
     A : ndarray
         A should be at most 2-D.  A 1-D array with length k will be treated
         as a 2-D with shape (1, k)
+    tol : float
+        The relative tolerance for determining the rank (may be None).
 
     Return value
     ------------
@@ -118,8 +126,54 @@ def nullspace_qr(A):
 
     A = np.atleast_2d(A)
 
-    Q, R = qr(A.T)
+    if tol is None:
+        Q, R = qr(A.T, check_finite=False)
+        rank = min(A.shape)
+    else:
+        Q, R, P = qr(A.T, pivoting=True, check_finite=False)
+        d = abs(np.diag(R))
+        if d.shape[0] == 0 or d[0] == 0:
+            rank = 0
+        else:
+            rank = int((d >= tol * d[0]).sum())
+    
+    ns = Q[:, rank:].conj()
+    
+    return ns
+    
+def calc_Vsh(A, sqrt_r, tol=None):
+    """Computes a basis for the gauge-fixed tangent space of an MPS site.
+    
+    This is shared by the TDVP classes, which use right gauge fixing. With
+    R[:, s, :] = sqrt_r A[s]^dagger, V is a basis for the nullspace of
+    R^dagger, so that sum_s Vsh[s]^dagger sqrt_r A[s]^dagger = 0.
+    The basis is computed using nullspace_qr().
+    
+    Parameters
+    ----------
+    A : ndarray
+        The site tensor, with shape (q, D1, D2).
+    sqrt_r : ndarray
+        The square root of the right density matrix, with shape (D2, D2).
+    tol : float
+        The relative tolerance for determining the rank of R (may be None,
+        in which case R is assumed to have full rank D1).
+        
+    Returns
+    -------
+    Vsh : ndarray
+        The adjoints of the V[s] as an array with shape (q, D2, n), where
+        n = q * D2 - D1 (if R has full rank).
+    """
+    q, D1, D2 = A.shape
+    
+    R = np.empty((D2, q, D1), dtype=A.dtype)
+    for s in xrange(q):
+        R[:, s, :] = sqrt_r.dot(A[s].conj().T)
+    
+    R = R.reshape((q * D2, D1))
     
-    ns = Q[:, R.shape[1]:].conj()
+    Vconj = nullspace_qr(R.conj().T, tol=tol).T
+    Vconj = Vconj.reshape((Vconj.shape[0], D2, q))
     
-    return ns
\ No newline at end of file
+    return np.asarray(Vconj.T, order='C')
@@ -0,0 +1,706 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Ashley Milsted
+
+Block-sparse site tensors for states with a conserved U(1) or Z_n charge.
+
+A site tensor A, with shape (q, D1, D2), is symmetric if A[s][i, j] can
+only be nonzero where
+
+    qn_l[i] + qn_phys[s] = qn_r[j],
+
+with integer charges qn_phys on the physical index and qn_l, qn_r on the
+left and right virtual indices. For a Z_n symmetry, such as the Z_2 parity
+of Ising-type models, the charges are taken modulo n (the modulus) and
+the sum is reduced accordingly. The virtual charges are kept sorted, so
+that each charge sector is a contiguous range of indices and the nonzero
+part of A[s] consists of the dense blocks
+A[s][sector_l(c), sector_r(fuse(c, qn_phys[s]))]. Matrices that carry no charge,
+such as l, r and K, are block-diagonal.
+
+The tensors themselves are stored as ordinary dense arrays, so that code
+that does not know about the symmetry (computing expectation values of
+arbitrary operators, for example) continues to work. The block structure
+is described by a BlockStructure object, which the functions below use to
+visit only the nonzero blocks. They mirror those in tdvp_common and, for
+sectors of similar size, reduce the cost of the O(D**3) contractions by
+about the number of sectors. Elements outside the allowed blocks are
+ignored in the arguments and are zero in the results.
+
+Operators used with these functions (the Hamiltonian terms) must conserve
+the charge. See check_op().
+"""
+import numpy as np
+import scipy.linalg as la
+import nullspace as ns
+import matmul as m
+
+def fuse(c, dq, modulus=None):
+    """Returns the charge c + dq, reduced modulo modulus for a Z_n charge.
+    """
+    if modulus is None:
+        return c + dq
+    else:
+        return (c + dq) % modulus
+
+class ChargeIndex:
+    """The charges on a virtual index.
+
+    The charges are sorted, so that each sector of equal charge is a
+    contiguous range of indices.
+
+    Attributes
+    ----------
+    qn : ndarray
+        The sorted charges, one per index value.
+    modulus : int
+        For a Z_n charge, n. The charges are then reduced to 0..n-1. None
+        for a U(1) charge.
+    dim : int
+        The dimension of the index.
+    sectors : list of (int, slice)
+        The charges present, in ascending order, together with the
+        corresponding index ranges.
+    slices : dict
+        The index range for each charge present.
+    """
+    def __init__(self, qn, modulus=None):
+        self.modulus = modulus
+        self.qn = np.sort(fuse(np.asarray(qn, dtype=int).ravel(), 0, modulus))
+        self.dim = self.qn.shape[0]
+
+        charges, start = np.unique(self.qn, return_index=True)
+        stop = np.append(start[1:], self.dim)
+
+        self.sectors = [(int(c), slice(a, b))
+                        for c, a, b in zip(charges, start, stop)]
+        self.slices = dict(self.sectors)
+
+    def mask(self, other=None):
+        """Returns a boolean array marking the allowed elements of a
+        charge-conserving matrix with this index for the rows and other
+        (by default, this index) for the columns.
+        """
+        if other is None:
+            other = self
+        return self.qn[:, None] == other.qn[None, :]
+
+    def project(self, x, other=None):
+        """Returns a copy of the matrix x with the elements outside the
+        allowed blocks (see mask()) set to zero.
+        """
+        x = np.array(x)
+        x[~self.mask(other)] = 0
+        return x
+
+class BlockStructure:
+    """The block structure of a symmetric site tensor A with shape
+    (q, D1, D2).
+
+    Attributes
+    ----------
+    qn_phys : ndarray
+        The charges of the physical basis states.
+    left, right : ChargeIndex
+        The charges on the left and right virtual indices.
+    blocks : list of (int, slice, slice)
+        The nonzero blocks (s, sl_l, sl_r), such that the only nonzero
+        elements of A[s] are in A[s][sl_l, sl_r].
+    """
+    def __init__(self, qn_phys, left, right):
+        if left.modulus != right.modulus:
+            raise ValueError("The virtual indices have different symmetries!")
+
+        self.modulus = left.modulus
+        self.qn_phys = fuse(np.asarray(qn_phys, dtype=int).ravel(), 0,
+                            self.modulus)
+        self.left = left
+        self.right = right
+
+        self.shape = (self.qn_phys.shape[0], left.dim, right.dim)
+
+        self.blocks = []
+        for s in xrange(self.shape[0]):
+            for c, sl_l in left.sectors:
+                sl_r = right.slices.get(fuse(c, self.qn_phys[s], self.modulus))
+                if not sl_r is None:
+                    self.blocks.append((s, sl_l, sl_r))
+
+        self._pairs = (None, None)
+        self._vci = None
+
+    def mask(self):
+        """Returns a boolean array, with the shape of A, marking the
+        allowed elements.
+        """
+        return (fuse(self.left.qn[None, :, None], self.qn_phys[:, None, None],
+                     self.modulus) == self.right.qn[None, None, :])
+
+    def project(self, A):
+        """Returns a copy of A with the elements outside the allowed blocks
+        set to zero.
+        """
+        A = np.array(A)
+        A[~self.mask()] = 0
+        return A
+
+    def pair_blocks(self, right):
+        """Returns the nonzero blocks of AA[s, t] = A[s].dot(Ap1[t]), with
+        A having this structure and Ap1 having the structure right.
+
+        The result is a list of (s, t, sl_a, sl_b, sl_c), with
+        AA[s, t][sl_a, sl_c] = A[s][sl_a, sl_b].dot(Ap1[t][sl_b, sl_c]).
+        It is cached for the last value of right.
+        """
+        if self._pairs[0] is right:
+            return self._pairs[1]
+
+        rblocks = {}
+        for t, sl_b, sl_c in right.blocks:
+            rblocks.setdefault(sl_b.start, []).append((t, sl_c))
+
+        pairs = []
+        for s, sl_a, sl_b in self.blocks:
+            for t, sl_c in rblocks.get(sl_b.start, []):
+                pairs.append((s, t, sl_a, sl_b, sl_c))
+
+        self._pairs = (right, pairs)
+
+        return pairs
+
+    def vsh_index(self):
+        """Returns the ChargeIndex for the columns of Vsh (see calc_Vsh()).
+
+        Each column has the charge of the left virtual index it connects
+        to, so that the parameter matrix x of a symmetric tangent vector is
+        block-diagonal. If A has full rank in each sector, the total
+        dimension is q * D2 - D1.
+        """
+        if not self._vci is None:
+            return self._vci
+
+        dims = {}
+        for s in xrange(self.shape[0]):
+            for c, sl_r in self.right.sectors:
+                c = fuse(c, -self.qn_phys[s], self.modulus)
+                dims[c] = dims.get(c, 0) + sl_r.stop - sl_r.start
+
+        for c, sl_l in self.left.sectors:
+            if c in dims:
+                dims[c] = max(dims[c] - (sl_l.stop - sl_l.start), 0)
+
+        qn = sorted(dims.iterkeys())
+        self._vci = ChargeIndex(np.repeat(qn, [dims[c] for c in qn]),
+                                modulus=self.modulus)
+
+        return self._vci
+
+def bond_charges(qn_phys, D, total=0, modulus=None):
+    """Chooses the virtual charges for a finite chain.
+
+    The charge of bond n is the total charge of sites 1..n, so that bond 0
+    has charge zero and bond N has charge total. Each bond dimension is
+    shared out among the possible charges in proportion to the number of
+    basis states supporting them. The dimensions are then reduced, where
+    necessary, so that each sector can have full rank.
+
+    Parameters
+    ----------
+    qn_phys : sequence of ndarray
+        The charges of the physical basis states for sites 1..N, with
+        element 0 unused.
+    D : ndarray
+        The requested bond dimensions for bonds 0..N.
+    total : int
+        The total charge of the state.
+    modulus : int
+        For a Z_n charge, n.
+
+    Returns
+    -------
+    qn_virt : list of ndarray
+        The charges for bonds 0..N. These may define bond dimensions
+        smaller than those requested.
+    """
+    N = len(D) - 1
+
+    def add_site(cnt, qn, sign):
+        res = {}
+        for c, k in cnt.iteritems():
+            for qs in qn:
+                cs = fuse(c, sign * qs, modulus)
+                res[cs] = res.get(cs, 0) + k
+        return res
+
+    cnt_l = [{0: 1}]
+    for n in xrange(1, N + 1):
+        cnt_l.append(add_site(cnt_l[-1], qn_phys[n], 1))
+
+    cnt_r = [{fuse(total, 0, modulus): 1}]
+    for n in reversed(xrange(1, N + 1)):
+        cnt_r.insert(0, add_site(cnt_r[0], qn_phys[n], -1))
+
+    dims = []
+    for n in xrange(N + 1):
+        w = dict((c, min(k, cnt_r[n][c])) for c, k in cnt_l[n].iteritems()
+                 if c in cnt_r[n])
+        wtot = sum(w.itervalues())
+        if wtot == 0:
+            raise ValueError("No states with total charge %d!" % total)
+
+        Dn = min(D[n], wtot)
+        d = dict((c, Dn * k // wtot) for c, k in w.iteritems())
+        rem = sorted(w.iterkeys(), key=lambda c: d[c] - Dn * w[c] / float(wtot))
+        i = 0
+        while sum(d.itervalues()) < Dn:
+            if d[rem[i]] < w[rem[i]]:
+                d[rem[i]] += 1
+            i = (i + 1) % len(rem)
+        dims.append(d)
+
+    #Make sure each sector can have full rank.
+    changed = True
+    while changed:
+        changed = False
+        for n in xrange(1, N + 1):
+            for c in dims[n]:
+                fr = sum(dims[n - 1].get(fuse(c, -qs, modulus), 0)
+                         for qs in qn_phys[n])
+                if dims[n][c] > fr:
+                    dims[n][c] = fr
+                    changed = True
+            for c in dims[n - 1]:
+                fr = sum(dims[n].get(fuse(c, qs, modulus), 0)
+                         for qs in qn_phys[n])
+                if dims[n - 1][c] > fr:
+                    dims[n - 1][c] = fr
+                    changed = True
+
+    return [np.repeat(sorted(d.keys()), [d[c] for c in sorted(d.keys())])
+            for d in dims]
+
+def check_op(op, qn_phys, modulus=None):
+    """Raises a ValueError if the operator does not conserve the charge.
+
+    Elements that violate the charge are ignored if they are smaller than
+    1E-12 times the largest element of op.
+
+    Parameters
+    ----------
+    op : ndarray
+        The operator, with shape (q1, ..., qk, q1, ..., qk) for a k-site
+        operator (see tdvp_common.get_op_array()).
+    qn_phys : sequence of ndarray
+        The charges of the physical basis states for each of the k sites.
+    modulus : int
+        For a Z_n charge, n.
+    """
+    k = len(qn_phys)
+    qtot = np.zeros([len(qn) for qn in qn_phys], dtype=int)
+    for i, qn in enumerate(qn_phys):
+        qtot += np.asarray(qn).reshape([-1 if j == i else 1
+                                        for j in xrange(k)])
+
+    diff = qtot.reshape(qtot.shape + (1,) * k) - qtot.reshape((1,) * k
+                                                              + qtot.shape)
+    diff = fuse(diff, 0, modulus)
+    absop = abs(np.asarray(op))
+    if absop.size == 0:
+        return
+    #Elements at round-off level, e.g. from a rotated basis, are tolerated
+    if np.any((diff != 0) & (absop > 1E-12 * absop.max())):
+        raise ValueError("The operator does not conserve the charge!")
+
+def _out(shape, out, *args):
+    if out is None:
+        return np.zeros(shape, dtype=np.result_type(*args))
+    else:
+        out.fill(0)
+        return out
+
+def eps_r_noop(x, A1, A2, bs, out=None):
+    """Implements the right epsilon map without an operator, for symmetric
+    A1 and A2 with block structure bs.
+
+    Returns sum_s A1[s] x H(A2[s]). If x is None, the identity is used.
+    """
+    if x is None:
+        out = _out((bs.shape[1], bs.shape[1]), out, A1, A2)
+    else:
+        x = np.asarray(x)
+        out = _out((bs.shape[1], bs.shape[1]), out, x, A1, A2)
+
+    for s, sl_l, sl_r in bs.blocks:
+        A1x = A1[s, sl_l, sl_r]
+        if not x is None:
+            A1x = A1x.dot(x[sl_r, sl_r])
+        out[sl_l, sl_l] += A1x.dot(A2[s, sl_l, sl_r].conj().T)
+
+    return out
+
+def eps_l_noop(x, A1, A2, bs, out=None):
+    """Implements the left epsilon map without an operator, for symmetric
+    A1 and A2 with block structure bs.
+
+    Returns sum_s H(A1[s]) x A2[s].
+    """
+    x = np.asarray(x)
+    out = _out((bs.shape[2], bs.shape[2]), out, x, A1, A2)
+
+    for s, sl_l, sl_r in bs.blocks:
+        out[sl_r, sl_r] += A1[s, sl_l, sl_r].conj().T.dot(
+                               x[sl_l, sl_l]).dot(A2[s, sl_l, sl_r])
+
+    return out
+
+def calc_AA(A, Ap1, bs1, bs2, out=None):
+    """Returns AA[s, t] = A[s].dot(Ap1[t]) for A with block structure bs1
+    and Ap1 with block structure bs2.
+    """
+    out = _out((A.shape[0], Ap1.shape[0], A.shape[1], Ap1.shape[2]), out,
+               A, Ap1)
+
+    for s, t, sl_a, sl_b, sl_c in bs1.pair_blocks(bs2):
+        out[s, t, sl_a, sl_c] = A[s, sl_a, sl_b].dot(Ap1[t, sl_b, sl_c])
+
+    return out
+
+def calc_C_mat_op_AA(op, AA, bs1, bs2, out=None):
+    """Returns C[s, t] = sum_{u, v} op[s, t, u, v] * AA[u, v] for AA from
+    calc_AA().
+
+    op must be a charge-conserving ndarray.
+    """
+    q1, q2, D1, D3 = AA.shape
+    op = np.asarray(op).reshape((q1 * q2, q1 * q2))
+
+    out = _out(AA.shape, out, op, AA)
+
+    done = set()
+    for s, t, sl_a, sl_b, sl_c in bs1.pair_blocks(bs2):
+        if (sl_a.start, sl_c.start) in done:
+            continue
+        done.add((sl_a.start, sl_c.start))
+
+        AAac = AA[:, :, sl_a, sl_c].reshape((q1 * q2, -1))
+        out[:, :, sl_a, sl_c] = op.dot(AAac).reshape((q1, q2, sl_a.stop - sl_a.start,
+                                                      sl_c.stop - sl_c.start))
+
+    return out
+
+def eps_r_op_2s_C12_AA34(x, C12, AA34, bs1, bs2):
+    """Implements the right epsilon map for a two-site operator, given
+    C12 = calc_C_mat_op_AA(op, AA12, bs1, bs2).
+
+    Returns sum_{u, v} C12[u, v] x H(AA34[u, v]).
+    """
+    x = np.asarray(x)
+    out = _out((C12.shape[2], AA34.shape[2]), None, x, C12, AA34)
+
+    for s, t, sl_a, sl_b, sl_c in bs1.pair_blocks(bs2):
+        out[sl_a, sl_a] += C12[s, t, sl_a, sl_c].dot(x[sl_c, sl_c]).dot(
+                               AA34[s, t, sl_a, sl_c].conj().T)
+
+    return out
+
+def eps_l_op_2s_AA12_C34(x, AA12, C34, bs1, bs2):
+    """Implements the left epsilon map for a two-site operator, given
+    C34 = calc_C_mat_op_AA(op, AA34, bs1, bs2).
+
+    Returns sum_{u, v} H(AA12[u, v]) x C34[u, v].
+    """
+    x = np.asarray(x)
+    out = _out((AA12.shape[3], C34.shape[3]), None, x, AA12, C34)
+
+    for s, t, sl_a, sl_b, sl_c in bs1.pair_blocks(bs2):
+        out[sl_c, sl_c] += AA12[s, t, sl_a, sl_c].conj().T.dot(
+                               x[sl_a, sl_a]).dot(C34[s, t, sl_a, sl_c])
+
+    return out
+
+def calc_C_r_AH(C, r, A, bs1, bs2):
+    """Returns res[s] = sum_t C[s, t] r H(A[t]), where C has the block
+    structure of AA for bs1 and bs2 and A has structure bs2.
+
+    The result has structure bs1.
+    """
+    r = np.asarray(r)
+    out = _out(bs1.shape, None, C, r, A)
+
+    for s, t, sl_a, sl_b, sl_c in bs1.pair_blocks(bs2):
+        out[s, sl_a, sl_b] += C[s, t, sl_a, sl_c].dot(r[sl_c, sl_c]).dot(
+                                  A[t, sl_b, sl_c].conj().T)
+
+    return out
+
+def calc_AH_l_C(A, l, C, bs1, bs2):
+    """Returns res[s] = sum_t H(A[t]) l C[t, s], where A has structure bs1
+    and C has the block structure of AA for bs1 and bs2.
+
+    The result has structure bs2.
+    """
+    l = np.asarray(l)
+    out = _out(bs2.shape, None, A, l, C)
+
+    for t, s, sl_a, sl_b, sl_c in bs1.pair_blocks(bs2):
+        out[s, sl_b, sl_c] += A[t, sl_a, sl_b].conj().T.dot(
+                                  l[sl_a, sl_a]).dot(C[t, s, sl_a, sl_c])
+
+    return out
+
+def mmul_stack_right(X, M, bs):
+    """Returns res[s] = X[s].dot(M) for X with structure bs and a
+    block-diagonal M.
+    """
+    M = np.asarray(M)
+    out = _out(bs.shape, None, X, M)
+
+    for s, sl_l, sl_r in bs.blocks:
+        out[s, sl_l, sl_r] = X[s, sl_l, sl_r].dot(M[sl_r, sl_r])
+
+    return out
+
+def mmul_stack_left(M, X, bs):
+    """Returns res[s] = M.dot(X[s]) for X with structure bs and a
+    block-diagonal M.
+    """
+    M = np.asarray(M)
+    out = _out(bs.shape, None, M, X)
+
+    for s, sl_l, sl_r in bs.blocks:
+        out[s, sl_l, sl_r] = M[sl_l, sl_l].dot(X[s, sl_l, sl_r])
+
+    return out
+
+def blockwise(f, ci, *args):
+    """Applies a matrix function blockwise.
+
+    Returns the block-diagonal matrix with the blocks
+    f(args[0][sl, sl], args[1][sl, sl], ...) for each sector sl of the
+    ChargeIndex ci. This is used, for example, for Cholesky decompositions
+    and matrix square roots of l and r.
+    """
+    args = [np.asarray(x) for x in args]
+    out = None
+    for c, sl in ci.sectors:
+        res = f(*[x[sl, sl] for x in args])
+        if out is None:
+            out = np.zeros((ci.dim, ci.dim), dtype=res.dtype)
+        out[sl, sl] = res
+
+    return out
+
+def eigh(x, ci):
+    """Diagonalizes a hermitian, block-diagonal matrix blockwise.
+
+    Unlike scipy.linalg.eigh(), this does not mix sectors in case of
+    degeneracies. The eigenvalues are in ascending order within each
+    sector.
+
+    Returns
+    -------
+    ev : ndarray
+        The eigenvalues.
+    EV : ndarray
+        The block-diagonal matrix of eigenvectors.
+    """
+    x = np.asarray(x)
+    ev = np.empty((ci.dim,), dtype=np.finfo(x.dtype).dtype)
+    EV = np.zeros_like(x)
+
+    for c, sl in ci.sectors:
+        ev[sl], EV[sl, sl] = la.eigh(x[sl, sl])
+
+    return ev, EV
+
+def svd(x, ci):
+    """Computes the singular value decomposition of a block-diagonal matrix
+    blockwise.
+
+    Returns U, sv, Vh, as for scipy.linalg.svd(), with U and Vh
+    block-diagonal. The singular values are in descending order within each
+    sector.
+    """
+    x = np.asarray(x)
+    U = np.zeros_like(x)
+    Vh = np.zeros_like(x)
+    sv = np.empty((ci.dim,), dtype=np.finfo(x.dtype).dtype)
+
+    for c, sl in ci.sectors:
+        U[sl, sl], sv[sl], Vh[sl, sl] = la.svd(x[sl, sl])
+
+    return U, sv, Vh
+
+def svd_AA(AA, bs1, bs2):
+    """Computes the singular value decomposition of a two-site tensor AA
+    (see calc_AA()) blockwise, splitting it into a pair of site tensors.
+
+    bs1 and bs2 are the block structures of the two sites. Only their
+    outer virtual indices (bs1.left and bs2.right) and physical charges are
+    used, since the charges on the bond between the sites are determined
+    by the decomposition.
+
+    Returns
+    -------
+    U : ndarray
+        The left site tensor, with shape (q1, D1, k).
+    sv : ndarray
+        The k singular values, in descending order within each sector.
+    Vh : ndarray
+        The right site tensor, with shape (q2, k, D2).
+    qn : ndarray
+        The charges of the new bond, in ascending order, so that U and Vh
+        have the block structures BlockStructure(bs1.qn_phys, bs1.left, ci)
+        and BlockStructure(bs2.qn_phys, ci, bs2.right), with 
+        ci = ChargeIndex(qn).
+    """
+    q1, D1 = bs1.shape[:2]
+    q2, D2 = bs2.shape[0], bs2.shape[2]
+    modulus = bs1.modulus
+
+    rows = {}
+    for s in xrange(q1):
+        for c, sl_a in bs1.left.sectors:
+            c12 = fuse(c, bs1.qn_phys[s], modulus)
+            rows.setdefault(c12, []).append((s, sl_a))
+
+    cols = {}
+    for t in xrange(q2):
+        for c, sl_b in bs2.right.sectors:
+            c12 = fuse(c, -bs2.qn_phys[t], modulus)
+            cols.setdefault(c12, []).append((t, sl_b))
+
+    res = []
+    for c in sorted(set(rows) & set(cols)):
+        M = np.vstack([np.hstack([AA[s, t, sl_a, sl_b]
+                                  for t, sl_b in cols[c]])
+                       for s, sl_a in rows[c]])
+        res.append((c,) + tuple(la.svd(M, full_matrices=False)))
+
+    k = sum(len(sv) for c, U, sv, Vh in res)
+    U = np.zeros((q1, D1, k), dtype=AA.dtype)
+    Vh = np.zeros((q2, k, D2), dtype=AA.dtype)
+    sv = np.empty((k,), dtype=np.finfo(AA.dtype).dtype)
+    qn = np.empty((k,), dtype=int)
+
+    i = 0
+    for c, U_c, sv_c, Vh_c in res:
+        sl_k = slice(i, i + len(sv_c))
+        sv[sl_k] = sv_c
+        qn[sl_k] = c
+
+        j = 0
+        for s, sl_a in rows[c]:
+            d = sl_a.stop - sl_a.start
+            U[s, sl_a, sl_k] = U_c[j:j + d]
+            j += d
+
+        j = 0
+        for t, sl_b in cols[c]:
+            d = sl_b.stop - sl_b.start
+            Vh[t, sl_k, sl_b] = Vh_c[:, j:j + d]
+            j += d
+
+        i += len(sv_c)
+
+    return U, sv, Vh, qn
+
+def sqrtmh_inv(x, ci):
+    """Returns the matrix square root of a hermitian, block-diagonal matrix
+    and its inverse, computed blockwise.
+
+    As in the dense case, the eigenvalue decomposition used for the square
+    root is reused for the inverse (see matmul.sqrtmh() and matmul.invmh()).
+    """
+    x = np.asarray(x)
+    x_sqrt = None
+    for c, sl in ci.sectors:
+        res, evd = m.sqrtmh(x[sl, sl], ret_evd=True)
+        if x_sqrt is None:
+            x_sqrt = np.zeros((ci.dim, ci.dim), dtype=res.dtype)
+            x_sqrt_i = np.zeros_like(x_sqrt)
+        x_sqrt[sl, sl] = res
+        x_sqrt_i[sl, sl] = m.invmh(res, evd=evd)
+
+    return x_sqrt, x_sqrt_i
+
+def calc_Vsh(A, sqrt_r, bs):
+    """Computes Vsh (see nullspace.calc_Vsh()) for a symmetric A with block
+    structure bs.
+
+    Each column of Vsh has a definite charge, given by bs.vsh_index(), so
+    that symmetric tangent vectors have a block-diagonal x. The nullspace
+    is computed separately for each sector. Columns with charges absent
+    from the left virtual index do not contribute to symmetric tangent
+    vectors, but are included so that Vsh spans the whole nullspace (as
+    needed for excitations with a nonzero charge).
+    """
+    q, D1, D2 = bs.shape
+    sqrt_r = np.asarray(sqrt_r)
+    vci = bs.vsh_index()
+
+    Vsh = np.zeros((q, D2, vci.dim), dtype=np.result_type(A, sqrt_r))
+
+    for c, sl_v in vci.sectors:
+        rows = [(s, bs.right.slices[fuse(c, bs.qn_phys[s], bs.modulus)])
+                for s in xrange(q)
+                if fuse(c, bs.qn_phys[s], bs.modulus) in bs.right.slices]
+
+        sl_l = bs.left.slices.get(c)
+        if sl_l is None:
+            V = np.eye(sl_v.stop - sl_v.start)
+        else:
+            #R^dagger for this sector, see nullspace.calc_Vsh()
+            RH = np.hstack([A[s, sl_l, sl_r].dot(sqrt_r[sl_r, sl_r])
+                            for s, sl_r in rows])
+
+            V = ns.nullspace_qr(RH)
+
+        i = 0
+        for s, sl_r in rows:
+            d = sl_r.stop - sl_r.start
+            Vsh[s, sl_r, sl_v] = V[i:i + d]
+            i += d
+
+    return Vsh
+
+def contract_Vsh(X, Vsh, bs, out=None):
+    """Returns sum_s X[s].dot(Vsh[s]) for X with structure bs and Vsh from
+    calc_Vsh().
+    """
+    vci = bs.vsh_index()
+    out = _out((bs.shape[1], vci.dim), out, X, Vsh)
+
+    for s, sl_l, sl_r in bs.blocks:
+        sl_v = vci.slices.get(bs.left.qn[sl_l.start])
+        if not sl_v is None:
+            out[sl_l, sl_v] += X[s, sl_l, sl_r].dot(Vsh[s, sl_r, sl_v])
+
+    return out
+
+def calc_B_from_x(x, Vsh, l_sqrt_i, r_sqrt_i, bs):
+    """Returns B[s] = l_sqrt_i x H(Vsh[s]) r_sqrt_i for Vsh from calc_Vsh()
+    and a block-diagonal x (with columns given by bs.vsh_index()).
+
+    The result has the structure bs.
+    """
+    vci = bs.vsh_index()
+    l_sqrt_i = np.asarray(l_sqrt_i)
+    r_sqrt_i = np.asarray(r_sqrt_i)
+
+    out = _out(bs.shape, None, x, Vsh, l_sqrt_i, r_sqrt_i)
+
+    lx = {}
+    for c, sl_l in bs.left.sectors:
+        sl_v = vci.slices.get(c)
+        if not sl_v is None:
+            lx[c] = l_sqrt_i[sl_l, sl_l].dot(x[sl_l, sl_v])
+
+    for s, sl_l, sl_r in bs.blocks:
+        c = bs.left.qn[sl_l.start]
+        if c in lx:
+            sl_v = vci.slices[c]
+            out[s, sl_l, sl_r] = lx[c].dot(Vsh[s, sl_r, sl_v].conj().T).dot(
+                                     r_sqrt_i[sl_r, sl_r])
+
+    return out
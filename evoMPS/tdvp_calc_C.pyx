@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Jan 21 13:21:20 2012
+
+@author: ash
+
+Computes C[s, t] = sum_{u, v} h_nn[s, t, u, v] * AA[u, v].
+
+Only the nonzero elements of h_nn are used. These are stored in compressed
+sparse row (CSR) form, with rows and columns labelled by the flattened
+index pairs (s, t) and (u, v), respectively. Each nonzero element
+contributes one BLAS zaxpy over a whole D1 x D2 block of AA. The output
+blocks are computed in parallel where OpenMP is available (setup.py builds
+this module with -fopenmp if the compiler supports it).
+"""
+
+import cython as cy
+import numpy as np
+cimport numpy as np
+cimport cpython.pycapsule as pc
+from cython.parallel import prange
+from scipy.linalg.cython_blas cimport zaxpy
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+@cy.cdivision(True)
+cdef void _calc_C_sparse(int[::1] indptr, int[::1] indices,
+                         DTYPE_t[::1] data, DTYPE_t[:, :, :, ::1] AA,
+                         DTYPE_t[:, :, :, ::1] out) nogil:
+    cdef int q2 = AA.shape[1]
+    cdef int n = AA.shape[2] * AA.shape[3]
+    cdef int one = 1
+
+    cdef int row, k, col
+
+    for row in prange(indptr.shape[0] - 1):
+        for k in range(indptr[row], indptr[row + 1]):
+            col = indices[k]
+            zaxpy(&n, &data[k], &AA[col // q2, col % q2, 0, 0], &one,
+                  &out[row // q2, row % q2, 0, 0], &one)
+
+def calc_C_sparse(int[::1] indptr, int[::1] indices, DTYPE_t[::1] data,
+                  DTYPE_t[:, :, :, ::1] AA, DTYPE_t[:, :, :, ::1] out):
+    """Computes C[s, t] = sum_{u, v} h_nn[s, t, u, v] * AA[u, v] from the
+    CSR form of h_nn.reshape((q1 * q2, q1 * q2)), writing the result to out.
+
+    See tdvp_common.get_op_sparse().
+    """
+    cdef int q1 = AA.shape[0]
+    cdef int q2 = AA.shape[1]
+    cdef int k
+
+    assert indptr.shape[0] == q1 * q2 + 1
+    assert indices.shape[0] >= indptr[q1 * q2]
+    assert data.shape[0] >= indptr[q1 * q2]
+    assert out.shape[0] == q1 and out.shape[1] == q2
+    assert out.shape[2] == AA.shape[2] and out.shape[3] == AA.shape[3]
+
+    for k in range(indptr[q1 * q2]):
+        assert 0 <= indices[k] < q1 * q2
+
+    out[:, :, :, :] = 0
+
+    _calc_C_sparse(indptr, indices, data, AA, out)
+
+    return out
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+cpdef calc_C(np.ndarray[DTYPE_t, ndim=4, mode="c"] AA,
+             h_nn_cptr, np.ndarray[DTYPE_t, ndim=4, mode="c"] out):
+
+    assert pc.PyCapsule_CheckExact(h_nn_cptr)
+
+    cdef h_nn_func h_nn = <h_nn_func>pc.PyCapsule_GetPointer(h_nn_cptr, 'h_nn')
+
+    cdef int q1 = AA.shape[0]
+    cdef int q2 = AA.shape[1]
+
+    cdef int D1 = AA.shape[2]
+    cdef int D2 = AA.shape[3]
+
+    if out is None:
+        out = np.empty([q1, q2, D1, D2], dtype=AA.dtype)
+    else:
+        assert out.shape[0] == q1 and out.shape[1] == q2
+        assert out.shape[2] == D1 and out.shape[3] == D2
+
+    #Evaluating h_nn is cheap compared to the contraction, so we just
+    #collect the nonzero elements each time.
+    cdef int[::1] indptr = np.empty((q1 * q2 + 1,), dtype=np.intc)
+    cdef int[::1] indices = np.empty((q1 * q2 * q1 * q2,), dtype=np.intc)
+    cdef DTYPE_t[::1] data = np.empty((q1 * q2 * q1 * q2,), dtype=np.complex128)
+
+    cdef int s, t, u, v
+    cdef int nnz = 0
+
+    cdef DTYPE_t h
+
+    with nogil:
+        indptr[0] = 0
+        for s in range(q1):
+            for t in range(q2):
+                for u in range(q1):
+                    for v in range(q2):
+                        h = h_nn(s, t, u, v)
+                        if h != 0:
+                            indices[nnz] = u * q2 + v
+                            data[nnz] = h
+                            nnz += 1
+                indptr[s * q2 + t + 1] = nnz
+
+    out.fill(0)
+
+    _calc_C_sparse(indptr, indices, data, AA, out)
+
+    return out
@@ -0,0 +1,695 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Ashley Milsted
+
+Routines shared by the TDVP classes.
+
+Operators (including Hamiltonian terms) may be given either as python
+callables, returning a single matrix element per call, or as ndarrays.
+The callables are converted into ndarrays once, using get_op_array(),
+so that all contractions can be done using tensordot() over whole arrays,
+rather than using one python call per matrix element.
+
+Index conventions for the array forms:
+    op[s, t] = <s|op|t>
+    h_nn[s, t, u, v] = <st|h_nn|uv>
+
+Where the compiled kernels in tdvp_kernels and tdvp_calc_C are available, 
+they are used for C-contiguous complex128 arrays. Otherwise, numpy is used.
+"""
+import numpy as np
+import scipy.linalg as la
+import scipy.sparse as sps
+import matmul as m
+import symmetry as sy
+
+try:
+    import tdvp_kernels as tk
+except ImportError:
+    tk = None
+
+try:
+    import tdvp_calc_C as tc
+except ImportError:
+    tc = None
+
+def _kernel_arrays(*args):
+    """Returns True if all arguments are C-contiguous complex128 ndarrays.
+    """
+    for a in args:
+        if not (type(a) is np.ndarray and a.dtype == np.complex128 
+                and a.flags.c_contiguous):
+            return False
+    
+    return True
+
+def _use_kernels(*args):
+    """Returns True if the compiled kernels can be used with the arguments.
+    """
+    return not tk is None and _kernel_arrays(*args)
+
+def get_op_array(op, shape, n=None, dtype=None):
+    """Returns an ndarray form of an operator.
+
+    Parameters
+    ----------
+    op : function or ndarray
+        The operator. If it is a function, it is called once for each
+        matrix element, with the site number n (if not None) as the first
+        argument, followed by the indices. If it is an ndarray, it is
+        returned as is. In case n is not None, an ndarray with an extra
+        leading dimension is also accepted and is indexed using n.
+    shape : tuple of int
+        The expected shape, e.g. (q, q) for a single-site operator or
+        (q, q, q, q) for a nearest-neighbour operator.
+    n : int
+        The site number (may be None).
+    dtype : numpy dtype
+        If not None, the result is converted to this type. For a real type,
+        a ValueError is raised if the operator is not real.
+
+    Returns
+    -------
+    op_arr : ndarray
+        The operator in array form.
+    """
+    if callable(op):
+        if n is None:
+            args = ()
+        else:
+            args = (n,)
+        op_arr = np.array([op(*(args + ind)) for ind in np.ndindex(*shape)])
+        op_arr = op_arr.reshape(shape)
+    else:
+        op_arr = np.asarray(op)
+        if not n is None and op_arr.ndim == len(shape) + 1:
+            op_arr = op_arr[n]
+    
+        if op_arr.shape != tuple(shape):
+            raise ValueError("Operator array has shape %s, expected %s."
+                             % (str(op_arr.shape), str(tuple(shape))))
+    
+    if not dtype is None:
+        if (np.iscomplexobj(op_arr) and not is_complex_type(dtype)):
+            if np.any(op_arr.imag != 0):
+                raise ValueError("Operator is not real, but a real dtype "
+                                 "(%s) was requested." % np.dtype(dtype).name)
+            op_arr = op_arr.real
+        op_arr = np.asarray(op_arr, dtype=dtype)
+
+    return op_arr
+
+def is_complex_type(dtype):
+    """Returns True if dtype is a complex floating point type.
+    """
+    return np.issubdtype(dtype, np.complexfloating)
+
+def check_dtype(dtype, supported=(np.float64, np.complex128, np.complex64)):
+    """Checks that dtype is supported for the MPS parameters and returns it
+    as a numpy dtype.
+    
+    A real dtype (float64) can be used for imaginary time evolution with
+    real Hamiltonians, which halves memory use and requires about a quarter
+    of the floating point operations of the complex case.
+    
+    In single precision (complex64), the state parameters and the 
+    quantities derived directly from them are stored in single precision,
+    while l, r and the solutions of linear problems are computed in double
+    precision (see high_precision_dtype()). This is intended for 
+    exploratory simulations that do not require high accuracy.
+    """
+    dtype = np.dtype(dtype)
+    if not dtype in [np.dtype(t) for t in supported]:
+        raise ValueError("Unsupported dtype: %s" % dtype.name)
+        
+    return dtype
+
+def high_precision_dtype(dtype):
+    """Returns the double precision type corresponding to dtype.
+    """
+    return np.result_type(dtype, np.float64)
+
+def default_tolerances(dtype):
+    """Returns default relative and absolute tolerances for the iterative
+    solvers, given the type of the state parameters.
+    
+    The results are not more accurate than the parameters, so the 
+    tolerances are relaxed in single precision.
+    """
+    eps = np.finfo(dtype).eps
+    
+    return max(1E-13, 10 * eps), max(1E-14, eps)
+
+def get_dtau(dtau, dtype):
+    """Returns the step size dtau in a form suitable for updating 
+    parameters of type dtype.
+    
+    With a real dtype, only imaginary time evolution is possible, so that
+    dtau must be real. A ValueError is raised otherwise.
+    """
+    if is_complex_type(dtype):
+        return dtau
+    
+    if np.imag(dtau) != 0:
+        raise ValueError("Real time evolution (complex dtau) requires a "
+                         "complex dtype.")
+                         
+    return np.real(dtau)
+
+#Butcher tableaux (a, b, e, p) for the embedded Runge-Kutta methods used by
+#rk_adaptive_step(). Stage i > 0 is evaluated at
+#A0 - dtau * sum_j a[i - 1][j] * B_j, the new state is
+#A0 - dtau * sum_j b[j] * B_j and the local error is estimated as
+#dtau * sum_j e[j] * B_j, with e the difference between the weights of the
+#two embedded solutions. p is the order of the lower-order solution.
+rk_tableaux = {
+    'BS23': ([[1./2],
+              [0., 3./4],
+              [2./9, 1./3, 4./9]],
+             [2./9, 1./3, 4./9, 0.],
+             [-5./72, 1./12, 1./9, -1./8],
+             2),
+    'DP54': ([[1./5],
+              [3./40, 9./40],
+              [44./45, -56./15, 32./9],
+              [19372./6561, -25360./2187, 64448./6561, -212./729],
+              [9017./3168, -355./33, 46732./5247, 49./176, -5103./18656],
+              [35./384, 0., 500./1113, 125./192, -2187./6784, 11./84]],
+             [35./384, 0., 500./1113, 125./192, -2187./6784, 11./84, 0.],
+             [71./57600, 0., -71./16695, 71./1920, -17253./339200, 22./525,
+              -1./40],
+             4)
+}
+
+def get_rk_tableau(method):
+    """Returns the tableau (a, b, e, p) for an embedded Runge-Kutta method.
+
+    See rk_tableaux. A ValueError is raised if the method is unknown.
+    """
+    try:
+        return rk_tableaux[method]
+    except KeyError:
+        raise ValueError("Unknown Runge-Kutta method: %s. Choose from %s."
+                         % (method, ", ".join(sorted(rk_tableaux))))
+
+def rk_stage(A0, dtau, coeff, Bs):
+    """Returns A0 - dtau * sum_j coeff[j] * Bs[j], skipping zero coefficients
+    and missing (None) tangent vectors.
+    """
+    res = A0.copy()
+    for c, B in zip(coeff, Bs):
+        if c != 0 and not B is None:
+            res -= (dtau * c) * B
+    return res
+
+def calc_dtau_next(dtau, err, tol, p, safety=0.9, fac_min=0.2, fac_max=5.):
+    """Proposes a new step size, given the estimated local error err of a step
+    of size dtau made using an embedded method of order p (see rk_tableaux).
+
+    The local error scales as dtau**(p + 1), so the step size is chosen to
+    give an error of about safety * tol. The change is limited to a factor
+    between fac_min and fac_max.
+    """
+    if err == 0:
+        fac = fac_max
+    else:
+        fac = min(fac_max, max(fac_min, safety * (tol / err)**(1. / (p + 1))))
+    return dtau * fac
+
+def _rk_stage_list(A0, dtau, coeff, Bs):
+    """Applies rk_stage() to each element of a list of parameter tensors,
+    skipping None entries. Bs is a list of lists with the layout of A0.
+    """
+    return [None if A0_n is None 
+            else rk_stage(A0_n, dtau, coeff, [B[n] for B in Bs])
+            for n, A0_n in enumerate(A0)]
+
+def rk_adaptive_step(A0, dtau, B0, calc_B, restore, tangent_norm, tol, 
+                     method='BS23', max_rejects=10):
+    """Takes a step using an embedded Runge-Kutta method (see rk_tableaux),
+    retrying with smaller step sizes until the estimated local error is 
+    below tol.
+    
+    This is the step size controller shared by the take_step_adaptive() 
+    methods of the TDVP classes. The state is a list of parameter tensors 
+    (e.g. A[n] for each site), where entries may be None.
+    
+    Parameters
+    ----------
+    A0 : list of ndarray
+        The initial parameter tensors.
+    dtau : complex
+        The step size to try first.
+    B0 : list of ndarray
+        The tangent vectors at A0, with the layout of A0.
+    calc_B : function
+        calc_B() returns the tangent vectors for the current state.
+    restore : function
+        restore(A) sets the state to the parameter tensors A and computes
+        whatever calc_B() depends on.
+    tangent_norm : function
+        tangent_norm(dA) returns the norm of the tangent vectors dA at A0.
+    tol : float
+        The tolerance for the local error.
+    method : str
+        The embedded method (see get_rk_tableau()).
+    max_rejects : int
+        The maximum number of times the step is retried. The last try is
+        accepted regardless of the error.
+        
+    Returns
+    -------
+    A : list of ndarray
+        The new parameter tensors. The state itself is left at the last 
+        stage, so the caller must set these.
+    dtau_taken : complex
+        The step size actually used.
+    dtau_next : complex
+        The proposed step size for the next step.
+    err : float
+        The estimated local error of the step.
+    rejects : int
+        The number of rejected tries.
+    """
+    a, b, e, p = get_rk_tableau(method)
+    
+    zeros = [None if A0_n is None else np.zeros_like(A0_n) for A0_n in A0]
+    
+    for i in xrange(max_rejects + 1):
+        Bs = [B0]
+        for a_i in a:
+            restore(_rk_stage_list(A0, dtau, a_i, Bs))
+            Bs.append(calc_B())
+            
+        err = tangent_norm(_rk_stage_list(zeros, -dtau, e, Bs))
+        
+        dtau_next = calc_dtau_next(dtau, err, tol, p)
+        
+        if err <= tol or i == max_rejects:
+            break
+        
+        dtau = dtau_next
+        
+    return _rk_stage_list(A0, dtau, b, Bs), dtau, dtau_next, err, i
+
+def expmv_lanczos(matvec, v, t, tol=1E-12, max_itr=30):
+    """Returns exp(t * H).dot(v) for a Hermitian operator H, using the 
+    Lanczos method.
+    
+    The exponential is computed in the Krylov subspace spanned by
+    v, Hv, ..., H^(k-1)v, where it is just the exponential of a k x k
+    tridiagonal matrix. For real time evolution, t = -1.j * dt. The subspace 
+    is extended until the estimated error falls below tol, which usually 
+    requires only a few matrix-vector products if |t| times the spread of 
+    the spectrum of H is not too large.
+    
+    The Lanczos vectors are fully reorthogonalized, since max_itr is small.
+
+    Parameters
+    ----------
+    matvec : function
+        Computes H.dot(x) for an ndarray x with the shape of v.
+    v : ndarray
+        The vector to apply the exponential to (of any shape).
+    t : complex
+        The factor in the exponent.
+    tol : float
+        Tolerance for the norm of the error of the result.
+    max_itr : int
+        The maximum dimension of the Krylov subspace.
+
+    Returns
+    -------
+    res : ndarray
+        The result, with the shape of v.
+    itr : int
+        The number of calls to matvec.
+    """
+    nrm = np.sqrt(abs(np.vdot(v, v)))
+    if nrm == 0:
+        return np.array(v), 0
+    
+    V = [v / nrm]
+    alpha = []
+    beta = []
+    for k in xrange(max_itr):
+        w = matvec(V[k])
+        alpha.append(np.vdot(V[k], w).real)
+        
+        for u in V:
+            w = w - np.vdot(u, w) * u
+        b = np.sqrt(abs(np.vdot(w, w)))
+        
+        T = np.diag(alpha) + np.diag(beta, 1) + np.diag(beta, -1)
+        c = la.expm(t * T)[:, 0]
+        
+        if b * abs(c[-1]) * nrm < tol or k == max_itr - 1:
+            break
+            
+        beta.append(b)
+        V.append(w / b)
+    
+    res = c[0] * V[0]
+    for j in xrange(1, len(c)):
+        res += c[j] * V[j]
+    
+    return nrm * res, k + 1
+
+def calc_AA(A, Ap1, out=None):
+    """Returns AA[s, t] = A[s].dot(Ap1[t]) for all s, t as a 4-d array.
+    """
+    if out is None:
+        if _use_kernels(A, Ap1):
+            out = np.empty((A.shape[0], Ap1.shape[0], A.shape[1], 
+                            Ap1.shape[2]), dtype=np.complex128)
+            tk.calc_AA(A, Ap1, out)
+            return out
+    elif _use_kernels(A, Ap1, out):
+        tk.calc_AA(A, Ap1, out)
+        return out
+        
+    AA = np.tensordot(A, Ap1, axes=((2,), (1,))) #[s, i, t, j]
+    AA = AA.transpose((0, 2, 1, 3))
+
+    if out is None:
+        return np.ascontiguousarray(AA)
+    else:
+        out[:] = AA
+        return out
+
+def get_op_sparse(op):
+    """Returns the nonzero elements of a two-site operator in sparse form.
+    
+    This is worth doing once per operator if it is used to compute C
+    repeatedly using calc_C_mat_op_AA(), since typical nearest-neighbour
+    Hamiltonians have only a few nonzero elements.
+
+    Parameters
+    ----------
+    op : ndarray
+        The operator in array form, with op[s, t, u, v] = <st|op|uv>.
+
+    Returns
+    -------
+    op_sp : scipy.sparse.csr_matrix
+        op.reshape((q1 * q2, q1 * q2)) in compressed sparse row form.
+    """
+    q1, q2 = op.shape[:2]
+    op_sp = sps.csr_matrix(np.asarray(op).reshape((q1 * q2, q1 * q2)))
+    op_sp.eliminate_zeros()
+    op_sp.sort_indices()
+    
+    return op_sp
+
+def calc_C_mat_op_AA(op, AA, out=None):
+    """Returns C[s, t] = sum_{u, v} op[s, t, u, v] * AA[u, v].
+
+    op must be an ndarray (see get_op_array()) or the sparse form returned
+    by get_op_sparse(). In the latter case, only the nonzero elements of op 
+    contribute, each requiring one BLAS axpy on a D1 x D2 block if the 
+    tdvp_calc_C module is available.
+    """
+    if not sps.issparse(op):
+        res = np.tensordot(op, AA, ((2, 3), (0, 1)))
+        if out is None:
+            return res
+        out[:] = res
+        return out
+    
+    q1, q2, D1, D2 = AA.shape
+    
+    if not tc is None and _kernel_arrays(AA) and (out is None 
+                                                  or _kernel_arrays(out)):
+        if out is None:
+            out = np.empty_like(AA)
+        tc.calc_C_sparse(np.asarray(op.indptr, dtype=np.intc), 
+                         np.asarray(op.indices, dtype=np.intc),
+                         np.asarray(op.data, dtype=np.complex128), AA, out)
+        return out
+        
+    res = op.dot(AA.reshape((q1 * q2, D1 * D2))).reshape((q1, q2, D1, D2))
+    if out is None:
+        return res
+    out[:] = res
+    return out
+
+def _dot_out(a, b, out=None):
+    """Returns a.dot(b), writing directly into out where possible.
+    """
+    if out is None:
+        return np.dot(a, b)
+
+    try:
+        return np.dot(a, b, out=out)
+    except ValueError: #out has the wrong dtype or is not C-contiguous
+        out[:] = np.dot(a, b)
+        return out
+
+def eps_r_noop(x, A1, A2, out=None):
+    """Implements the right epsilon map without an operator.
+
+    Returns sum_s A1[s] x H(A2[s]).
+
+    A1 is treated as a (q * D1, D2) block, so that the whole map requires
+    just two matrix multiplications and one transposed copy of the
+    intermediate result (plus one of A2), rather than two dot() calls
+    and several temporaries per physical index.
+    """
+    q, D1, D2 = A1.shape
+    D1_ = A2.shape[1]
+    
+    if _use_kernels(x, A1, A2) and (out is None or _use_kernels(out)):
+        if out is None:
+            out = np.empty((D1, D1_), dtype=np.complex128)
+        tk.eps_r(x, A1, A2, out)
+        return out
+
+    A1x = np.dot(A1.reshape((q * D1, D2)), np.asarray(x)) #[s, i, m]
+    A1x = A1x.reshape((q, D1, A1x.shape[1])).transpose((1, 0, 2))
+    A1x = A1x.reshape((D1, -1)) #[i, (s, m)] (copy)
+
+    A2c = np.empty((D1_, q, A2.shape[2]), dtype=A2.dtype)
+    np.conjugate(A2.transpose((1, 0, 2)), out=A2c)
+
+    return _dot_out(A1x, A2c.reshape((D1_, -1)).T, out=out)
+
+def eps_l_noop(x, A1, A2, out=None):
+    """Implements the left epsilon map without an operator.
+
+    Returns sum_s H(A1[s]) x A2[s].
+
+    A2 is treated as a (q * D1, D2) block. See eps_r_noop().
+    """
+    q, D1, D2 = A1.shape
+    
+    if _use_kernels(x, A1, A2) and (out is None or _use_kernels(out)):
+        if out is None:
+            out = np.empty((D2, A2.shape[2]), dtype=np.complex128)
+        tk.eps_l(x, A1, A2, out)
+        return out
+
+    A1c = np.empty((q, D2, D1), dtype=A1.dtype)
+    np.conjugate(A1.transpose((0, 2, 1)), out=A1c)
+
+    A1x = np.dot(A1c.reshape((q * D2, D1)), np.asarray(x)) #[s, k, j]
+    A1x = A1x.reshape((q, D2, A1x.shape[1])).transpose((1, 0, 2))
+    A1x = A1x.reshape((D2, -1)) #[k, (s, j)] (copy)
+
+    return _dot_out(A1x, A2.reshape((-1, A2.shape[2])), out=out)
+
+class EOp:
+    """A matrix-free form of the transfer matrix E (the epsilon map) for use 
+    with the iterative solvers in scipy.sparse.linalg.
+    
+    Vectors are D x D matrices in raveled form. The number of calls to
+    matvec() is recorded in calls.
+    
+    If A1 and A2 are symmetric with block structure bs, the map can be 
+    applied blockwise (see symmetry.BlockStructure).
+    """
+    def __init__(self, A1, A2, left=False, dtype=None, bs=None):
+        self.A1 = A1
+        self.A2 = A2
+        self.left = left
+        self.bs = bs
+        
+        self.D = A1.shape[2] if left else A1.shape[1]
+        self.shape = (self.D**2, self.D**2)
+        if dtype is None:
+            dtype = A1.dtype
+        self.dtype = np.dtype(dtype)
+        
+        self.calls = 0
+        
+        self.out = np.empty((self.D, self.D), dtype=self.dtype)
+        
+    def matvec(self, v):
+        x = v.reshape((self.D, self.D))
+        
+        if not self.bs is None:
+            if self.left:
+                sy.eps_l_noop(x, self.A1, self.A2, self.bs, out=self.out)
+            else:
+                sy.eps_r_noop(x, self.A1, self.A2, self.bs, out=self.out)
+        elif self.left:
+            eps_l_noop(x, self.A1, self.A2, out=self.out)
+        else:
+            eps_r_noop(x, self.A1, self.A2, out=self.out)
+        
+        self.calls += 1
+        
+        return self.out.ravel().copy()
+
+def eps_r_op_1s(x, A1, A2, op, out=None):
+    """Implements the right epsilon map with a single-site operator.
+
+    Returns sum_{s, t} op[s, t] * A1[t] x H(A2[s]).
+
+    op must be an ndarray (see get_op_array()).
+    """
+    op_A1 = np.tensordot(op, A1, ((1,), (0,))) #[s, i, k]
+    op_A1x = np.tensordot(op_A1, x, ((2,), (0,))) #[s, i, m]
+    res = np.tensordot(op_A1x, A2.conj(), ((0, 2), (0, 2)))
+
+    if out is None:
+        return res
+    else:
+        out[:] = res
+        return out
+
+def eps_r_op_2s_C12_AA34(x, C12, AA34):
+    """Implements the right epsilon map for a two-site operator, given
+    C12 = calc_C_mat_op_AA(op, AA12).
+
+    Returns sum_{u, v} C12[u, v] x H(AA34[u, v]).
+    """
+    if _use_kernels(x, C12, AA34):
+        q1, q2, D1, D2 = C12.shape
+        out = np.empty((D1, AA34.shape[2]), dtype=np.complex128)
+        tk.eps_r(x, C12.reshape((q1 * q2, D1, D2)), 
+                 AA34.reshape((q1 * q2,) + AA34.shape[2:]), out)
+        return out
+    
+    C12x = np.tensordot(C12, np.asarray(x), ((3,), (0,))) #[u, v, i, m]
+
+    return np.tensordot(C12x, AA34.conj(), ((0, 1, 3), (0, 1, 3)))
+
+def eps_l_op_2s_AA12_C34(x, AA12, C34):
+    """Implements the left epsilon map for a two-site operator, given
+    C34 = calc_C_mat_op_AA(op, AA34).
+
+    Returns sum_{u, v} H(AA12[u, v]) x C34[u, v].
+    """
+    if _use_kernels(x, AA12, C34):
+        q1, q2, D1, D2 = AA12.shape
+        out = np.empty((D2, C34.shape[3]), dtype=np.complex128)
+        tk.eps_l(x, AA12.reshape((q1 * q2, D1, D2)), 
+                 C34.reshape((q1 * q2,) + C34.shape[2:]), out)
+        return out
+    
+    xC34 = np.tensordot(np.asarray(x), C34, ((1,), (2,))) #[i, u, v, m]
+    
+    return np.tensordot(AA12.conj(), xC34, ((0, 1, 2), (1, 2, 0)))
+
+def eps_r_op_2s_AA12_AA34(x, AA12, AA34, op):
+    """Implements the right epsilon map for a two-site operator.
+
+    Returns sum_{u, v, s, t} op[u, v, s, t] * AA12[s, t] x H(AA34[u, v]).
+
+    op must be an ndarray (see get_op_array()).
+    """
+    return eps_r_op_2s_C12_AA34(x, calc_C_mat_op_AA(op, AA12), AA34)
+
+def apply_op_1s(op, A):
+    """Returns newA[s] = sum_t op[s, t] * A[t].
+
+    op must be an ndarray (see get_op_array()).
+    """
+    return np.tensordot(op, A, ((1,), (0,)))
+
+def mmul_stack_right(X, M):
+    """Returns res[s] = X[s].dot(M) for a stack of matrices X.
+    
+    This is done as one matrix multiplication of the (q * D1, D2) block.
+    M may be any matrix object supported by matmul.mmul().
+    """
+    q, D1, D2 = X.shape
+    res = m.mmul(np.ascontiguousarray(X).reshape((q * D1, D2)), M)
+    
+    return res.reshape((q, D1, res.shape[1]))
+
+def mmul_stack_left(M, X):
+    """Returns res[s] = M.dot(X[s]) for a stack of matrices X.
+    
+    This is done as one matrix multiplication of the (D1, q * D2) block.
+    M may be any matrix object supported by matmul.mmul().
+    """
+    q, D1, D2 = X.shape
+    res = m.mmul(M, X.transpose((1, 0, 2)).reshape((D1, q * D2)))
+    res = res.reshape((res.shape[0], q, D2)).transpose((1, 0, 2))
+    
+    return np.ascontiguousarray(res)
+
+def calc_C_r_AH(C, r, A):
+    """Returns res[s] = sum_t C[s, t] r H(A[t]).
+    
+    This appears in the gradient, e.g. in calc_x().
+    """
+    q1, q2, D1, D2 = C.shape
+    
+    if _use_kernels(C, r, A):
+        out = np.empty((q1, D1, A.shape[1]), dtype=np.complex128)
+        tk.calc_C_r_AH(C, r, A, out)
+        return out
+    
+    Cr = mmul_stack_right(C.reshape((q1 * q2, D1, D2)), r)
+    Cr = Cr.reshape((q1, q2, D1, Cr.shape[2]))
+    
+    return np.tensordot(Cr, A.conj(), ((1, 3), (0, 2)))
+
+def calc_AH_l_C(A, l, C):
+    """Returns res[s] = sum_t H(A[t]) l C[t, s].
+    
+    This appears in the gradient, e.g. in calc_x().
+    """
+    q1, q2, D1, D2 = C.shape
+    
+    if _use_kernels(A, l, C):
+        out = np.empty((q2, A.shape[2], D2), dtype=np.complex128)
+        tk.calc_AH_l_C(A, l, C, out)
+        return out
+    
+    lC = mmul_stack_left(l, C.reshape((q1 * q2, D1, D2)))
+    lC = lC.reshape((q1, q2, lC.shape[1], D2))
+    
+    res = np.tensordot(A.conj(), lC, ((0, 1), (0, 2))) #[j, s, m]
+    
+    return np.ascontiguousarray(res.transpose((1, 0, 2)))
+
+def contract_Vsh(X, Vsh, out=None):
+    """Returns sum_s X[s].dot(Vsh[s]).
+    """
+    res = np.tensordot(X, Vsh, ((0, 2), (0, 1)))
+    
+    if out is None:
+        return res
+    else:
+        out[:] = res
+        return out
+
+def calc_B_from_x(x, Vsh, l_sqrt_i, r_sqrt_i, out=None):
+    """Returns B[s] = l_sqrt_i x H(Vsh[s]) r_sqrt_i.
+    """
+    q, D = Vsh.shape[:2]
+    
+    xV = np.tensordot(x, Vsh.conj(), ((1,), (2,))) #[i, s, k]
+    lxV = m.mmul(l_sqrt_i, xV.reshape((x.shape[0], q * D)))
+    lxV = lxV.reshape((lxV.shape[0], q, D)).transpose((1, 0, 2))
+    
+    res = mmul_stack_right(lxV, r_sqrt_i)
+    
+    if out is None:
+        return res
+    else:
+        out[:] = res
+        return out
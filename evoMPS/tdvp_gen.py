@@ -11,15 +11,16 @@ TODO:
           the Schmidt spectrum.
         - Maybe the l's could be better conditioned?
     - Build more into take_step or add a new method that does restore_RCF etc. itself.
-    - Add an algorithm for expanding the bond dimension.
-    - Adaptive step size.
     - Find a way to randomize the starting state.
 
 """
 import scipy as sp
 import scipy.linalg as la
+import scipy.sparse.linalg as las
 import nullspace as ns
 import matmul as m
+import tdvp_common as tm
+import symmetry as sy
 
 class EvoMPS_TDVP_Generic:
     odr = 'C'
@@ -34,6 +35,11 @@ class EvoMPS_TDVP_Generic:
     h_nn = None
     h_ext = None
     
+    _op_arrays = None
+    _op_arrays_src = None
+    
+    charges = None
+    
     eps = 0
     
     sanity_checks = True
@@ -76,11 +82,14 @@ class EvoMPS_TDVP_Generic:
         """
         for n in xrange(1, self.N + 1):
             self.A[n].real = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
-            self.A[n].imag = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
+            if sp.iscomplexobj(self.A[n]):
+                self.A[n].imag = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
+            if not self.charges is None:
+                self.A[n][:] = self.charges[n].project(self.A[n])
                 
         self.restore_RCF()
             
-    def __init__(self, numsites, D, q):
+    def __init__(self, numsites, D, q, dtype=sp.complex128):
         """Creates a new TDVP_MPS object.
         
         The TDVP_MPS class implements the time-dependent variational principle 
@@ -88,6 +97,13 @@ class EvoMPS_TDVP_Generic:
         a hamiltonian consisting of a nearest-neighbour interaction term and a 
         single-site term (external field).
         
+        The Hamiltonian terms h_nn and h_ext (and other operators) may be
+        given as callables h_nn(n, s, t, u, v) and h_ext(n, s, t), or as 
+        ndarrays of shape (q, q, q, q) and (q, q) respectively. Arrays with
+        an additional leading site index n are also accepted.
+        See tdvp_common.get_op_array(). Callables are converted to arrays 
+        once, and again only if h_nn or h_ext is reassigned.
+        
         Bond dimensions will be adjusted where they are too high to be useful.
         FIXME: Add reference.
         
@@ -100,25 +116,36 @@ class EvoMPS_TDVP_Generic:
         q : ndarray
             A 1-d array, also length numsites, of integers indicating the 
             dimension of the hilbert space for each site.
+        dtype : numpy dtype
+            The type of the state parameters. float64 can be used for 
+            imaginary time evolution with real Hamiltonians and complex64
+            for fast, less accurate simulations 
+            (see tdvp_common.check_dtype()). In the latter case, the l and r 
+            matrices are still computed and stored in double precision 
+            (typ_hp).
     
         Returns
         -------
         sqrt_A : ndarray
             An array of the same shape and type as A containing the matrix square root of A.        
         """
+        self.typ = tm.check_dtype(dtype)
+        self.typ_hp = tm.high_precision_dtype(self.typ)
+        
         self.eps = sp.finfo(self.typ).eps
         
         self.N = numsites
         self.D = sp.array(D)
         self.q = sp.array(q)
         
-        #Make indicies correspond to the thesis
-        self.K = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N
-        self.C = sp.empty((self.N), dtype=sp.ndarray) #Elements 1..N-1
-        self.A = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N
+        self.charges = None
         
-        self.r = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 0..N
-        self.l = sp.empty((self.N + 1), dtype=sp.ndarray)        
+        self.rk_accepted = 0
+        self.rk_rejected = 0
+        self.rk_err = 0
+        
+        self.itr_krylov = 0
+        self.trunc_err = 0
         
         if (self.D.ndim != 1) or (self.q.ndim != 1):
             raise NameError('D and q must be 1-dimensional!')
@@ -141,18 +168,111 @@ class EvoMPS_TDVP_Generic:
             if self.D[n] > qacc:
                 self.D[n] = qacc
         
-        self.r[0] = sp.zeros((self.D[0], self.D[0]), dtype=self.typ, order=self.odr)  
-        self.l[0] = sp.eye(self.D[0], self.D[0], dtype=self.typ).copy(order=self.odr) #Already set the 0th element (not a dummy)    
+        self._init_arrays()
+        self.setup_A()
+        
+    def _init_arrays(self):
+        #Make indicies correspond to the thesis
+        self.K = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N
+        self.K_l = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 0..N
+        self.C = sp.empty((self.N), dtype=sp.ndarray) #Elements 1..N-1
+        self.A = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 1..N
+        
+        self.r = sp.empty((self.N + 1), dtype=sp.ndarray) #Elements 0..N
+        self.l = sp.empty((self.N + 1), dtype=sp.ndarray)        
+        
+        self.r[0] = sp.zeros((self.D[0], self.D[0]), dtype=self.typ_hp, order=self.odr)  
+        self.l[0] = sp.eye(self.D[0], self.D[0], dtype=self.typ_hp).copy(order=self.odr) #Already set the 0th element (not a dummy)    
+        self.K_l[0] = sp.zeros((self.D[0], self.D[0]), dtype=self.typ, order=self.odr)
     
         for n in xrange(1, self.N + 1):
             self.K[n] = sp.zeros((self.D[n-1], self.D[n-1]), dtype=self.typ, order=self.odr)    
-            self.r[n] = sp.zeros((self.D[n], self.D[n]), dtype=self.typ, order=self.odr)
-            self.l[n] = sp.zeros((self.D[n], self.D[n]), dtype=self.typ, order=self.odr)
+            self.K_l[n] = sp.zeros((self.D[n], self.D[n]), dtype=self.typ, order=self.odr)
+            self.r[n] = sp.zeros((self.D[n], self.D[n]), dtype=self.typ_hp, order=self.odr)
+            self.l[n] = sp.zeros((self.D[n], self.D[n]), dtype=self.typ_hp, order=self.odr)
             self.A[n] = sp.empty((self.q[n], self.D[n-1], self.D[n]), dtype=self.typ, order=self.odr)
             if n < self.N:
                 self.C[n] = sp.empty((self.q[n], self.q[n+1], self.D[n-1], self.D[n+1]), dtype=self.typ, order=self.odr)
         sp.fill_diagonal(self.r[self.N], 1.)
-        self.setup_A()
+        
+    def set_charges(self, qn_phys, qn_virt=None, total=0, modulus=None):
+        """Restricts the state to a sector with a conserved U(1) or Z_n charge.
+        
+        The site tensors A[n] are then kept in block-sparse form (see the
+        symmetry module) and calc_l(), calc_r(), calc_C(), calc_K(), 
+        calc_Vsh(), calc_B() and restore_RCF() operate blockwise, which 
+        reduces the cost of each contraction by about the number of charge
+        sectors. eps_r() and eps_l() remain dense unless blocks=True is 
+        passed, since their argument may carry charge. The Hamiltonian 
+        terms h_nn and h_ext must conserve the charge.
+        
+        The state is replaced by a random state with the given charges.
+        The bond dimensions D may be reduced, where they are larger than 
+        the charges allow.
+        
+        Parameters
+        ----------
+        qn_phys : ndarray or sequence of ndarray
+            The integer charges of the physical basis states. Either a 
+            single array, used for all sites, or a sequence with one array
+            for each site 1..N (element 0 is ignored).
+        qn_virt : sequence of ndarray
+            The charges for the virtual indices of bonds 0..N, with
+            qn_virt[n] of length D[n]. Bond n carries the total charge of
+            sites 1..n. If None, these are chosen using 
+            symmetry.bond_charges().
+        total : int
+            The total charge of the state, used if qn_virt is None.
+        modulus : int
+            For a Z_n charge, n. The charges are then added modulo n. If 
+            None, the charge is a U(1) charge.
+        """
+        if sp.ndim(qn_phys[-1]) == 0:
+            qn_phys = [qn_phys] * (self.N + 1)
+        
+        if qn_virt is None:
+            qn_virt = sy.bond_charges(qn_phys, self.D, total=total, 
+                                      modulus=modulus)
+            
+        ci = [sy.ChargeIndex(qn_virt[n], modulus=modulus) 
+              for n in xrange(self.N + 1)]
+        
+        D = sp.array([c.dim for c in ci])
+        if not sp.all(D == self.D):
+            self.D = D
+            self._init_arrays()
+        
+        self.charges = sp.empty((self.N + 1), dtype=object) #Elements 1..N
+        for n in xrange(1, self.N + 1):
+            if len(qn_phys[n]) != self.q[n]:
+                raise ValueError("qn_phys[%u] has the wrong length!" % n)
+            self.charges[n] = sy.BlockStructure(qn_phys[n], ci[n - 1], ci[n])
+            
+        self.randomize()
+        
+    def set_parity(self, par_phys, par_virt=None, total=0):
+        """Restricts the state to a sector with a conserved Z_2 parity.
+        
+        This is set_charges() with modulus 2. Each A[n] then consists of 
+        two blocks for each physical basis state, so that the contractions
+        cost about half as much as for a generic state.
+        
+        The parity must be diagonal in the physical basis. For the 
+        transverse Ising model with -J sigma_x sigma_x - h sigma_z, for 
+        example, the basis states of sigma_z have parities [0, 1].
+        
+        Parameters
+        ----------
+        par_phys : ndarray or sequence of ndarray
+            The parities (0 or 1) of the physical basis states, as for 
+            qn_phys in set_charges().
+        par_virt : sequence of ndarray
+            The parities for the virtual indices of bonds 0..N. If None, 
+            these are chosen automatically.
+        total : int
+            The total parity of the state, used if par_virt is None.
+        """
+        self.set_charges(par_phys, qn_virt=par_virt, total=total, modulus=2)
     
     def calc_C(self, n_low=-1, n_high=-1):
         """Generates the C matrices used to calculate the K's and ultimately the B's
@@ -174,16 +294,19 @@ class EvoMPS_TDVP_Generic:
         if n_high < 1:
             n_high = self.N
         
+        h_nn_arr = self._get_op_arrays()[0]
+        
         for n in xrange(n_low, n_high):
-            self.C[n].fill(0)
-            for u in xrange(self.q[n]):
-                for v in xrange(self.q[n + 1]):
-                    AA = m.mmul(self.A[n][u], self.A[n + 1][v]) #only do this once for each 
-                    for s in xrange(self.q[n]):
-                        for t in xrange(self.q[n + 1]):                
-                            h_nn_stuv = self.h_nn(n, s, t, u, v)
-                            if h_nn_stuv != 0:
-                                self.C[n][s, t] += h_nn_stuv * AA
+            h_nn = h_nn_arr[n]
+            if self.charges is None:
+                AA = tm.calc_AA(self.A[n], self.A[n + 1])
+                self.C[n][:] = tm.calc_C_mat_op_AA(h_nn, AA)
+            else:
+                bs1, bs2 = self.charges[n], self.charges[n + 1]
+                sy.check_op(h_nn, [bs1.qn_phys, bs2.qn_phys], 
+                            modulus=bs1.modulus)
+                AA = sy.calc_AA(self.A[n], self.A[n + 1], bs1, bs2)
+                sy.calc_C_mat_op_AA(h_nn, AA, bs1, bs2, out=self.C[n])
     
     def calc_K(self, n_low=-1, n_high=-1):
         """Generates the K matrices used to calculate the B's
@@ -207,10 +330,14 @@ class EvoMPS_TDVP_Generic:
         if n_high < 1:
             n_high = self.N + 1
             
+        h_ext = self._get_op_arrays()[1]
+            
         for n in reversed(xrange(n_low, n_high)):
             self.K[n].fill(0)
-
-            if n < self.N:
+            
+            if not self.charges is None:
+                self._calc_K_sym(n)
+            elif n < self.N:
                 for s in xrange(self.q[n]): 
                     for t in xrange(self.q[n+1]):
                         self.K[n] += m.mmul(self.C[n][s, t],
@@ -219,13 +346,67 @@ class EvoMPS_TDVP_Generic:
                     self.K[n] += m.mmul(self.A[n][s], self.K[n + 1], 
                                           m.H(self.A[n][s]))
             
+            if not self.h_ext is None and self.charges is None:
+                self.K[n] += self.eps_r(n, self.r[n], o=h_ext[n])
+                
+    def calc_K_l(self, n_low=-1, n_high=-1):
+        """Generates the K_l matrices, the left-hand counterparts of the K's.
+        
+        K_l[n] contains the Hamiltonian terms acting only on sites 1..n. It 
+        depends on C[m] and A[m] for all m <= n.
+        
+        It directly depends on A[n - 1], A[n], l[n - 2], l[n - 1], C[n - 1] 
+        and K_l[n - 1].
+        
+        These are only needed by take_step_split(), which computes them
+        itself.
+        """
+        if n_low < 1:
+            n_low = 1
+        if n_high < 1:
+            n_high = self.N + 1
+            
+        for n in xrange(n_low, n_high):
+            K_l = tm.eps_l_noop(self.K_l[n - 1], self.A[n], self.A[n])
+            
+            if n > 1 and not self.h_nn is None:
+                X = tm.calc_AH_l_C(self.A[n - 1], self.l[n - 2], self.C[n - 1])
+                K_l += sp.tensordot(self.A[n].conj(), X, ((0, 1), (0, 1)))
+                
             if not self.h_ext is None:
-                for s in xrange(self.q[n]):
-                    for t in xrange(self.q[n]):
-                        h_ext_st = self.h_ext(n, s, t)
-                        if h_ext_st != 0:
-                            self.K[n] += h_ext_st * m.mmul(self.A[n][t], 
-                                                    self.r[n], m.H(self.A[n][s]))
+                K_l += tm.eps_l_noop(self.l[n - 1], self.A[n], 
+                                     self._get_h_ext_A(n))
+                
+            self.K_l[n] = sp.asarray(K_l, dtype=self.typ)
+                
+    def _get_h_ext_A(self, n):
+        """Returns sum_t h_ext[s, t] A[n][t], checking that h_ext conserves
+        the charge if the state is symmetric.
+        """
+        h_ext = self._get_op_arrays()[1][n]
+        if not self.charges is None:
+            sy.check_op(h_ext, [self.charges[n].qn_phys], 
+                        modulus=self.charges[n].modulus)
+            
+        return tm.apply_op_1s(h_ext, self.A[n])
+                
+    def _calc_K_sym(self, n):
+        """Computes K[n] blockwise for a symmetric state (see calc_K()).
+        
+        K[n] = sum_s X[s] H(A[n][s]), with 
+        X[s] = sum_t C[n][s, t] r[n + 1] H(A[n + 1][t]) + A[n][s] K[n + 1].
+        """
+        bs = self.charges[n]
+        
+        if n < self.N:
+            X = sy.calc_C_r_AH(self.C[n], self.r[n + 1], self.A[n + 1], bs, 
+                               self.charges[n + 1])
+            X += sy.mmul_stack_right(self.A[n], self.K[n + 1], bs)
+            self.K[n] += sy.eps_r_noop(None, X, self.A[n], bs)
+        
+        if not self.h_ext is None:
+            self.K[n] += sy.eps_r_noop(self.r[n], self._get_h_ext_A(n), 
+                                       self.A[n], bs)
     
     def update(self):
         self.calc_l()
@@ -246,23 +427,17 @@ class EvoMPS_TDVP_Generic:
         
         We return the conjugate m.H(V) because we use it in more places than V.
         """
-        R = sp.zeros((self.D[n], self.q[n], self.D[n-1]), dtype=self.typ, order='C')
+        if self.charges is None:
+            Vsh = ns.calc_Vsh(self.A[n], sqrt_r)
+        else:
+            Vsh = sy.calc_Vsh(self.A[n], sqrt_r, self.charges[n])
         
-        for s in xrange(self.q[n]):
-            R[:,s,:] = m.mmul(sqrt_r, m.H(self.A[n][s]))
-
-        R = R.reshape((self.q[n] * self.D[n], self.D[n-1]))
-        V = m.H(ns.nullspace(m.H(R)))
-        #print (q[n]*D[n] - D[n-1], q[n]*D[n])
-        #print V.shape
-        #print sp.allclose(mat(V) * mat(V).H, sp.eye(q[n]*D[n] - D[n-1]))
-        #print sp.allclose(mat(V) * mat(Rh).H, 0)
-        V = V.reshape((self.q[n] * self.D[n] - self.D[n - 1], self.D[n], self.q[n])) #this works with the above form for R
-        
-        #prepare for using V[s] and already take the adjoint, since we use it more often
-        Vsh = sp.empty((self.q[n], self.D[n], self.q[n] * self.D[n] - self.D[n - 1]), dtype=self.typ, order=self.odr)
-        for s in xrange(self.q[n]):
-            Vsh[s] = m.H(V[:,:,s])
+        if self.sanity_checks:
+            M = sp.zeros((Vsh.shape[2], self.D[n - 1]), dtype=self.typ)
+            for s in xrange(self.q[n]):
+                M += m.mmul(m.H(Vsh[s]), sqrt_r, m.H(self.A[n][s]))
+            if not sp.allclose(M, 0):
+                print "Sanity Fail in calc_Vsh!: Bad Vsh_%u" % (n)
         
         return Vsh
         
@@ -286,43 +461,59 @@ class EvoMPS_TDVP_Generic:
             - K[n + 1]
             - V[n]
         """
+        if not self.charges is None:
+            return self._calc_x_sym(n, Vsh, sqrt_l, sqrt_r, sqrt_l_inv, 
+                                    sqrt_r_inv)
+        
         x = sp.zeros((self.D[n - 1], self.q[n] * self.D[n] - self.D[n - 1]), dtype=self.typ, order=self.odr)
-        x_part = sp.empty_like(x)
-        x_subpart = sp.empty_like(self.A[n][0])
-        x_subsubpart = sp.empty_like(self.A[n][0])
         
-        x_part.fill(0)
-        for s in xrange(self.q[n]):
-            x_subpart.fill(0)    
-            
-            if n < self.N:
-                x_subsubpart.fill(0)
-                for t in xrange(self.q[n + 1]):
-                    x_subsubpart += m.mmul(self.C[n][s,t], self.r[n + 1], m.H(self.A[n + 1][t])) #~1st line
-                    
-                x_subsubpart += m.mmul(self.A[n][s], self.K[n + 1]) #~3rd line               
-                
-                x_subpart += m.mmul(x_subsubpart, sqrt_r_inv)
+        X = sp.zeros_like(self.A[n])
+        
+        if n < self.N:
+            X += tm.calc_C_r_AH(self.C[n], self.r[n + 1], self.A[n + 1]) #~1st line
+            X += tm.mmul_stack_right(self.A[n], self.K[n + 1]) #~3rd line
+            X = tm.mmul_stack_right(X, sqrt_r_inv)
+        
+        if not self.h_ext is None: #Extra term to take care of h_ext..
+            h_ext_A = tm.apply_op_1s(self._get_op_arrays()[1][n], self.A[n])
+            X += tm.mmul_stack_right(h_ext_A, sqrt_r) #it may be more effecient to squeeze this into the nn term...
             
-            if not self.h_ext is None:
-                x_subsubpart.fill(0)
-                for t in xrange(self.q[n]):                         #Extra term to take care of h_ext..
-                    x_subsubpart += self.h_ext(n, s, t) * self.A[n][t] #it may be more effecient to squeeze this into the nn term...
-                x_subpart += m.mmul(x_subsubpart, sqrt_r)
+        x += m.mmul(sqrt_l, tm.contract_Vsh(X, Vsh))
             
-            x_part += m.mmul(x_subpart, Vsh[s])
+        if n > 1: #~2nd line
+            X = tm.calc_AH_l_C(self.A[n - 1], self.l[n - 2], self.C[n - 1])
+            X = tm.mmul_stack_right(X, sqrt_r)
+            x += m.mmul(sqrt_l_inv, tm.contract_Vsh(X, Vsh))
                 
-        x += m.mmul(sqrt_l, x_part)
+        return x
+        
+    def _calc_x_sym(self, n, Vsh, sqrt_l, sqrt_r, sqrt_l_inv, sqrt_r_inv):
+        """Computes x blockwise for a symmetric state (see calc_x()).
+        
+        The columns of x are given by charges[n].vsh_index().
+        """
+        bs = self.charges[n]
+        
+        X = sp.zeros_like(self.A[n])
+        
+        if n < self.N:
+            X += sy.calc_C_r_AH(self.C[n], self.r[n + 1], self.A[n + 1], bs,
+                                self.charges[n + 1])
+            X += sy.mmul_stack_right(self.A[n], self.K[n + 1], bs)
+            X = sy.mmul_stack_right(X, sqrt_r_inv, bs)
+        
+        if not self.h_ext is None:
+            X += sy.mmul_stack_right(self._get_h_ext_A(n), sqrt_r, bs)
             
+        x = sy.contract_Vsh(sy.mmul_stack_left(sqrt_l, X, bs), Vsh, bs)
+        
         if n > 1:
-            x_part.fill(0)
-            for s in xrange(self.q[n]):     #~2nd line
-                x_subsubpart.fill(0)
-                for t in xrange(self.q[n + 1]):
-                    x_subsubpart += m.mmul(m.H(self.A[n - 1][t]), self.l[n - 2], self.C[n - 1][t, s])
-                x_part += m.mmul(x_subsubpart, sqrt_r, Vsh[s])
-            x += m.mmul(sqrt_l_inv, x_part)
-                
+            X = sy.calc_AH_l_C(self.A[n - 1], self.l[n - 2], self.C[n - 1],
+                               self.charges[n - 1], bs)
+            X = sy.mmul_stack_right(X, sqrt_r, bs)
+            x += sy.contract_Vsh(sy.mmul_stack_left(sqrt_l_inv, X, bs), Vsh,
+                                 bs)
+        
         return x
         
     def calc_B(self, n):
@@ -333,19 +524,29 @@ class EvoMPS_TDVP_Generic:
         with x* the parameter matrices satisfying the Euler-Lagrange equations
         as closely as possible.
         """
-        if self.q[n] * self.D[n] - self.D[n - 1] > 0:
+        if self.charges is None:
+            nV = self.q[n] * self.D[n] - self.D[n - 1]
+        else:
+            nV = self.charges[n].vsh_index().dim
+        
+        if nV > 0:
             l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv = self.calc_l_r_roots(n)
             
             Vsh = self.calc_Vsh(n, r_sqrt)
             
             x = self.calc_x(n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv)
     
-            B = sp.empty_like(self.A[n])
-            for s in xrange(self.q[n]):
-                B[s] = m.mmul(l_sqrt_inv, x, m.H(Vsh[s]), r_sqrt_inv)
-            return B
+            return self._calc_B_from_x(n, x, Vsh, l_sqrt_inv, r_sqrt_inv)
         else:
             return None
+            
+    def _calc_B_from_x(self, n, x, Vsh, l_sqrt_inv, r_sqrt_inv):
+        if self.charges is None:
+            B = tm.calc_B_from_x(x, Vsh, l_sqrt_inv, r_sqrt_inv)
+        else:
+            B = sy.calc_B_from_x(x, Vsh, l_sqrt_inv, r_sqrt_inv, 
+                                 self.charges[n])
+        return sp.asarray(B, dtype=self.typ)
         
     def calc_l_r_roots(self, n):
         """Returns the matrix square roots (and inverses) needed to calculate B.
@@ -353,7 +554,18 @@ class EvoMPS_TDVP_Generic:
         Hermiticity of l[n] and r[n] is used to speed this up.
         If an exception occurs here, it is probably because these matrices
         are not longer Hermitian (enough).
+        
+        For a symmetric state, this is done blockwise.
         """
+        if not self.charges is None:
+            ci_l = self.charges[n].left
+            ci_r = self.charges[n].right
+            
+            l_sqrt, l_sqrt_inv = sy.sqrtmh_inv(self.l[n - 1], ci_l)
+            r_sqrt, r_sqrt_inv = sy.sqrtmh_inv(self.r[n], ci_r)
+            
+            return l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv
+        
         l_sqrt, evd = m.sqrtmh(self.l[n - 1], ret_evd=True)
         l_sqrt_inv = m.invmh(l_sqrt, evd=evd)
 
@@ -380,6 +592,8 @@ class EvoMPS_TDVP_Generic:
         dtau : complex
             The (imaginary or real) amount of imaginary time (tau) to step.
         """
+        dtau = tm.get_dtau(dtau, self.typ)
+        
         B_prev = None
         for n in xrange(1, self.N + 2):
             #V is not always defined (e.g. at the right boundary vector, and possibly before)
@@ -391,221 +605,164 @@ class EvoMPS_TDVP_Generic:
                 
             B_prev = B
 
-    def take_step_implicit(self, dtau, midpoint=True):
+    def take_step_implicit(self, dtau, midpoint=True, tol=1E-10, max_itr=20):
         """A backward (implicit) integration step.
         
         Based on p. 8-10 of arXiv:1103.0936v2 [cond-mat.str-el].
         
-        NOTE: Not currently working as well as expected. Iterative solution of 
-              implicit equation stops converging at some point...
-        
-        This is made trickier by the gauge freedom. We solve the implicit equation iteratively, aligning the tangent
-        vectors along the gauge orbits for each step to obtain the physically relevant difference dA. The gauge-alignment is done
-        by solving a matrix equation.
-        
-        The iteration seems to be difficult. At the moment, iteration over the whole chain is combined with iteration over a single
-        site (a single A[n]). Iteration over the chain is needed because the evolution of a single site depends on the state of the
-        whole chain. The algorithm runs through the chain from N to 1, iterating a few times over each site (depending on how many
-        chain iterations we have done, since iterating over a single site becomes more fruitful as the rest of the chain stabilizes).
-        
-        In running_update mode, which is likely the most sensible choice, the current midpoint guess is updated after visiting each
-        site. I.e. The trial backwards step at site n is based on the updates that were made to site n + 1, n + 2 during the current chain
-        iteration.
+        Rather than solving the implicit equation for the whole chain at once,
+        which requires many iterations over the chain to converge, the 
+        evolution equation is split into the contributions of the individual 
+        sites, with dA[n]/dtau = -B[n] evolving only A[n]. These are 
+        integrated one site at a time, in a sweep from site 1 to N followed
+        by a sweep from N to 1, each site taking half a step per sweep. This
+        symmetric ordering makes the step second order in dtau. 
+        
+        With midpoint=True, each of these single-site steps uses the implicit 
+        midpoint rule, making the whole step time-symmetric. For real time 
+        evolution, the single-site steps are then unitary in the coordinates
+        of the tangent space, so that the energy is well conserved even for 
+        large steps. With midpoint=False, backward-Euler steps are used 
+        instead.
+        
+        The single-site implicit equations are solved by _solve_implicit_n(),
+        which must be iterated since B[n] depends nonlinearly on A[n]. After
+        each site update, only the quantities depending directly on A[n] and 
+        needed for the remainder of the sweep are recomputed (l[n] and C for 
+        the first sweep, r[n - 1], C and K[n] for the second), so that the 
+        cost of a step is linear in N.
+        
+        As for take_step_RK4(), update() should be called before each step.
         
         Parameters
         ----------
         dtau : complex
             The (imaginary or real) amount of imaginary time (tau) to step.
         midpoint : bool
-            Whether to use approximately time-symmetric midpoint integration,
-            or just a backward-Euler step.
-        """        
-        #---------------------------
-        #Hard-coded params:
-        debug = True
-        dbg_bstep = False
-        safe_mode = True
-        
-        tol = sp.finfo(sp.complex128).eps * 3
-        max_iter = 10
-        itr_switch_mode = 10
-        #---------------------------
+            Whether to use the (time-symmetric) implicit midpoint rule, 
+            or backward-Euler steps.
+        tol : float
+            Tolerance for the change in A[n] (in the norm of the tangent 
+            space) in the final iteration of each single-site solution.
+        max_itr : int
+            The maximum number of iterations per single-site solution.
+            
+        Returns
+        -------
+        itr : int
+            The largest number of iterations needed for a single site.
+        delta : float
+            The largest change in A[n] during a final iteration. If this is 
+            larger than tol, max_itr was not sufficient.
+        """
+        dtau = tm.get_dtau(dtau, self.typ) / 2 #Each sweep takes half a step
         
         if midpoint:
-            dtau = dtau / 2
-        
-        self.restore_RCF()
-
-        #Take a copy of the current state
-        A0 = sp.empty_like(self.A)
-        for n in xrange(1, self.N + 1):
-            A0[n] = self.A[n].copy()
+            dtau_n = dtau / 2
+        else:
+            dtau_n = dtau
         
-        #Take initial forward-Euler step
-        self.take_step(dtau)     
-
         itr = 0
-        delta = 1
-        delta_prev = 0                
-        final_check = False
-
-        while delta > tol * (self.N - 1) and itr < max_iter or final_check:
-            print "OUTER"
-            running_update = itr < itr_switch_mode
-            
-            A_np1 = A0[self.N]            
-            
-            #Prepare for next calculation of B from the new A
-            self.restore_RCF() #updates l and r
-            
-            if running_update:
-                self.calc_C() #we really do need all of these, since B directly uses C[n-1]
-                self.calc_K()            
-            
-            g0_n = sp.eye(self.D[self.N - 1], dtype=self.typ)       #g0_n is the gauge transform matrix needed to solve the implicit equation
-            
-            #Loop through the chain, optimizing the individual A's
-            delta = 0
-            for n in reversed(xrange(1, self.N)): #We start at N - 1, since the right vector can't be altered here.
-                print "SWEEP"
-                if not running_update: #save new A[n + 1] and replace with old version for building B
-                    A_np1_new = self.A[n + 1].copy()
-                    self.A[n + 1] = A_np1  
-                    A_np1 = self.A[n].copy()
-                    max_itr_n = 1 #wait until the next run-through of the chain to change A[n] again
-                else:
-                    max_itr_n = itr + 1 #do more iterations here as the outer loop progresses
+        delta = 0
+        for forward in (True, False):
+            if forward:
+                sites = xrange(1, self.N + 1)
+            else:
+                sites = reversed(xrange(1, self.N + 1))
                 
-                delta_n = 1
-                itr_n = 0
-                while True:
-                    print "INNER"
-                    #Find transformation to gauge-align A0 with the backwards-obtained A.. is this enough?
-                    M = m.mmul(A0[n][0], g0_n, self.r[n], m.H(self.A[n][0]))
-                    for s in xrange(1, self.q[n]):
-                        M += m.mmul(A0[n][s], g0_n, self.r[n], m.H(self.A[n][s]))
-                    
-                    g0_nm1 = la.solve(self.r[n - 1], M, sym_pos=True, overwrite_b=True)
-                    
-                    if not (delta_n > tol and itr_n < max_itr_n):
+            for n in sites:
+                A0_n = self.A[n]
+                
+                for i in xrange(max_itr):
+                    A_n = self._solve_implicit_n(n, A0_n, dtau_n)
+                    if A_n is None:
                         break
                     
-                    B = self.calc_B(n)
+                    dA = A_n - self.A[n]
+                    delta_n = abs(m.adot(self.l[n - 1], 
+                                         tm.eps_r_noop(self.r[n], dA, dA)))**0.5
+                    self.A[n] = A_n
                     
-                    if B is None:
-                        delta_n = 0
-                        fnorm = 0
+                    if delta_n < tol:
                         break
                     
-                    g0_nm1_inv = la.inv(g0_nm1) #sadly, we need the inverse too...    
-                    r_dA = sp.zeros_like(self.r[n - 1])
-                    dA = sp.empty_like(self.A[n])
-                    sqsum = 0
-                    for s in xrange(self.q[n]):
-                        dA[s] = m.mmul(g0_nm1_inv, A0[n][s], g0_n)
-                        dA[s] -= self.A[n][s] 
-                        dA[s] -= dtau * B[s]
-                        if not final_check:
-                            self.A[n][s] += dA[s]
-    
-                    for s in xrange(self.q[n]):
-                        r_dA += m.mmul(dA[s], self.r[n], m.H(dA[s]))
-                        sqsum += sum(dA[s]**2)
-                    
-                    fnorm = sp.sqrt(sqsum)
+                if A_n is None:
+                    continue
                     
-                    delta_n = sp.sqrt(sp.trace(m.mmul(self.l[n - 1], r_dA)))
-                    
-                    if running_update: #Since we want to use the current A[n] and A[n + 1], we need this:
-                        if safe_mode:
-                            self.restore_RCF()
-                            self.calc_C()
-                            self.calc_K()
-                        else:
-                            self.restore_RCF(start=n) #will also renormalize
-                            self.calc_C(n_low=n-1, n_high=n)
-                            self.calc_K(n_low=n, n_high=n+1)
-                                        
-                    itr_n += 1
-                    
-                    if final_check:
-                        break
-                    
-                if not running_update: #save new A[n + 1] and replace with old version for building B
-                    self.A[n + 1] = A_np1_new
+                itr = max(itr, i + 1)
+                delta = max(delta, delta_n)
                 
-                if debug:
-                    print "delta_%d: %g, (%d iterations)" % (n, delta_n.real, itr_n) + ", fnorm = " + str(fnorm)
-                delta += delta_n
+                if midpoint:
+                    self.A[n] = 2 * A_n - A0_n
                 
-                if safe_mode:
-                    self.calc_r()
+                #Update what depends on A[n] for the remainder of the sweep
+                self.calc_C(n_low=n - 1, n_high=min(n + 1, self.N))
+                if forward:
+                    self.calc_l(n, n)
                 else:
-                    self.calc_r(n - 2, n - 1) #We only need these for the next step.
-                
-                g0_n = g0_nm1                
-                            
-            itr += 1
-            if debug:
-                print "delta: %g  delta delta: %g (%d iterations)" % (delta.real, (delta - delta_prev).real, itr)
-            delta_prev = delta
-            
-            if debug:
-                if final_check:
-                    break
-                elif delta <= tol * (self.N - 1) or itr >= max_iter:
-                    print "Final check to get final delta:"
-                    final_check = True
-        
-        #Test backward step!        
-        if dbg_bstep:
-            Anew = sp.empty_like(self.A)
-            for n in xrange(1, self.N + 1):
-                Anew[n] = self.A[n].copy()
+                    self.calc_r(n - 1, n - 1)
+                    self.calc_K(n_low=n, n_high=n + 1)
             
-#            self.calc_l()
-#            self.simple_renorm()
-#            self.restore_RCF()
-            self.calc_C()
-            self.calc_K()        
-            self.take_step(-dtau)
-            self.restore_RCF()
-            
-            delta2 = 0            
-            for n in reversed(xrange(1, self.N + 1)):
-                #print n
-                dA = A0[n] - self.A[n]
-                #Surely this dA should also preserve the gauge choice, since both A's are in ON_R...                
-                #print dA/A0[n]
-                r_dA = sp.zeros_like(self.r[n - 1])
-                sqsum = 0
-                for s in xrange(self.q[n]):
-                    r_dA += m.mmul(dA[s], self.r[n], m.H(dA[s]))
-                    sqsum += sum(dA[s]**2)
-                delta_n = sp.sqrt(sp.trace(m.mmul(self.l[n - 1], r_dA)))                
-                delta2 += delta_n
-                if debug:
-                    print "A[%d] OK?: " % n + str(sp.allclose(dA, 0)) + ", delta = " + str(delta_n) + ", fnorm = " + str(sp.sqrt(sqsum))
-                #print delta_n
-            if debug:
-                print "Total delta: " + str(delta2)
-                
-            for n in xrange(1, self.N + 1):
-                self.A[n] = Anew[n]
+        return itr, delta
+        
+    def _solve_implicit_n(self, n, A0_n, dtau):
+        """Solves A[n] = A0_n - dtau * B[n] for A[n], with the other sites 
+        fixed. Returns None if B[n] is always zero.
+        
+        Vsh is computed from the current A[n] and kept fixed, so that B[n] 
+        = l^(-1/2) x Vsh^dagger r^(-1/2), with x = x(A[n]) linear in A[n]
+        (see calc_x()). Writing A[n] = A0_n - dtau * B[n](y), we solve 
+        
+            y + dtau * x(B[n](y)) = x(A0_n)
+        
+        for y using GMRES. The operator x(B[n](y)) is the effective 
+        Hamiltonian for site n in the (orthonormal) coordinates of the 
+        tangent space. Since Vsh depends on A[n], the result is only exact
+        once it agrees with the current A[n], so that this must be iterated.
+        
+        The current A[n] and the C's are left unchanged.
+        """
+        if self.charges is None:
+            nV = self.q[n] * self.D[n] - self.D[n - 1]
         else:
-            delta2 = 0
+            nV = self.charges[n].vsh_index().dim
             
-        if midpoint:
-            #Take a final step from the midpoint
-            #self.restore_RCF() #updates l and r            
-            self.calc_l()
-            self.simple_renorm()
-            self.calc_C()
-            self.calc_K()
-            self.take_step(dtau)
+        if nV <= 0:
+            return None
+            
+        l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv = self.calc_l_r_roots(n)
+        Vsh = self.calc_Vsh(n, r_sqrt)
+        
+        A_n = self.A[n]
+        
+        def calc_x(A):
+            self.A[n] = A
+            self.calc_C(n_low=n - 1, n_high=min(n + 1, self.N))
+            return self.calc_x(n, Vsh, l_sqrt, r_sqrt, l_sqrt_inv, r_sqrt_inv)
             
-        return itr, delta, delta2
+        def calc_B(y):
+            return self._calc_B_from_x(n, y, Vsh, l_sqrt_inv, r_sqrt_inv)
+        
+        x0 = calc_x(A0_n)
+        shp = x0.shape
+        
+        def matvec(y):
+            y = y.reshape(shp)
+            return (y + dtau * calc_x(calc_B(y))).ravel()
         
+        op = las.LinearOperator((x0.size, x0.size), matvec=matvec, 
+                                dtype=self.typ)
+        
+        y, info = las.gmres(op, x0.ravel(), 
+                            tol=tm.default_tolerances(self.typ)[0])
+        if info > 0:
+            print "Warning: Did not converge on solution for site %u!" % n
+            
+        self.A[n] = A_n
+        self.calc_C(n_low=n - 1, n_high=min(n + 1, self.N))
+        
+        return A0_n - dtau * calc_B(y.reshape(shp))
+
     def take_step_RK4(self, dtau):
         """Take a step using the fourth-order explicit Runge-Kutta method.
         
@@ -617,6 +774,8 @@ class EvoMPS_TDVP_Generic:
         """
         #self.restore_RCF()
         
+        dtau = tm.get_dtau(dtau, self.typ)
+        
         #Take a copy of the current state
         A0 = sp.empty_like(self.A)
         for n in xrange(1, self.N):
@@ -683,6 +842,469 @@ class EvoMPS_TDVP_Generic:
         for n in xrange(1, self.N):
             if not B_fin[n] is None:
                 self.A[n] = A0[n] - dtau /6 * B_fin[n]
+                
+    def take_step_adaptive(self, dtau, tol=1E-8, method='BS23', 
+                           max_rejects=10):
+        """Takes a step using an embedded Runge-Kutta method with step size
+        control.
+        
+        Two solutions of different order are computed from the same stages
+        and their difference is used as an estimate of the local error, 
+        measured in the norm of the tangent space (given by the l and r 
+        matrices) and summed over all sites. If the error exceeds tol, the 
+        step is rejected and retried with a smaller dtau. A step size for 
+        the next step is then proposed based on the error, so that dtau 
+        grows where the evolution is slow.
+        
+        As for take_step_RK4(), update() should be called before each step.
+        Accepted and rejected steps are counted in rk_accepted and 
+        rk_rejected. The error estimate for the last step is stored in 
+        rk_err.
+        
+        Parameters
+        ----------
+        dtau : complex
+            The (imaginary or real) amount of imaginary time (tau) to try
+            to step. Usually, this is dtau_next from the previous step.
+        tol : float
+            The tolerance for the local error of each step.
+        method : str
+            The embedded method. Either 'BS23' (Bogacki-Shampine 3(2), four
+            stages) or 'DP54' (Dormand-Prince 5(4), seven stages). See 
+            tdvp_common.rk_tableaux.
+        max_rejects : int
+            The maximum number of times the step is retried. The last try
+            is accepted regardless of the error.
+            
+        Returns
+        -------
+        dtau_taken : complex
+            The step size actually used.
+        dtau_next : complex
+            The proposed step size for the next step.
+        """
+        def calc_Bs():
+            #All B's must be computed before any A is changed.
+            return [None] + [self.calc_B(n) for n in xrange(1, self.N + 1)]
+        
+        def restore(A):
+            for n in xrange(1, self.N + 1):
+                self.A[n] = A[n]
+            self.calc_l()
+            self.calc_r()
+            self.calc_C()
+            self.calc_K()
+            
+        l0 = [sp.array(self.l[n]) for n in xrange(self.N + 1)]
+        r0 = [sp.array(self.r[n]) for n in xrange(self.N + 1)]
+        
+        def tangent_norm(dA):
+            res = 0
+            for n in xrange(1, self.N + 1):
+                res += abs(m.adot(l0[n - 1], 
+                                  tm.eps_r_noop(r0[n], dA[n], dA[n])))
+            return sp.sqrt(res)
+        
+        dtau = tm.get_dtau(dtau, self.typ)
+        
+        A0 = [None] + [self.A[n].copy() for n in xrange(1, self.N + 1)]
+        
+        A, dtau, dtau_next, self.rk_err, rejects = tm.rk_adaptive_step(
+            A0, dtau, calc_Bs(), calc_Bs, restore, tangent_norm, tol, 
+            method=method, max_rejects=max_rejects)
+            
+        for n in xrange(1, self.N + 1):
+            self.A[n] = A[n]
+        self.rk_accepted += 1
+        self.rk_rejected += rejects
+        
+        return dtau, dtau_next
+            
+    def take_step_split(self, dtau, tol=1E-12, max_itr=30):
+        """Takes a step using the projector-splitting integrator.
+        
+        See arXiv:1408.5056 [quant-ph]. Rather than evolving all sites at 
+        once using calc_B(), the sites are evolved one at a time, with the
+        state in mixed canonical form around the current site n: A[m] is 
+        left-orthonormal for m < n and right-orthonormal for m > n, so that
+        l[n - 1] = r[n] = 1. The site tensor AC = A[n] is evolved using the
+        exponential of the effective Hamiltonian for site n. The centre is
+        then moved to the next site using a QR decomposition, with the 
+        bond matrix evolved backwards in time using the effective 
+        Hamiltonian for the bond. A sweep from site 1 to N, followed by one
+        from N to 1, each with dtau / 2, make up a symmetric, second-order 
+        step.
+        
+        The exponentials are computed with tdvp_common.expmv_lanczos() 
+        using matrix-free effective Hamiltonians (see _apply_H_AC() and 
+        _apply_H_C()). For real time evolution, each of these is unitary, so 
+        that the step preserves the norm and the energy and is stable for 
+        any dtau. The environments K_l (see calc_K_l()) and K are updated 
+        site by site during the sweeps, so that no global recomputation is 
+        needed.
+        
+        As for take_step_RK4(), update() should be called before each step,
+        to bring the state into right canonical form and compute the K's.
+        The total number of matrix-vector products used is stored in 
+        itr_krylov.
+        
+        Parameters
+        ----------
+        dtau : complex
+            The (imaginary or real) amount of imaginary time (tau) to step.
+        tol : float
+            Tolerance for the Krylov approximations of the exponentials.
+        max_itr : int
+            The maximum dimension of the Krylov subspaces.
+        """
+        dtau = tm.get_dtau(dtau, self.typ) / 2
+        
+        self.itr_krylov = 0
+        
+        ops = self._get_op_arrays()
+        
+        def expm(f, x, t):
+            res, itr = tm.expmv_lanczos(f, x, t, tol=tol, max_itr=max_itr)
+            self.itr_krylov += itr
+            return res
+        
+        AC = self.A[1]
+        
+        for n in xrange(1, self.N + 1):
+            AC = expm(lambda x: self._apply_H_AC(n, x, ops), AC, -dtau)
+            
+            if n == self.N:
+                self.A[n] = AC
+                break
+            
+            Q, R = la.qr(AC.reshape((self.q[n] * self.D[n - 1], self.D[n])),
+                         mode='economic')
+            self.A[n] = self._project(n, Q.reshape(AC.shape))
+            self.l[n] = sp.eye(self.D[n], dtype=self.typ_hp)
+            
+            self.calc_C(n_low=n - 1, n_high=n)
+            self.calc_K_l(n_low=n, n_high=n + 1)
+            
+            R = expm(lambda x: self._apply_H_C(n, x, ops), R, dtau)
+            AC = tm.mmul_stack_left(R, self.A[n + 1])
+            
+        for n in reversed(xrange(1, self.N + 1)):
+            AC = expm(lambda x: self._apply_H_AC(n, x, ops), AC, -dtau)
+            
+            if n == 1:
+                self.A[n] = AC
+                break
+            
+            R, Q = la.rq(AC.transpose((1, 0, 2)).reshape((self.D[n - 1], 
+                                                          self.q[n] * self.D[n])),
+                         mode='economic')
+            self.A[n] = self._project(n, Q.reshape((self.D[n - 1], self.q[n], 
+                                                    self.D[n])).transpose((1, 0, 2)))
+            self.r[n - 1] = sp.eye(self.D[n - 1], dtype=self.typ_hp)
+            
+            if n < self.N:
+                self.calc_C(n_low=n, n_high=n + 1)
+            self.calc_K(n_low=n, n_high=n + 1)
+            
+            R = expm(lambda x: self._apply_H_C(n - 1, x, ops), R, dtau)
+            AC = tm.mmul_stack_right(self.A[n - 1], R)
+        
+    def _get_op_arrays(self):
+        """Returns the Hamiltonian terms in array form (see 
+        tdvp_common.get_op_array()), as a pair of object arrays, with 
+        elements 1..N - 1 for h_nn and 1..N for h_ext. Either is None if the
+        corresponding term is not set.
+        
+        The arrays are cached, so that callables are converted only once.
+        They are rebuilt when h_nn, h_ext or typ is reassigned, so an array 
+        Hamiltonian that is modified in place should be reassigned too.
+        """
+        src = (self.h_nn, self.h_ext, self.typ)
+        if (not self._op_arrays is None 
+            and all(a is b for a, b in zip(src, self._op_arrays_src))):
+            return self._op_arrays
+        
+        h_nn = h_ext = None
+        
+        if not self.h_nn is None:
+            h_nn = sp.empty((self.N,), dtype=object)
+            for n in xrange(1, self.N):
+                h_nn[n] = tm.get_op_array(self.h_nn, (self.q[n], self.q[n + 1], 
+                                                      self.q[n], self.q[n + 1]), 
+                                          n, dtype=self.typ)
+                
+        if not self.h_ext is None:
+            h_ext = sp.empty((self.N + 1,), dtype=object)
+            for n in xrange(1, self.N + 1):
+                h_ext[n] = tm.get_op_array(self.h_ext, (self.q[n], self.q[n]), 
+                                           n, dtype=self.typ)
+                
+        self._op_arrays = (h_nn, h_ext)
+        self._op_arrays_src = src
+                
+        return self._op_arrays
+        
+    def _project(self, n, A):
+        """Returns A as a C-contiguous array of type typ, with the elements
+        outside the allowed blocks removed if the state is symmetric.
+        """
+        A = sp.ascontiguousarray(A, dtype=self.typ)
+        if not self.charges is None:
+            A = self.charges[n].project(A)
+        return A
+        
+    def _apply_H_AC(self, n, AC, ops, left=True, right=True):
+        """Applies the effective Hamiltonian for site n to the site tensor AC,
+        with the state in mixed canonical form around n (see 
+        take_step_split()). ops are the Hamiltonian terms, as returned by
+        _get_op_arrays().
+        
+        If left (right) is False, the terms acting on sites < n (> n) are
+        omitted. The virtual index on that side of AC may then have any 
+        dimension. This is used by _apply_H_AA().
+        
+        Direct dependencies: 
+            - A[n - 1], A[n + 1]
+            - K_l[n - 1], K[n + 1]
+        """
+        h_nn, h_ext = ops
+        
+        res = sp.zeros_like(AC)
+        
+        if left and n > 1:
+            res += tm.mmul_stack_left(self.K_l[n - 1], AC)
+            if not h_nn is None:
+                C = tm.calc_C_mat_op_AA(h_nn[n - 1], 
+                                        tm.calc_AA(self.A[n - 1], AC))
+                res += tm.calc_AH_l_C(self.A[n - 1], 
+                                      sp.eye(self.D[n - 2], dtype=AC.dtype), C)
+        
+        if right and n < self.N:
+            res += tm.mmul_stack_right(AC, self.K[n + 1])
+            if not h_nn is None:
+                C = tm.calc_C_mat_op_AA(h_nn[n], tm.calc_AA(AC, self.A[n + 1]))
+                res += tm.calc_C_r_AH(C, sp.eye(self.D[n + 1], dtype=AC.dtype), 
+                                      self.A[n + 1])
+            
+        if not h_ext is None:
+            res += tm.apply_op_1s(h_ext[n], AC)
+            
+        return res
+        
+    def _apply_H_C(self, n, C, ops):
+        """Applies the effective Hamiltonian for bond n (between sites n and 
+        n + 1) to the bond matrix C, with A[n] left-orthonormal and A[n + 1] 
+        right-orthonormal (see take_step_split()). ops are the Hamiltonian 
+        terms, as returned by _get_op_arrays().
+        
+        Direct dependencies: 
+            - A[n], A[n + 1]
+            - K_l[n], K[n + 1]
+        """
+        h_nn = ops[0]
+        
+        res = m.mmul(self.K_l[n], C) + m.mmul(C, self.K[n + 1])
+        
+        if not h_nn is None:
+            CAA = tm.calc_C_mat_op_AA(h_nn[n], tm.calc_AA(self.A[n], 
+                                      tm.mmul_stack_left(C, self.A[n + 1])))
+            X = tm.calc_AH_l_C(self.A[n], sp.eye(self.D[n - 1], dtype=C.dtype), 
+                               CAA)
+            res += sp.tensordot(X, self.A[n + 1].conj(), ((0, 2), (0, 2)))
+            
+        return res
+        
+    def take_step_split_2s(self, dtau, trunc=1E-10, D_max=None, tol=1E-12, 
+                           max_itr=30):
+        """Takes a step using the two-site projector-splitting integrator,
+        adapting the bond dimensions.
+        
+        This is like take_step_split(), except that pairs of neighbouring
+        sites n, n + 1 are evolved together, with the two-site tensor 
+        split into left- and right-orthonormal site tensors using a 
+        singular value decomposition. The singular values are the Schmidt
+        coefficients for bond n, the square roots of the eigenvalues of
+        l[n] in right canonical form. Only the largest of them are kept, 
+        with D[n] chosen as small as possible such that the discarded 
+        weight (the sum of the squares of the discarded values relative 
+        to the sum of all squares) is at most trunc. The bond dimension can
+        thus grow, up to a factor q per step, where the entanglement 
+        increases and shrinks where it decreases. This makes it possible 
+        to start, for example, from a product state with D = 1.
+        
+        The arrays of the affected bonds are reallocated as needed. For a 
+        symmetric state (see set_charges()), the decomposition is done 
+        blockwise and the charges on the bonds are updated.
+        
+        After truncation, the state is renormalized. The total discarded 
+        weight for the step is stored in trunc_err.
+        
+        As for take_step_RK4(), update() should be called before each step.
+        
+        Parameters
+        ----------
+        dtau : complex
+            The (imaginary or real) amount of imaginary time (tau) to step.
+        trunc : float
+            The maximum discarded weight per bond and sweep.
+        D_max : int
+            The maximum bond dimension. If None, it is limited only by the
+            dimension of the Hilbert space.
+        tol : float
+            Tolerance for the Krylov approximations of the exponentials.
+        max_itr : int
+            The maximum dimension of the Krylov subspaces.
+        """
+        dtau = tm.get_dtau(dtau, self.typ) / 2
+        
+        self.itr_krylov = 0
+        self.trunc_err = 0
+        
+        ops = self._get_op_arrays()
+        
+        def expm(f, x, t):
+            res, itr = tm.expmv_lanczos(f, x, t, tol=tol, max_itr=max_itr)
+            self.itr_krylov += itr
+            return res
+        
+        AC = self.A[1]
+        
+        for n in xrange(1, self.N):
+            AA = tm.calc_AA(AC, self.A[n + 1])
+            AA = expm(lambda x: self._apply_H_AA(n, x, ops), AA, -dtau)
+            
+            U, sv, Vh = self._split_AA(n, AA, trunc, D_max)
+            
+            self.A[n] = self._project(n, U)
+            self.l[n] = sp.eye(self.D[n], dtype=self.typ_hp)
+            
+            self.calc_C(n_low=n - 1, n_high=n)
+            self.calc_K_l(n_low=n, n_high=n + 1)
+            
+            AC = tm.mmul_stack_left(sp.diag(sv), Vh)
+            if n < self.N - 1:
+                AC = expm(lambda x: self._apply_H_AC(n + 1, x, ops), AC, dtau)
+        
+        self.A[self.N] = self._project(self.N, AC)
+        
+        for n in reversed(xrange(1, self.N)):
+            AA = tm.calc_AA(self.A[n], AC)
+            AA = expm(lambda x: self._apply_H_AA(n, x, ops), AA, -dtau)
+            
+            U, sv, Vh = self._split_AA(n, AA, trunc, D_max)
+            
+            self.A[n + 1] = self._project(n + 1, Vh)
+            self.r[n] = sp.eye(self.D[n], dtype=self.typ_hp)
+            
+            if n + 1 < self.N:
+                self.calc_C(n_low=n + 1, n_high=n + 2)
+            self.calc_K(n_low=n + 1, n_high=n + 2)
+            
+            AC = tm.mmul_stack_right(U, sp.diag(sv))
+            if n > 1:
+                AC = expm(lambda x: self._apply_H_AC(n, x, ops), AC, dtau)
+                
+        self.A[1] = self._project(1, AC)
+        
+    def _apply_H_AA(self, n, AA, ops):
+        """Applies the effective Hamiltonian for sites n and n + 1 to the 
+        two-site tensor AA (as returned by tdvp_common.calc_AA()), with the
+        state in mixed canonical form around these sites (see 
+        take_step_split_2s()). ops are the Hamiltonian terms, as returned by
+        _get_op_arrays().
+        
+        Direct dependencies: 
+            - A[n - 1], A[n + 2]
+            - K_l[n - 1], K[n + 2]
+        """
+        q1, q2, D1, D2 = AA.shape
+        
+        h_nn = ops[0]
+        
+        if h_nn is None:
+            res = sp.zeros_like(AA)
+        else:
+            res = tm.calc_C_mat_op_AA(h_nn[n], AA)
+        
+        #Treat AA as a tensor for site n, with a right index (t, b)...
+        AC = AA.transpose((0, 2, 1, 3)).reshape((q1, D1, q2 * D2))
+        AC = self._apply_H_AC(n, AC, ops, right=False)
+        res += AC.reshape((q1, D1, q2, D2)).transpose((0, 2, 1, 3))
+        
+        #...and as a tensor for site n + 1, with a left index (s, a).
+        AC = AA.transpose((1, 0, 2, 3)).reshape((q2, q1 * D1, D2))
+        AC = self._apply_H_AC(n + 1, AC, ops, left=False)
+        res += AC.reshape((q2, q1, D1, D2)).transpose((1, 0, 2, 3))
+        
+        return res
+        
+    def _split_AA(self, n, AA, trunc, D_max):
+        """Splits the two-site tensor AA for sites n and n + 1 into a left-
+        orthonormal U, singular values sv and a right-orthonormal Vh, 
+        truncating and resizing bond n as described in take_step_split_2s().
+        """
+        if self.charges is None:
+            q1, q2, D1, D2 = AA.shape
+            U, sv, Vh = la.svd(AA.transpose((0, 2, 1, 3)).reshape((q1 * D1, 
+                                                                   q2 * D2)),
+                               full_matrices=False)
+            U = U.reshape((q1, D1, len(sv)))
+            Vh = Vh.reshape((len(sv), q2, D2)).transpose((1, 0, 2))
+            qn = None
+        else:
+            U, sv, Vh, qn = sy.svd_AA(AA, self.charges[n], 
+                                      self.charges[n + 1])
+        
+        w = sv**2 / sp.sum(sv**2)
+        order = sp.argsort(-w, kind='mergesort')
+        disc = sp.cumsum(w[order][::-1])[::-1] #disc[k] is the weight of order[k:]
+        D_n = max(sp.count_nonzero(disc > trunc), 1)
+        if not D_max is None:
+            D_n = min(D_n, D_max)
+        
+        keep = sp.sort(order[:D_n])
+        if D_n < len(sv):
+            self.trunc_err += disc[D_n]
+        
+        norm = la.norm(sv)
+        sv = sv[keep]
+        sv *= norm / la.norm(sv)
+        
+        self._resize_bond(n, D_n, qn=None if qn is None else qn[keep])
+        
+        return U[:, :, keep], sv, Vh[:, keep, :]
+        
+    def _resize_bond(self, n, D_n, qn=None):
+        """Sets the bond dimension D[n] to D_n, reallocating the arrays that
+        depend on it. For a symmetric state, qn are the new charges of the
+        bond.
+        
+        The contents of A[n] and A[n + 1], as well as l[n], r[n], K_l[n],
+        K[n + 1], C[n - 1] and C[n + 1], must be recomputed afterwards.
+        """
+        if not qn is None:
+            bs1, bs2 = self.charges[n], self.charges[n + 1]
+            ci = sy.ChargeIndex(qn, modulus=bs1.modulus)
+            self.charges[n] = sy.BlockStructure(bs1.qn_phys, bs1.left, ci)
+            self.charges[n + 1] = sy.BlockStructure(bs2.qn_phys, ci, bs2.right)
+        
+        if D_n == self.D[n]:
+            return
+            
+        self.D[n] = D_n
+        
+        self.l[n] = sp.zeros((D_n, D_n), dtype=self.typ_hp, order=self.odr)
+        self.r[n] = sp.zeros((D_n, D_n), dtype=self.typ_hp, order=self.odr)
+        self.K_l[n] = sp.zeros((D_n, D_n), dtype=self.typ, order=self.odr)
+        self.K[n + 1] = sp.zeros((D_n, D_n), dtype=self.typ, order=self.odr)
+        
+        if n > 1:
+            self.C[n - 1] = sp.empty((self.q[n - 1], self.q[n], self.D[n - 2], 
+                                      D_n), dtype=self.typ, order=self.odr)
+        if n + 1 < self.N:
+            self.C[n + 1] = sp.empty((self.q[n + 1], self.q[n + 2], D_n, 
+                                      self.D[n + 2]), dtype=self.typ, 
+                                     order=self.odr)
             
     def add_noise(self, fac):
         """Adds some random noise of a given order to the state matrices A
@@ -692,7 +1314,8 @@ class EvoMPS_TDVP_Generic:
         for n in xrange(1, self.N + 1):
             for s in xrange(self.q[n]):
                 self.A[n][s].real += (sp.rand(self.D[n - 1], self.D[n]) - 0.5) * 2 * fac
-                self.A[n][s].imag += (sp.rand(self.D[n - 1], self.D[n]) - 0.5) * 2 * fac
+                if sp.iscomplexobj(self.A[n]):
+                    self.A[n][s].imag += (sp.rand(self.D[n - 1], self.D[n]) - 0.5) * 2 * fac
                 
     
     def calc_l(self, start=-1, finish=-1):
@@ -705,10 +1328,7 @@ class EvoMPS_TDVP_Generic:
         if finish < 0:
             finish = self.N
         for n in xrange(start, finish + 1):
-            self.l[n].fill(0)
-
-            for s in xrange(self.q[n]):
-                self.l[n] += m.mmul(m.H(self.A[n][s]), self.l[n - 1], self.A[n][s])
+            self.eps_l(n, self.l[n - 1], out=self.l[n], blocks=True)
     
     def calc_r(self, n_low=-1, n_high=-1):
         """Updates the r matrices using the current state.
@@ -720,7 +1340,7 @@ class EvoMPS_TDVP_Generic:
         if n_high < 0:
             n_high = self.N - 1
         for n in reversed(xrange(n_low, n_high + 1)):
-            self.eps_r(n + 1, self.r[n + 1], out=self.r[n])
+            self.eps_r(n + 1, self.r[n + 1], out=self.r[n], blocks=True)
     
     def simple_renorm(self, update_r=True):
         """Renormalize the state by altering A[N] by a factor.
@@ -755,7 +1375,7 @@ class EvoMPS_TDVP_Generic:
             for n in xrange(self.N):
                 self.r[n] *= 1 / norm
     
-    def eps_r(self, n, x, o=None, out=None):
+    def eps_r(self, n, x, o=None, out=None, blocks=False):
         """Implements the right epsilon map
         
         FIXME: Ref.
@@ -766,35 +1386,42 @@ class EvoMPS_TDVP_Generic:
             The site number.
         x : ndarray
             The argument matrix. For example, using r[n] (and o=None) gives a result r[n - 1]
-        o : function
-            The single-site operator to use. May be None.
+        o : function or ndarray
+            The single-site operator to use. May be None. 
+            See tdvp_common.get_op_array().
         out : ndarray
             A matrix to hold the result (with the same dimensions as r[n - 1]). May be None.
+        blocks : bool
+            Whether x is known to carry no charge, like r[n], so that the map
+            can be applied blockwise if charges are set. Elements of x 
+            outside the diagonal blocks are then ignored. Only used if o is 
+            None.
     
         Returns
         -------
         res : ndarray
             The resulting matrix.
         """
+        if not o is None:
+            o = tm.get_op_array(o, (self.q[n], self.q[n]), n)
+            
         if out is None:
-            out = sp.zeros((self.D[n - 1], self.D[n - 1]), dtype=self.typ)
+            typ = self.typ_hp if o is None else sp.result_type(self.typ_hp, o.dtype)
+            out = sp.zeros((self.D[n - 1], self.D[n - 1]), dtype=typ)
         else:
             out.fill(0)
 
         if o is None:
-            for s in xrange(self.q[n]):
-                out += m.mmul(self.A[n][s], x, m.H(self.A[n][s]))            
+            if self.charges is None or not blocks:
+                tm.eps_r_noop(x, self.A[n], self.A[n], out=out)
+            else:
+                sy.eps_r_noop(x, self.A[n], self.A[n], self.charges[n], 
+                              out=out)
         else:
-            for s in xrange(self.q[n]):
-                for t in xrange(self.q[n]):
-                    o_st = o(n, s, t)
-                    if o_st != 0.:
-                        tmp = m.mmul(self.A[n][t], x, m.H(self.A[n][s]))
-                        tmp *= o_st
-                        out += tmp
+            tm.eps_r_op_1s(sp.asarray(x), self.A[n], self.A[n], o, out=out)
         return out
         
-    def eps_l(self, n, x, out=None):
+    def eps_l(self, n, x, out=None, blocks=False):
         """Implements the left epsilon map
         
         FIXME: Ref.
@@ -807,6 +1434,9 @@ class EvoMPS_TDVP_Generic:
             The argument matrix. For example, using l[n - 1] gives a result l[n]
         out : ndarray
             A matrix to hold the result (with the same dimensions as l[n]). May be None.
+        blocks : bool
+            Whether x is known to carry no charge, like l[n - 1] (see 
+            eps_r()).
     
         Returns
         -------
@@ -814,13 +1444,13 @@ class EvoMPS_TDVP_Generic:
             The resulting matrix.
         """
         if out is None:
-            out = sp.zeros_like(self.l[n])
-        else:
-            out.fill(0.)
+            out = sp.zeros((self.D[n], self.D[n]), dtype=self.typ_hp)
+            
+        if not self.charges is None and blocks:
+            return sy.eps_l_noop(x, self.A[n], self.A[n], self.charges[n],
+                                 out=out)
 
-        for s in xrange(self.q[n]):
-            out += m.mmul(m.H(self.A[n][s]), x, self.A[n][s])
-        return out
+        return tm.eps_l_noop(x, self.A[n], self.A[n], out=out)
     
     def restore_ONR_n(self, n, G_n_i):
         """Transforms a single A[n] to obtain right orthonormalization.
@@ -853,23 +1483,38 @@ class EvoMPS_TDVP_Generic:
         """
         GGh_n_i = m.mmul(G_n_i, m.H(G_n_i)) #r[n] does not belong here. The condition is for sum(AA). r[n] = 1 is a consequence. 
         
-        M = self.eps_r(n, GGh_n_i)
+        M = self.eps_r(n, GGh_n_i, blocks=True)
+                    
+        if self.charges is None:
+            cholesky, invtr, eigh, inv = la.cholesky, m.invtr, la.eigh, la.inv
+        else:
+            #Work blockwise, so that the sectors are not mixed
+            ci = self.charges[n].left
+            cholesky = lambda x: sy.blockwise(la.cholesky, ci, x)
+            invtr = lambda x: sy.blockwise(m.invtr, ci, x)
+            eigh = lambda x: sy.eigh(x, ci)
+            inv = lambda x: sy.blockwise(la.inv, ci, x)
                     
         #The following should be more efficient than eigh():
         try:
-            tu = la.cholesky(M) #Assumes M is pos. def.. It should raise LinAlgError if not.
-            G_nm1 = m.H(m.invtr(tu)) #G is now lower-triangular
+            tu = cholesky(M) #Assumes M is pos. def.. It should raise LinAlgError if not.
+            G_nm1 = m.H(invtr(tu)) #G is now lower-triangular
             G_nm1_i = m.H(tu)
         except sp.linalg.LinAlgError:
             print "restore_ONR_n: Falling back to eigh()!"
-            e,Gh = la.eigh(M)
+            e,Gh = eigh(M)
             G_nm1 = m.H(m.mmul(Gh, sp.diag(1/sp.sqrt(e) + 0.j)))
-            G_nm1_i = la.inv(G_nm1)
+            G_nm1_i = inv(G_nm1)
         
-        for s in xrange(self.q[n]):                
-            self.A[n][s] = m.mmul(G_nm1, self.A[n][s], G_n_i)
-            #It's ok to use the same matrix as out and as an operand here
-            #since there are > 2 matrices in the chain and it is not the last argument.
+        if self.charges is None:
+            for s in xrange(self.q[n]):                
+                self.A[n][s] = m.mmul(G_nm1, self.A[n][s], G_n_i)
+                #It's ok to use the same matrix as out and as an operand here
+                #since there are > 2 matrices in the chain and it is not the last argument.
+        else:
+            bs = self.charges[n]
+            self.A[n][:] = sy.mmul_stack_left(G_nm1, 
+                               sy.mmul_stack_right(self.A[n], G_n_i, bs), bs)
 
         return G_nm1_i
         
@@ -920,10 +1565,10 @@ class EvoMPS_TDVP_Generic:
         if start < 1:
             start = self.N
         
-        G_n_i = sp.eye(self.D[start], dtype=self.typ) #This is actually just the number 1
+        G_n_i = sp.eye(self.D[start], dtype=self.typ_hp) #This is actually just the number 1
         for n in reversed(xrange(2, start + 1)):
             G_n_i = self.restore_ONR_n(n, G_n_i)
-            self.eps_r(n, self.r[n], out=self.r[n - 1]) #Update r[n - 1], which should, ideally, now equal 1
+            self.eps_r(n, self.r[n], out=self.r[n - 1], blocks=True) #Update r[n - 1], which should, ideally, now equal 1
             #self.r[n - 1][:] = sp.eye(self.D[n - 1])
             #self.r[n - 1] = m.eyemat(self.D[n - 1], dtype=self.typ)
             #print self.r[n - 1]
@@ -938,7 +1583,7 @@ class EvoMPS_TDVP_Generic:
             self.A[1][s] = m.mmul(self.A[1][s], G_n_i)
                     
         #Now finish off
-        self.eps_r(1, self.r[1], out=self.r[0])
+        self.eps_r(1, self.r[1], out=self.r[0], blocks=True)
         
         if normalize:
             G0 = 1. / sp.sqrt(self.r[0].squeeze().real)
@@ -951,18 +1596,27 @@ class EvoMPS_TDVP_Generic:
                     print "Sanity Fail in restore_RCF!: r_0 is bad / norm failure"
                 
         if diag_l:
-            G_nm1 = sp.eye(self.D[0], dtype=self.typ)
+            G_nm1 = sp.eye(self.D[0], dtype=self.typ_hp)
             for n in xrange(1, self.N):
                 x = m.mmul(m.H(G_nm1), self.l[n - 1], G_nm1)
-                M = self.eps_l(n, x)
-                ev, EV = la.eigh(M)
+                M = self.eps_l(n, x, blocks=True)
+                if self.charges is None:
+                    ev, EV = la.eigh(M)
+                else:
+                    ev, EV = sy.eigh(M, self.charges[n].right)
                 
                 G_n_i = EV
                 self.l[n][:] = sp.diag(ev)
                 #self.l[n] = m.simple_diag_matrix(sp.array(ev, dtype=self.typ))
                 
-                for s in xrange(self.q[n]):                
-                    self.A[n][s] = m.mmul(G_nm1, self.A[n][s], G_n_i)
+                if self.charges is None:
+                    for s in xrange(self.q[n]):                
+                        self.A[n][s] = m.mmul(G_nm1, self.A[n][s], G_n_i)
+                else:
+                    bs = self.charges[n]
+                    self.A[n][:] = sy.mmul_stack_left(G_nm1, 
+                                       sy.mmul_stack_right(self.A[n], G_n_i, bs), 
+                                       bs)
                 
                 if self.sanity_checks:
                     l = self.eps_l(n, self.l[n - 1])
@@ -977,7 +1631,7 @@ class EvoMPS_TDVP_Generic:
                 self.A[n][s] = m.mmul(G_nm1, self.A[n][s])
                 
             #Deal with final, scalar l[N]
-            self.eps_l(n, self.l[n - 1], out=self.l[n])
+            self.eps_l(n, self.l[n - 1], out=self.l[n], blocks=True)
             
             if self.sanity_checks:
                 if not sp.allclose(self.l[self.N].real, 1, atol=1E-14, rtol=1E-14):
@@ -1023,12 +1677,13 @@ class EvoMPS_TDVP_Generic:
         A single-site operator is represented as a function taking three
         integer arguments (n, s, t) where n is the site number and s, t 
         range from 0 to q[n] - 1 and define the requested matrix element <s|o|t>.
+        Alternatively, it may be given as an ndarray o[s, t] = <s|o|t>.
         
         Assumes that the state is normalized.
         
         Parameters
         ----------
-        o : function
+        o : function or ndarray
             The operator.
         n : int
             The site number.
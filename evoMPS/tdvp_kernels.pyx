@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Ashley Milsted
+
+Compiled kernels for the contractions in the TDVP update pipeline.
+
+All matrix products are computed by calling BLAS (zgemm) directly via
+scipy.linalg.cython_blas, without holding the GIL. Only C-contiguous
+complex128 arrays are supported. The results are written into the
+arrays supplied as out, which must have the correct shape.
+
+These are not intended to be called directly: tdvp_common uses them
+where possible and falls back to numpy otherwise.
+"""
+
+import cython as cy
+import numpy as np
+cimport numpy as np
+from scipy.linalg.cython_blas cimport zgemm
+
+ctypedef np.complex128_t DTYPE_t
+
+cdef inline void _gemm(bint conj_a, bint conj_b, int M, int N, int K,
+                       DTYPE_t *a, DTYPE_t *b, DTYPE_t beta,
+                       DTYPE_t *c) nogil:
+    """Computes c = op(a) op(b) + beta * c for C-ordered matrices.
+
+    c is M x N and op(a), op(b) are M x K and K x N, respectively.
+    If conj_a, a is the K x M matrix with op(a) = a^dagger, otherwise
+    op(a) = a (similarly for b).
+
+    BLAS expects Fortran-ordered matrices, which are the transposes of the
+    C-ordered ones, so we compute c^T = op(b)^T op(a)^T.
+    """
+    cdef char ta = 'N'
+    cdef char tb = 'N'
+    cdef int lda = K
+    cdef int ldb = N
+    cdef int ldc = N
+    cdef DTYPE_t alpha = 1
+
+    if conj_a:
+        ta = 'C'
+        lda = M
+    if conj_b:
+        tb = 'C'
+        ldb = K
+
+    zgemm(&tb, &ta, &N, &M, &K, &alpha, b, &ldb, a, &lda, &beta, c, &ldc)
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+def calc_AA(DTYPE_t[:, :, ::1] A, DTYPE_t[:, :, ::1] Ap1,
+            DTYPE_t[:, :, :, ::1] out):
+    """Computes out[s, t] = A[s].dot(Ap1[t]).
+    """
+    cdef int q1 = A.shape[0]
+    cdef int q2 = Ap1.shape[0]
+    cdef int D1 = A.shape[1]
+    cdef int D2 = A.shape[2]
+    cdef int D3 = Ap1.shape[2]
+
+    assert Ap1.shape[1] == D2
+    assert (out.shape[0] == q1 and out.shape[1] == q2
+            and out.shape[2] == D1 and out.shape[3] == D3)
+
+    cdef int s, t
+
+    with nogil:
+        for s in range(q1):
+            for t in range(q2):
+                _gemm(False, False, D1, D3, D2, &A[s, 0, 0], &Ap1[t, 0, 0],
+                      0, &out[s, t, 0, 0])
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+def eps_r(DTYPE_t[:, ::1] x, DTYPE_t[:, :, ::1] A1, DTYPE_t[:, :, ::1] A2,
+          DTYPE_t[:, ::1] out):
+    """Computes out = sum_s A1[s] x H(A2[s]).
+
+    With A1 and A2 reshaped from (q1, q2, D, D) stacks, this is also the
+    right epsilon map for a two-site operator in the form C12, AA34.
+    """
+    cdef int q = A1.shape[0]
+    cdef int D1 = A1.shape[1]
+    cdef int D2 = A1.shape[2]
+    cdef int D1_ = A2.shape[1]
+    cdef int D2_ = A2.shape[2]
+
+    assert A2.shape[0] == q
+    assert x.shape[0] == D2 and x.shape[1] == D2_
+    assert out.shape[0] == D1 and out.shape[1] == D1_
+
+    cdef DTYPE_t[:, ::1] tmp = np.empty((D1, D2_), dtype=np.complex128)
+
+    cdef int s
+
+    with nogil:
+        for s in range(q):
+            _gemm(False, False, D1, D2_, D2, &A1[s, 0, 0], &x[0, 0],
+                  0, &tmp[0, 0])
+            _gemm(False, True, D1, D1_, D2_, &tmp[0, 0], &A2[s, 0, 0],
+                  0 if s == 0 else 1, &out[0, 0])
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+def eps_l(DTYPE_t[:, ::1] x, DTYPE_t[:, :, ::1] A1, DTYPE_t[:, :, ::1] A2,
+          DTYPE_t[:, ::1] out):
+    """Computes out = sum_s H(A1[s]) x A2[s].
+
+    With A1 and A2 reshaped from (q1, q2, D, D) stacks, this is also the
+    left epsilon map for a two-site operator in the form AA12, C34.
+    """
+    cdef int q = A1.shape[0]
+    cdef int D1 = A1.shape[1]
+    cdef int D2 = A1.shape[2]
+    cdef int D1_ = A2.shape[1]
+    cdef int D2_ = A2.shape[2]
+
+    assert A2.shape[0] == q
+    assert x.shape[0] == D1 and x.shape[1] == D1_
+    assert out.shape[0] == D2 and out.shape[1] == D2_
+
+    cdef DTYPE_t[:, ::1] tmp = np.empty((D2, D1_), dtype=np.complex128)
+
+    cdef int s
+
+    with nogil:
+        for s in range(q):
+            _gemm(True, False, D2, D1_, D1, &A1[s, 0, 0], &x[0, 0],
+                  0, &tmp[0, 0])
+            _gemm(False, False, D2, D2_, D1_, &tmp[0, 0], &A2[s, 0, 0],
+                  0 if s == 0 else 1, &out[0, 0])
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+def calc_C_r_AH(DTYPE_t[:, :, :, ::1] C, DTYPE_t[:, ::1] r,
+                DTYPE_t[:, :, ::1] A, DTYPE_t[:, :, ::1] out):
+    """Computes out[s] = sum_t C[s, t] r H(A[t]).
+    """
+    cdef int q1 = C.shape[0]
+    cdef int q2 = C.shape[1]
+    cdef int D1 = C.shape[2]
+    cdef int D2 = C.shape[3]
+    cdef int D2_ = r.shape[1]
+    cdef int D1_ = A.shape[1]
+
+    assert r.shape[0] == D2
+    assert A.shape[0] == q2 and A.shape[2] == D2_
+    assert out.shape[0] == q1 and out.shape[1] == D1 and out.shape[2] == D1_
+
+    cdef DTYPE_t[:, ::1] tmp = np.empty((D1, D2_), dtype=np.complex128)
+
+    cdef int s, t
+
+    with nogil:
+        for s in range(q1):
+            for t in range(q2):
+                _gemm(False, False, D1, D2_, D2, &C[s, t, 0, 0], &r[0, 0],
+                      0, &tmp[0, 0])
+                _gemm(False, True, D1, D1_, D2_, &tmp[0, 0], &A[t, 0, 0],
+                      0 if t == 0 else 1, &out[s, 0, 0])
+
+@cy.boundscheck(False)
+@cy.wraparound(False)
+def calc_AH_l_C(DTYPE_t[:, :, ::1] A, DTYPE_t[:, ::1] l,
+                DTYPE_t[:, :, :, ::1] C, DTYPE_t[:, :, ::1] out):
+    """Computes out[s] = sum_t H(A[t]) l C[t, s].
+    """
+    cdef int q1 = C.shape[0]
+    cdef int q2 = C.shape[1]
+    cdef int D1 = A.shape[1]
+    cdef int D2 = A.shape[2]
+    cdef int D1_ = l.shape[1]
+    cdef int D2_ = C.shape[3]
+
+    assert A.shape[0] == q1
+    assert l.shape[0] == D1 and C.shape[2] == D1_
+    assert out.shape[0] == q2 and out.shape[1] == D2 and out.shape[2] == D2_
+
+    cdef DTYPE_t[:, :, ::1] Al = np.empty((q1, D2, D1_), dtype=np.complex128)
+
+    cdef int s, t
+
+    with nogil:
+        for t in range(q1):
+            _gemm(True, False, D2, D1_, D1, &A[t, 0, 0], &l[0, 0],
+                  0, &Al[t, 0, 0])
+
+        for s in range(q2):
+            for t in range(q1):
+                _gemm(False, False, D2, D2_, D1_, &Al[t, 0, 0], &C[t, s, 0, 0],
+                      0 if t == 0 else 1, &out[s, 0, 0])
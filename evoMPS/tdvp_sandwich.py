@@ -10,6 +10,7 @@ import scipy.linalg as la
 import nullspace as ns
 import matmul as mm
 import tdvp_uniform as uni
+import tdvp_common as tm
 
 def go(sim, tau, steps, force_calc_lr=False, RK4=False,
        autogrow=False, autogrow_amount=2, autogrow_max_N=1000,
@@ -266,14 +267,26 @@ class EvoMPS_TDVP_Sandwich:
             if n < self.N + 1:
                 self.C[n] = sp.empty((self.q[n], self.q[n+1], self.D[n-1], self.D[n+1]), dtype=self.typ, order=self.odr)
 
-    def __init__(self, numsites, uni_ground):
-        self.u_gnd_l = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q)
+    def __init__(self, numsites, uni_ground, dtype=None):
+        """Creates a nonuniform window of numsites sites, embedded in the 
+        uniform state uni_ground.
+        
+        The dtype of the parameters defaults to that of uni_ground. A real
+        ground state can be used with dtype=complex128 for real time 
+        evolution.
+        """
+        if dtype is None:
+            dtype = uni_ground.typ
+        self.typ = tm.check_dtype(dtype, supported=(sp.float64, sp.complex128))
+        
+        self.u_gnd_l = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q,
+                                               dtype=self.typ)
         self.u_gnd_l.sanity_checks = self.sanity_checks
         self.u_gnd_l.h_nn = uni_ground.h_nn
         self.u_gnd_l.h_nn_cptr = uni_ground.h_nn_cptr
-        self.u_gnd_l.A = uni_ground.A.copy()
-        self.u_gnd_l.l = uni_ground.l.copy()
-        self.u_gnd_l.r = uni_ground.r.copy()
+        self.u_gnd_l.A = uni_ground.A.astype(self.typ) #copies
+        self.u_gnd_l.l = sp.asarray(uni_ground.l).astype(self.typ)
+        self.u_gnd_l.r = sp.asarray(uni_ground.r).astype(self.typ)
 
         self.u_gnd_l.symm_gauge = False
         self.u_gnd_l.update()
@@ -283,7 +296,8 @@ class EvoMPS_TDVP_Sandwich:
         self.u_gnd_l_kmr = la.norm(self.u_gnd_l.r / la.norm(self.u_gnd_l.r) - 
                                    self.u_gnd_l.K / la.norm(self.u_gnd_l.K))
 
-        self.u_gnd_r = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q)
+        self.u_gnd_r = uni.EvoMPS_TDVP_Uniform(uni_ground.D, uni_ground.q,
+                                               dtype=self.typ)
         self.u_gnd_r.sanity_checks = self.sanity_checks
         self.u_gnd_r.symm_gauge = False
         self.u_gnd_r.h_nn = uni_ground.h_nn
@@ -296,8 +310,15 @@ class EvoMPS_TDVP_Sandwich:
         self.grown_right = 0
         self.shrunk_left = 0
         self.shrunk_right = 0
+        
+        self.rk_accepted = 0
+        self.rk_rejected = 0
+        self.rk_err = 0
 
-        self.h_nn = self.wrap_h
+        if callable(uni_ground.h_nn):
+            self.h_nn = self.wrap_h
+        else:
+            self.h_nn = uni_ground.h_nn #the same array is used for all n
         self.h_nn_mat = None
 
         self.eps = sp.finfo(self.typ).eps
@@ -321,7 +342,8 @@ class EvoMPS_TDVP_Sandwich:
         """
         for n in xrange(1, self.N + 1):
             self.A[n].real = (sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n]) #/ sp.sqrt(self.N) #/ sp.sqrt(self.D[n])
-            self.A[n].imag = 0#(sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n])
+            if sp.iscomplexobj(self.A[n]):
+                self.A[n].imag = 0#(sp.rand(self.D[n - 1], self.D[n]) - 0.5) / sp.sqrt(self.q[n])
 
     def wrap_h(self, n, s, t, u, v):
         return self.u_gnd_l.h_nn(s, t, u, v)
@@ -331,13 +353,12 @@ class EvoMPS_TDVP_Sandwich:
         algorithm by avoiding excess loops and python calls.
         """
         self.h_nn_mat = sp.zeros((self.N + 1, self.q.max(), self.q.max(), 
-                                  self.q.max(), self.q.max()), dtype=sp.complex128)
+                                  self.q.max(), self.q.max()), dtype=self.typ)
         for n in xrange(self.N + 1):
-            for u in xrange(self.q[n]):
-                for v in xrange(self.q[n + 1]):
-                    for s in xrange(self.q[n]):
-                        for t in xrange(self.q[n + 1]):
-                            self.h_nn_mat[n, s, t, u, v] = self.h_nn(n, s, t, u, v)
+            self.h_nn_mat[n, :self.q[n], :self.q[n + 1], :self.q[n], :self.q[n + 1]] = \
+                tm.get_op_array(self.h_nn, (self.q[n], self.q[n + 1], 
+                                            self.q[n], self.q[n + 1]), n,
+                                dtype=self.typ)
 
     def calc_C(self, n_low=-1, n_high=-1):
         """Generates the C matrices used to calculate the K's and ultimately the B's
@@ -362,38 +383,23 @@ class EvoMPS_TDVP_Sandwich:
         if n_high < 1:
             n_high = self.N + 1
         
-        if self.h_nn_mat is None:
-            for n in xrange(n_low, n_high):
-                self.C[n].fill(0)
-                for u in xrange(self.q[n]):
-                    for v in xrange(self.q[n + 1]):
-                        AA = mm.mmul(self.A[n][u], self.A[n + 1][v]) #only do this once for each
-                        for s in xrange(self.q[n]):
-                            for t in xrange(self.q[n + 1]):
-                                h_nn_stuv = self.h_nn(n, s, t, u, v)
-                                if h_nn_stuv != 0:
-                                    self.C[n][s, t] += h_nn_stuv * AA
-        else:
-            dot = sp.dot
-            for n in xrange(n_low, n_high):
-                An = self.A[n]
-                Anp1 = self.A[n + 1]
-                
-                AA = sp.empty_like(self.C[n])
-                for u in xrange(self.q[n]):
-                    for v in xrange(self.q[n + 1]):
-                        AA[u, v] = dot(An[u], Anp1[v])
-                        
-                if n == 0: #FIXME: Temp. hack
-                    self.AA0 = AA
-                elif n == 1:
-                    self.AA1 = AA
-                
-                res = sp.tensordot(AA, self.h_nn_mat[n], ((0, 1), (2, 3)))
-                res = sp.rollaxis(res, 3)
-                res = sp.rollaxis(res, 3)
-                
-                self.C[n][:] = res
+        for n in xrange(n_low, n_high):
+            AA = tm.calc_AA(self.A[n], self.A[n + 1])
+                    
+            if n == 0: #FIXME: Temp. hack
+                self.AA0 = AA
+            elif n == 1:
+                self.AA1 = AA
+            
+            if self.h_nn_mat is None:
+                h_nn = tm.get_op_array(self.h_nn, (self.q[n], self.q[n + 1], 
+                                                   self.q[n], self.q[n + 1]), n,
+                                       dtype=self.typ)
+            else:
+                h_nn = self.h_nn_mat[n, :self.q[n], :self.q[n + 1], 
+                                        :self.q[n], :self.q[n + 1]]
+            
+            self.C[n][:] = tm.calc_C_mat_op_AA(h_nn, AA)
 
     def calc_K(self):
         """Generates the right K matrices used to calculate the B's
@@ -465,24 +471,12 @@ class EvoMPS_TDVP_Sandwich:
 
         We return the conjugate mm.H(V) because we use it in more places than V.
         """
-        R = sp.zeros((self.D[n], self.q[n], self.D[n-1]), dtype=self.typ, order='C')
-
-        for s in xrange(self.q[n]):
-            R[:,s,:] = mm.mmul(sqrt_r, mm.H(self.A[n][s]))
-
-        R = R.reshape((self.q[n] * self.D[n], self.D[n-1]))
-        Vconj = ns.nullspace_qr(mm.H(R)).T
+        Vsh = ns.calc_Vsh(self.A[n], sqrt_r)
 
         if self.sanity_checks:
-            if not sp.allclose(mm.mmul(Vconj.conj(), R), 0):
-                print "Sanity Fail in calc_Vsh!: VR_%u != 0" % (n)
+            Vconj = Vsh.T.reshape((Vsh.shape[2], self.D[n] * self.q[n]))
             if not sp.allclose(mm.mmul(Vconj, mm.H(Vconj)), sp.eye(Vconj.shape[0])):
                 print "Sanity Fail in calc_Vsh!: V H(V)_%u != eye" % (n)
-            
-        Vconj = Vconj.reshape((self.q[n] * self.D[n] - self.D[n - 1], self.D[n], self.q[n]))
-
-        Vsh = Vconj.T
-        Vsh = sp.asarray(Vsh, order='C')
 
         if self.sanity_checks:
             M = sp.zeros((self.q[n] * self.D[n] - self.D[n - 1], self.D[n]), dtype=self.typ)
@@ -510,49 +504,18 @@ class EvoMPS_TDVP_Sandwich:
             - V[n]
         """
         x = sp.zeros((self.D[n - 1], self.q[n] * self.D[n] - self.D[n - 1]), dtype=self.typ, order=self.odr)
-        x_part = sp.empty_like(x)
-        x_subpart = sp.empty_like(self.A[n][0])
-        x_subsubpart = sp.empty_like(self.A[n][0])
         
-        C = self.C[n]
-        Cm1 = self.C[n - 1]
-        rp1 = self.r[n + 1]
-        A = self.A[n]
-        Ap1 = self.A[n + 1]
-        Am1 = self.A[n - 1]
-        Kp1 = self.K[n + 1]
-        
-        H = mm.H
-
-        x_part.fill(0)
-        for s in xrange(self.q[n]):
-            x_subpart.fill(0)
-
-            if n < self.N + 1:
-                x_subsubpart.fill(0)
-                for t in xrange(self.q[n + 1]):
-                    x_subsubpart += C[s,t].dot(rp1.dot(H(Ap1[t]))) #~1st line
-
-                x_subsubpart += A[s].dot(Kp1) #~3rd line
-
-                try:
-                    x_subpart += sqrt_r_inv.dot_left(x_subsubpart)
-                except AttributeError:
-                    x_subpart += x_subsubpart.dot(sqrt_r_inv)
-
-            x_part += x_subpart.dot(Vsh[s])
-
-        x += sqrt_l.dot(x_part)
+        if n < self.N + 1:
+            X = tm.calc_C_r_AH(self.C[n], self.r[n + 1], self.A[n + 1]) #~1st line
+            X += tm.mmul_stack_right(self.A[n], self.K[n + 1]) #~3rd line
+            X = tm.mmul_stack_right(X, sqrt_r_inv)
+            
+            x += mm.mmul(sqrt_l, tm.contract_Vsh(X, Vsh))
 
-        if n > 0:
-            l_nm2 = self.get_l(n - 2)
-            x_part.fill(0)
-            for s in xrange(self.q[n]):     #~2nd line
-                x_subsubpart.fill(0)
-                for t in xrange(self.q[n + 1]):
-                    x_subsubpart += H(Am1[t]).dot(l_nm2.dot(Cm1[t, s]))
-                x_part += x_subsubpart.dot(sqrt_r.dot(Vsh[s]))
-            x += sqrt_l_inv.dot(x_part)
+        if n > 0: #~2nd line
+            X = tm.calc_AH_l_C(self.A[n - 1], self.get_l(n - 2), self.C[n - 1])
+            X = tm.mmul_stack_right(X, sqrt_r)
+            x += mm.mmul(sqrt_l_inv, tm.contract_Vsh(X, Vsh))
 
         return x
         
@@ -641,9 +604,7 @@ class EvoMPS_TDVP_Sandwich:
                 if set_eta:
                     self.eta[n] = sp.sqrt(mm.adot(x, x))
     
-                B = sp.empty_like(self.A[n])
-                for s in xrange(self.q[n]):
-                    B[s] = mm.mmul(l_sqrt_inv, x, mm.H(Vsh[s]), r_sqrt_inv)
+                B = tm.calc_B_from_x(x, Vsh, l_sqrt_inv, r_sqrt_inv)
 
             if self.sanity_checks:
                 M = sp.zeros_like(self.r[n - 1])
@@ -734,6 +695,7 @@ class EvoMPS_TDVP_Sandwich:
         dtau : complex
             The (imaginary or real) amount of imaginary time (tau) to step.
         """
+        dtau = tm.get_dtau(dtau, self.typ)
 
         eta_tot = 0
 
@@ -766,6 +728,8 @@ class EvoMPS_TDVP_Sandwich:
             self.calc_C()
             self.calc_K()            
 
+        dtau = tm.get_dtau(dtau, self.typ)
+
         eta_tot = 0
 
         #Take a copy of the current state
@@ -826,6 +790,82 @@ class EvoMPS_TDVP_Sandwich:
 
         return eta_tot
 
+    def take_step_adaptive(self, dtau, tol=1E-8, method='BS23',
+                           max_rejects=10):
+        """Takes a step using an embedded Runge-Kutta method with step size
+        control.
+
+        Two solutions of different order are computed from the same stages
+        and their difference is used as an estimate of the local error,
+        measured in the norm of the tangent space (given by the l and r
+        matrices) and summed over the sites 1..N. If the error exceeds tol,
+        the step is rejected and retried with a smaller dtau. A step size
+        for the next step is then proposed based on the error.
+
+        As for take_step_RK4(), update() should be called before each step.
+        Accepted and rejected steps are counted in rk_accepted and
+        rk_rejected. The error estimate for the last step is stored in
+        rk_err.
+
+        Parameters
+        ----------
+        dtau : complex
+            The (imaginary or real) amount of imaginary time (tau) to try
+            to step. Usually, this is dtau_next from the previous step.
+        tol : float
+            The tolerance for the local error of each step.
+        method : str
+            The embedded method, 'BS23' or 'DP54' (see
+            tdvp_common.rk_tableaux).
+        max_rejects : int
+            The maximum number of times the step is retried. The last try
+            is accepted regardless of the error.
+
+        Returns
+        -------
+        dtau_taken : complex
+            The step size actually used.
+        dtau_next : complex
+            The proposed step size for the next step.
+        """
+        def calc_Bs(set_eta=False):
+            #All B's must be computed before any A is changed.
+            return [None] + [self.calc_B(n, set_eta=set_eta)
+                             for n in xrange(1, self.N + 1)]
+
+        def restore(A):
+            for n in xrange(1, self.N + 1):
+                self.A[n] = A[n]
+            self.calc_l()
+            self.calc_r()
+            self.calc_C()
+            self.calc_K()
+
+        l0 = [sp.array(self.l[n]) for n in xrange(self.N + 1)]
+        r0 = [sp.array(self.r[n]) for n in xrange(self.N + 1)]
+
+        def tangent_norm(dA):
+            res = 0
+            for n in xrange(1, self.N + 1):
+                res += abs(mm.adot(l0[n - 1],
+                                   tm.eps_r_noop(r0[n], dA[n], dA[n])))
+            return sp.sqrt(res)
+
+        dtau = tm.get_dtau(dtau, self.typ)
+
+        A0 = [None] + [self.A[n].copy() for n in xrange(1, self.N + 1)]
+
+        A, dtau, dtau_next, self.rk_err, rejects = tm.rk_adaptive_step(
+            A0, dtau, calc_Bs(set_eta=True), calc_Bs, restore, tangent_norm,
+            tol, method=method, max_rejects=max_rejects)
+
+        for n in xrange(1, self.N + 1):
+            self.A[n] = A[n]
+        self.rk_accepted += 1
+        self.rk_rejected += rejects
+
+        return dtau, dtau_next
+
     def add_noise(self, fac, n_i=-1, n_f=-1):
         """Adds some random noise of a given order to the state matrices A
         This can be used to determine the influence of numerical innaccuracies
@@ -853,11 +893,7 @@ class EvoMPS_TDVP_Sandwich:
         if finish < 0:
             finish = self.N + 1
         for n in xrange(start, finish + 1):
-            self.l[n] = sp.asarray(self.l[n])
-            self.l[n].fill(0)
-
-            for s in xrange(self.q[n]):
-                self.l[n] += mm.mmul(mm.H(self.A[n][s]), self.l[n - 1], self.A[n][s])
+            self.l[n] = self.eps_l(n, self.l[n - 1])
 
     def calc_r(self, n_low=-1, n_high=-1):
         """Updates the r matrices using the current state.
@@ -883,8 +919,9 @@ class EvoMPS_TDVP_Sandwich:
             The site number.
         x : ndarray
             The argument matrix. For example, using r[n] (and o=None) gives a result r[n - 1]
-        o : function
+        o : function or ndarray
             The single-site operator to use. May be None.
+            See tdvp_common.get_op_array().
 
         Returns
         -------
@@ -896,19 +933,18 @@ class EvoMPS_TDVP_Sandwich:
         elif n < 0:
             n = 0
 
-        res = sp.zeros((self.D[n - 1], self.D[n - 1]), dtype=self.typ)
+        if not o is None:
+            o = tm.get_op_array(o, (self.q[n], self.q[n]), n)
+            typ = sp.result_type(self.typ, o.dtype)
+        else:
+            typ = self.typ
+
+        res = sp.zeros((self.D[n - 1], self.D[n - 1]), dtype=typ)
 
         if o is None:
-            for s in xrange(self.q[n]):
-                res += mm.mmul(self.A[n][s], x, mm.H(self.A[n][s]))
+            tm.eps_r_noop(x, self.A[n], self.A[n], out=res)
         else:
-            A = self.A[n]
-            for s in xrange(self.q[n]):
-                Ash = mm.H(A[s])
-                for t in xrange(self.q[n]):
-                    o_st = o(n, s, t)
-                    if o_st != 0:
-                        res += o_st * A[t].dot(x.dot(Ash))
+            tm.eps_r_op_1s(sp.asarray(x), self.A[n], self.A[n], o, out=res)
         return res
 
     def eps_r_2s(self, n, x, op, A1=None, A2=None, A3=None, A4=None):
@@ -930,25 +966,12 @@ class EvoMPS_TDVP_Sandwich:
         if A4 is None:
             A4 = self.A[m]
 
-        res = sp.zeros((A1.shape[1], A1.shape[1]), dtype=self.typ)
-        subres = sp.zeros_like(A1[0])
+        op = tm.get_op_array(op, (self.q[n], self.q[m], self.q[n], self.q[m]), n)
         
-        H = mm.H
-
-        for u in xrange(self.q[n]):
-            A3u = A3[u]
-            for v in xrange(self.q[m]):
-                AAuvH = H(A3u.dot(A4[v]))
-                subres.fill(0)
-                for s in xrange(self.q[n]):
-                    A1s = A1[s]
-                    for t in xrange(self.q[m]):
-                        opval = op(n, u, v, s, t)
-                        if opval != 0:
-                            subres += opval * A1s.dot(A2[t])
-                res += subres.dot(x.dot(AAuvH))
+        AA12 = tm.calc_AA(A1, A2)
+        AA34 = tm.calc_AA(A3, A4)
 
-        return res
+        return tm.eps_r_op_2s_AA12_AA34(sp.asarray(x), AA12, AA34, op)
 
     def eps_l(self, n, x):
         """Implements the left epsilon map
@@ -972,11 +995,9 @@ class EvoMPS_TDVP_Sandwich:
         elif n < 0:
             n = 0
 
-        res = sp.zeros_like(self.l[n])
+        res = sp.empty((self.D[n], self.D[n]), dtype=self.typ)
 
-        for s in xrange(self.q[n]):
-            res += mm.mmul(mm.H(self.A[n][s]), x, self.A[n][s])
-        return res
+        return tm.eps_l_noop(x, self.A[n], self.A[n], out=res)
 
     def restore_ONR_n(self, n, G_n_i):
         """Transforms a single A[n] to obtain right orthonormalization.
@@ -1360,12 +1381,13 @@ class EvoMPS_TDVP_Sandwich:
         A single-site operator is represented as a function taking three
         integer arguments (n, s, t) where n is the site number and s, t
         range from 0 to q[n] - 1 and define the requested matrix element <s|o|t>.
+        Alternatively, it may be given as an ndarray o[s, t] = <s|o|t>.
 
         Assumes that the state is normalized.
 
         Parameters
         ----------
-        o : function
+        o : function or ndarray
             The operator.
         n : int
             The site number.
@@ -1441,13 +1463,10 @@ class EvoMPS_TDVP_Sandwich:
         
         Can be used to create excitations.
         """
-        newA = sp.zeros_like(self.A[n])
-
-        for s in xrange(self.q[n]):
-            for t in xrange(self.q[n]):
-                newA[s] += self.A[n][t] * o(n, s, t)
+        o = tm.get_op_array(o, (self.q[n], self.q[n]), n)
+        newA = tm.apply_op_1s(o, self.A[n])
 
-        self.A[n] = newA
+        self.A[n] = sp.asarray(newA, dtype=self.typ, order=self.odr)
 
     def save_state(self, file_name, userdata=None):
         tosave = sp.empty((9), dtype=sp.ndarray)
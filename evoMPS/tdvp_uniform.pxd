@@ -7,7 +7,7 @@ Created on Sat Jun  2 18:29:31 2012
 """
 import cython
 cimport numpy as np
-cimport tdvp_common as tc
+cimport tdvp_calc_C as tc
 
 #np.ndarray[np.complex128_t, ndim=3]
 
@@ -16,35 +16,61 @@ cdef class EvoMPS_TDVP_Uniform:
     cdef public int D
 
     #odr = 'C'
-    #typ = sp.complex128
+    cdef public object typ, typ_hp
     cdef public float eps
     
     cdef public float itr_rtol
     cdef public float itr_atol
     
+    cdef public bint ev_use_arpack
+    cdef public object ev_arpack_ncv
+    
+    cdef public object PPinv_solver
+    cdef public int PPinv_precond_k
+    cdef public bint PPinv_recycle
+    cdef public int PPinv_dense_max_D
+    
     cdef public object h_nn
     cdef public object h_nn_cptr
     
     cdef public bint symm_gauge
     
+    cdef public bint Vsh_implicit
+    
+    cdef public int roots_cache_hits, roots_cache_misses
+    cdef public int Vsh_cache_hits, Vsh_cache_misses
+    
+    cdef public int rk_accepted, rk_rejected
+    cdef public float rk_err
+    
+    cdef public int itr_krylov
+    
     cdef public bint sanity_checks
     cdef public int check_fac
     
     cdef public bint conv_l, conv_r
+    cdef public int lr_fail_count
     cdef public int itr_l, itr_r
+    cdef public int itr_K, itr_K_l
+    cdef public float res_l, res_r
     
     cdef public object userdata
     
-    cdef public np.complex128_t h
-    cdef public np.complex128_t eta
+    cdef public object h, eta #real if typ is
     cdef public float S_hc
     
     cdef public object A, l, r, K, K_left
+    cdef public object charges
     cdef object AA, C, tmp
     cdef object l_sqrt, l_sqrt_i, r_sqrt, r_sqrt_i
     cdef object Vsh, x
+    cdef object _E_spec_cache
+    cdef object _K_outer_v, _K_l_outer_v
+    cdef object _PPinv_dense_cache
+    cdef object _roots_cache
+    cdef object _h_nn_arr_cache
+    cdef object _h_nn_sparse_cache
     
-    @cython.locals(s = cython.int, t = cython.int)
     cpdef calc_AA(self)
     
     @cython.locals(i = cython.int)
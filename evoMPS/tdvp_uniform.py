@@ -12,10 +12,12 @@ import scipy.sparse.linalg as las
 import scipy.optimize as opti
 import nullspace as ns
 import matmul as m
+import tdvp_common as tm
+import symmetry as sy
 import math as ma
 
 try:
-    import tdvp_common as tc
+    import tdvp_calc_C as tc
 except ImportError:
     tc = None
     print "Warning! Cython version of Calc_C was not available. Performance may suffer for large q."
@@ -34,29 +36,44 @@ class PPInvOp:
     
     left = False
     
-    def __init__(self, tdvp, p=0, left=False):
+    blocks = False
+    
+    def __init__(self, tdvp, p=0, left=False, dtype=None, blocks=False):
         self.tdvp = tdvp
         self.l = tdvp.l
         self.r = tdvp.r
-        self.p = 0
+        self.p = p
         self.left = left
+        self.blocks = blocks
         
         self.D = tdvp.D
         
         self.shape = (self.D**2, self.D**2)
         
-        self.dtype = tdvp.typ
+        if dtype is None:
+            dtype = tdvp.typ
+        self.dtype = np.dtype(dtype)
         
-        self.out = np.empty_like(self.l)
+        self.out = np.empty((self.D, self.D), dtype=self.dtype)
+        
+        self.calls = 0
     
     def matvec(self, v):
         x = v.reshape((self.D, self.D))
         
+        self.calls += 1
+        
         if self.left:
-            xE = self.tdvp._eps_l_noop_dense_A(x, self.out)
+            if self.blocks:
+                xE = self.tdvp._eps_l_noop_blocks(x, self.out)
+            else:
+                xE = self.tdvp._eps_l_noop_dense_A(x, self.out)
             QEQ = xE - m.H(self.l) * m.adot(self.r, x)
         else:
-            Ex = self.tdvp._eps_r_noop_dense_A(x, self.out)
+            if self.blocks:
+                Ex = self.tdvp._eps_r_noop_blocks(x, self.out)
+            else:
+                Ex = self.tdvp._eps_r_noop_dense_A(x, self.out)
             QEQ = Ex - self.r * m.adot(self.l, x)        
         
         
@@ -66,39 +83,155 @@ class PPInvOp:
         res = x - QEQ
         
         return res.ravel()
+        
+    def todense(self):
+        """Returns the operator as a dense D**2 x D**2 matrix.
+        
+        Only sensible for small D. The matrix is built in self.dtype, 
+        promoted to complex if p != 0.
+        """
+        typ = self.dtype
+        if not self.p == 0:
+            typ = np.promote_types(typ, np.complex64)
+        A = np.asarray(self.tdvp.A, dtype=typ)
+        E = np.zeros(self.shape, dtype=typ)
+        for s in xrange(A.shape[0]):
+            E += np.kron(A[s], A[s].conj())
+            
+        l = np.asarray(self.l)
+        r = np.asarray(self.r)
+        if self.left:
+            QEQ = m.H(E) - np.outer(m.H(l).ravel(), r.ravel().conj())
+        else:
+            QEQ = E - np.outer(r.ravel(), l.ravel().conj())
+        
+        if not self.p == 0:
+            QEQ *= np.exp(1.j * self.p)
+        
+        return np.eye(self.shape[0], dtype=typ) - QEQ
+        
+class PPInvPrecondOp:
+    """A preconditioner for PPInvOp that acts as the exact inverse on the
+    subspace spanned by some eigenvectors of the transfer matrix E (other
+    than the dominant one, which is projected out by Q).
+    
+    On the eigenvector V[i] with eigenvalue ev[i], 1 - e^(ip) QEQ is just
+    the number 1 - e^(ip) ev[i]. The corresponding left eigenvectors W[i]
+    are needed to project onto V[i].
+    """
+    def __init__(self, ev, V, W, p=0):
+        self.D = V.shape[1]
+        self.shape = (self.D**2, self.D**2)
+        self.dtype = V.dtype
+        
+        self.V = V
+        self.W = np.empty_like(W)
+        self.c = np.empty(len(ev), dtype=self.dtype)
+        for i in xrange(len(ev)):
+            self.W[i] = W[i] / m.adot(V[i], W[i]) #biorthonormalize
+            evp = np.exp(1.j * p) * ev[i]
+            self.c[i] = evp / (1 - evp)
+            
+    def matvec(self, v):
+        x = v.reshape((self.D, self.D))
+        
+        res = x.copy()
+        for i in xrange(len(self.c)):
+            res += (self.c[i] * m.adot(self.W[i], x)) * self.V[i]
+            
+        return res.ravel()
 
 class HTangentOp:
+    """The effective Hamiltonian for momentum p on the tangent space, for use
+    with the eigensolvers in scipy.sparse.linalg.
+    
+    Vectors are the parameter matrices x of the tangent vectors B(x) (see
+    get_B_from_x()) in raveled form. Since the tangent vectors are 
+    parametrized such that the effective norm matrix is the identity, the
+    eigenvalues of this operator are the excitation energies of the 
+    quasi-particle ansatz.
+    
+    The number of calls to matvec() is recorded in calls.
+    """
     tdvp = None
-    ppinvop = None
     p = 0
     
     def __init__(self, tdvp, p):
         self.tdvp = tdvp
         self.p = p
-        self.ppinvop = PPInvOp(tdvp, p)
         
-        self.shape = (tdvp.D**2, tdvp.D**2)
-        self.dtype = tdvp.typ        
+        q = tdvp.q
+        self.h_nn = tdvp._get_h_nn_array()
+        
+        self.x_shape = (tdvp.D, (q - 1) * tdvp.D)
+        self.shape = ((q - 1) * tdvp.D**2, (q - 1) * tdvp.D**2)
+        #The tangent vectors are complex for nonzero momenta, even if the
+        #state is real.
+        self.dtype = np.result_type(tdvp.typ_hp, np.complex64)
+        
+        self.calls = 0
         
     def matvec(self, v):
-        x = v.reshape((self.tdvp.D, self.tdvp.D * (self.tdvp.q)))
+        x = v.reshape(self.x_shape)
+        
+        self.calls += 1
         
-        self.tdvp.calc_BHB(x)                
+        res = self.tdvp.calc_BHB(x, self.p, h_nn=self.h_nn)
+        
+        return res.ravel()
         
 class EvoMPS_TDVP_Uniform:
     odr = 'C'
-    typ = np.complex128
         
-    def __init__(self, D, q):
+    def __init__(self, D, q, dtype=np.complex128):
+        """Creates a new uniform MPS with bond dimension D and local 
+        Hilbert space dimension q.
+        
+        The dtype of the parameters can be set to float64 for imaginary 
+        time evolution with a real Hamiltonian, or to complex64 for fast,
+        less accurate simulations (see tdvp_common.check_dtype()). 
+        Otherwise, it should be complex128.
+        
+        In single precision, A, AA, C and K are stored as complex64, while
+        l and r, which determine the normalization and the gauge, are 
+        computed and stored in double precision (typ_hp), as are the 
+        solutions of calc_PPinv(). The default tolerances itr_rtol and 
+        itr_atol are relaxed accordingly. Single precision becomes unstable
+        if the smallest eigenvalues of l (in canonical form) drop far below
+        the single-precision epsilon, which happens when D is much larger
+        than the state requires.
+        """
+        self.typ = tm.check_dtype(dtype)
+        self.typ_hp = tm.high_precision_dtype(self.typ)
+        
+        self.itr_rtol, self.itr_atol = tm.default_tolerances(self.typ)
         
-        self.itr_rtol = 1E-13
-        self.itr_atol = 1E-14
+        self.ev_use_arpack = False
+        self.ev_arpack_ncv = None
+        
+        self.PPinv_solver = 'bicgstab'
+        self.PPinv_dense_max_D = 16
+        self.PPinv_precond_k = 0
+        self.PPinv_recycle = False
         
         self.h_nn = None    
         self.h_nn_cptr = None
         
         self.symm_gauge = False
         
+        self.Vsh_implicit = False
+        
+        self.roots_cache_hits = 0
+        self.roots_cache_misses = 0
+        self.Vsh_cache_hits = 0
+        self.Vsh_cache_misses = 0
+        
+        self.rk_accepted = 0
+        self.rk_rejected = 0
+        self.rk_err = 0
+        
+        self.itr_krylov = 0
+        
         self.sanity_checks = False
         self.check_fac = 50
         
@@ -106,6 +239,7 @@ class EvoMPS_TDVP_Uniform:
         
         self.eps = np.finfo(self.typ).eps
         
+        self.h = 0
         self.eta = 0
         
         self._init_arrays(D, q)
@@ -118,6 +252,83 @@ class EvoMPS_TDVP_Uniform:
 
     def randomize(self, fac=0.5):
         m.randomize_cmplx(self.A, a=-fac, b=fac)
+        if not self.charges is None:
+            self.A[:] = self.charges.project(self.A)
+            
+    def set_charges(self, qn_phys, qn_virt, modulus=None):
+        """Restricts the state to have a conserved U(1) or Z_n charge.
+        
+        A is then kept in block-sparse form (see the symmetry module) and 
+        the computation of l, r and K, as well as calc_C(), calc_B() and 
+        restore_CF(), operate blockwise, which reduces the cost of each 
+        contraction by about the number of charge sectors. The public 
+        eps_r() and eps_l() remain dense, since their argument may carry
+        charge. The Hamiltonian h_nn must conserve the charge. The state is
+        replaced by a random symmetric state. Excitations (see 
+        calc_excitations()) are not supported.
+        
+        Since the state is uniform, A[s] maps the virtual charge c to 
+        c + qn_phys[s] and the same charges are used on both virtual 
+        indices. The charges must be chosen to suit the state. For the 
+        spin-1 Heisenberg chain, for example, the virtual spins are 
+        half-integers, so one may use qn_phys = [2, 0, -2] (twice S_z) and 
+        odd virtual charges.
+        
+        The charges are discarded if the arrays are reinitialized, for 
+        example by expand_D().
+        
+        Parameters
+        ----------
+        qn_phys : ndarray
+            The integer charges of the q physical basis states.
+        qn_virt : ndarray
+            The integer charges of the D virtual basis states. These are
+            sorted, so that each sector is a contiguous range of indices.
+        modulus : int
+            For a Z_n charge, n. The charges are then added modulo n. If 
+            None, the charge is a U(1) charge.
+        """
+        if len(qn_phys) != self.q or len(qn_virt) != self.D:
+            raise ValueError("The charges do not match q and D!")
+            
+        ci = sy.ChargeIndex(qn_virt, modulus=modulus)
+        self.charges = sy.BlockStructure(qn_phys, ci, ci)
+        
+        self.l = np.eye(self.D, dtype=self.typ_hp)
+        self.r = np.eye(self.D, dtype=self.typ_hp)
+        self.K = np.zeros_like(self.A[0])
+        self.K_left = None
+        self._K_outer_v = []
+        self._K_l_outer_v = []
+        self._roots_cache = {}
+        
+        self.randomize()
+        
+    def set_parity(self, par_phys, par_virt=None):
+        """Restricts the state to have a conserved Z_2 parity.
+        
+        This is set_charges() with modulus 2. A then consists of two 
+        blocks for each physical basis state, so that the contractions 
+        cost about half as much as for a generic state.
+        
+        The parity must be diagonal in the physical basis. For the 
+        transverse Ising model with -J sigma_x sigma_x - h sigma_z, for 
+        example, the basis states of sigma_z have parities [0, 1]. Note 
+        that a state with this symmetry cannot break it spontaneously, as 
+        the ground state does in the ordered phase (h < J).
+        
+        Parameters
+        ----------
+        par_phys : ndarray
+            The parities (0 or 1) of the q physical basis states.
+        par_virt : ndarray
+            The parities of the D virtual basis states. By default, half 
+            of them are even and half odd.
+        """
+        if par_virt is None:
+            par_virt = [0] * (self.D - self.D // 2) + [1] * (self.D // 2)
+            
+        self.set_charges(par_phys, par_virt, modulus=2)
     
     def _init_arrays(self, D, q):
         self.D = D
@@ -131,23 +342,51 @@ class EvoMPS_TDVP_Uniform:
         self.K = np.ones_like(self.A[0])
         self.K_left = None
         
-        self.l = np.ones_like(self.A[0])
-        self.r = np.ones_like(self.A[0])
+        self.l = np.ones((D, D), dtype=self.typ_hp)
+        self.r = np.ones((D, D), dtype=self.typ_hp)
         self.conv_l = True
         self.conv_r = True
+        self.lr_fail_count = 0
+        self.itr_l = 0
+        self.itr_r = 0
+        self.itr_K = 0
+        self.itr_K_l = 0
+        self.res_l = 0
+        self.res_r = 0
+        
+        self.tmp = np.empty((D, D), dtype=self.typ_hp)
+        
+        self._E_spec_cache = {}
         
-        self.tmp = np.empty_like(self.A[0])
+        self._K_outer_v = []
+        self._K_l_outer_v = []
+        
+        self._PPinv_dense_cache = None
+        
+        self._roots_cache = {}
+        
+        self._h_nn_arr_cache = None
+        
+        self._h_nn_sparse_cache = None
+        
+        self.charges = None
            
     def _eps_r_noop_dense_A(self, x, out):
         """The right epsilon map, optimized for efficiency.
         """
-        A = self.A
-        out.fill(0)
-        dot = np.dot
-        for s in xrange(self.q):
-            out += dot(A[s], dot(x, A[s].conj().T))
+        return tm.eps_r_noop(x, self.A, self.A, out=out)
         
-        return out
+    def _eps_r_noop_blocks(self, x, out):
+        """The right epsilon map for an x that carries no charge, such as
+        l, r or K, and is therefore block-diagonal if charges are set. 
+        
+        The map is then applied blockwise. Elements of x outside the 
+        diagonal blocks are ignored, so a general x must be passed to 
+        _eps_r_noop_dense_A() instead.
+        """
+        if not self.charges is None:
+            return sy.eps_r_noop(x, self.A, self.A, self.charges, out=out)
+        return tm.eps_r_noop(x, self.A, self.A, out=out)
         
     def eps_r(self, x, A1=None, A2=None, op=None, out=None):
         """Implements the right epsilon map
@@ -156,8 +395,8 @@ class EvoMPS_TDVP_Uniform:
         
         Parameters
         ----------
-        op : function
-            The single-site operator to use.
+        op : function or ndarray
+            The single-site operator to use (see tdvp_common.get_op_array()).
         out : ndarray
             A matrix to hold the result (with the same dimensions as r).
         x : ndarray
@@ -168,69 +407,84 @@ class EvoMPS_TDVP_Uniform:
         res : ndarray
             The resulting matrix.
         """
+        if not op is None:
+            op = tm.get_op_array(op, (self.q, self.q))
+            
         if out is None:
-            out = np.zeros_like(self.A[0])
+            if op is None:
+                out = np.zeros((self.D, self.D), dtype=self.typ_hp)
+            else:
+                out = np.zeros((self.D, self.D), 
+                               dtype=np.result_type(self.typ_hp, op.dtype))
         else:
             out.fill(0.)
             
+        if op is None and A1 is None and A2 is None:
+            return self._eps_r_noop_dense_A(x, out)
+            
         if A1 is None:
             A1 = self.A
         if A2 is None:
             A2 = self.A
             
         if op is None:
-            for s in xrange(self.q):
-                out += m.mmul(A1[s], x, m.H(A2[s]))
+            tm.eps_r_noop(x, A1, A2, out=out)
         else:
-            for s in xrange(self.q):
-                for t in xrange(self.q):
-                    o_st = op(s, t)
-                    if o_st != 0.:
-                        tmp = m.mmul(A1[t], x, m.H(A2[s]))
-                        tmp *= o_st
-                        out += tmp
+            tm.eps_r_op_1s(np.asarray(x), A1, A2, op, out=out)
         return out
         
     def _eps_l_noop_dense_A(self, x, out):
         """The left epsilon map, optimized for efficiency.
         """
-        A = self.A
-        out.fill(0)
-        dot = np.dot
-        for s in xrange(self.q):
-            out += dot(A[s].conj().T, dot(x, A[s]))
-            
-        return out
+        return tm.eps_l_noop(x, self.A, self.A, out=out)
         
-    def eps_l(self, x, out=None):
-        if out is None:
-            out = np.zeros_like(self.A[0])
-        else:
-            out.fill(0.)
-            
-        for s in xrange(self.q):
-            out += m.mmul(m.H(self.A[s]), x, self.A[s])        
-            
-        return out
+    def _eps_l_noop_blocks(self, x, out):
+        """The left epsilon map for a block-diagonal x (see 
+        _eps_r_noop_blocks()).
+        """
+        if not self.charges is None:
+            return sy.eps_l_noop(x, self.A, self.A, self.charges, out=out)
+        return tm.eps_l_noop(x, self.A, self.A, out=out)
         
-    def calc_AA(self):
-        dot = np.dot
-        A = self.A
-        AA = self.AA
-        for s in xrange(self.q):
-            for t in xrange(self.q):
-                AA[s, t] = dot(A[s], A[t])
-                #Use dot() because A[s] is always a dense matrix
+    def eps_l(self, x, out=None):
+        """Implements the left epsilon map
         
-        #Note: This could be cythonized, calling BLAS from C    
+        Parameters
+        ----------
+        x : ndarray
+            The argument matrix.
+        out : ndarray
+            A matrix to hold the result (with the same dimensions as l).
+    
+        Returns
+        -------
+        res : ndarray
+            The resulting matrix.
+        """
+        return self._eps_l_noop_dense_A(x, out)
         
-        #This works too: (just for reference)
-        #AA = np.array([dot(A[s], A[t]) for s in xrange(self.q) for t in xrange(self.q)])
-        #self.AA = AA.reshape(self.q, self.q, self.D, self.D)
+    def calc_AA(self):
+        if not self.charges is None:
+            self.AA = sy.calc_AA(self.A, self.A, self.charges, self.charges,
+                                 out=self.AA)
+        else:
+            self.AA = tm.calc_AA(self.A, self.A, out=self.AA)
         
     def eps_r_2s(self, x, op, A1=None, A2=None, A3=None, A4=None):
-        res = np.zeros_like(self.A[0])
+        """Implements the right epsilon map for a nearest-neighbour operator.
         
+        Parameters
+        ----------
+        x : ndarray
+            The argument matrix.
+        op : function or ndarray
+            The two-site operator to use (see tdvp_common.get_op_array()).
+    
+        Returns
+        -------
+        res : ndarray
+            The resulting matrix.
+        """
         if A1 is None:
             A1 = self.A
         if A2 is None:
@@ -240,53 +494,63 @@ class EvoMPS_TDVP_Uniform:
         if A4 is None:
             A4 = self.A
             
-        if (A1 is self.A) and (A2 is self.A) and (A3 is self.A) and (A4 is self.A):
-            for u in xrange(self.q):
-                for v in xrange(self.q):
-                    subres = np.zeros_like(self.A[0])
-                    for s in xrange(self.q):
-                        for t in xrange(self.q):
-                            opval = op(u, v, s, t)
-                            if opval != 0:
-                                subres += opval * self.AA[s, t]
-                    res += m.mmul(subres, x, m.H(self.AA[u, v]))
+        op = tm.get_op_array(op, (self.q, self.q, self.q, self.q))
+        
+        if (A1 is self.A) and (A2 is self.A):
+            AA12 = self.AA
         else:
-            AAuvH = np.empty_like(self.A[0])
-            for u in xrange(self.q):
-                for v in xrange(self.q):
-                    AAuvH = m.H(m.mmul(A3[u], A4[v]), out=AAuvH)
-                    subres = np.zeros_like(self.A[0])
-                    for s in xrange(self.q):
-                        for t in xrange(self.q):
-                            opval = op(u, v, s, t)
-                            if opval != 0:
-                                subres += opval * np.dot(A1[s], A2[t])
-                    res += m.mmul(subres, x, AAuvH)
-                    
-        return res
+            AA12 = tm.calc_AA(A1, A2)
+            
+        if (A3 is self.A) and (A4 is self.A):
+            AA34 = self.AA
+        else:
+            AA34 = tm.calc_AA(A3, A4)
+            
+        return tm.eps_r_op_2s_AA12_AA34(np.asarray(x), AA12, AA34, op)
 
-    def _calc_lr_brute(self):
-        E = np.zeros((self.D**2, self.D**2), dtype=self.typ, order='C')
-        
-        for s in xrange(self.q):
-            E += sp.kron(self.A[s], self.A[s].conj())
+    def _calc_lr_brute(self, tmp=None, calc_l=True, calc_r=True, 
+                       max_itr=1000):
+        """Fallback for when the iterative solvers in calc_lr() fail to 
+        converge.
+        
+        Uses restarted Arnoldi (ARPACK) with a random starting vector and
+        an enlarged Krylov subspace, which copes much better with a small 
+        gap between the largest eigenvalues of the transfer matrix than 
+        power iteration does. The transfer matrix is never formed, so that 
+        this scales like the other solvers (O(q D^3) per step) rather than 
+        requiring O(D^4) memory.
+        
+        The outcome is reported via conv_l and conv_r (and res_l, res_r).
+        The matrix-vector products used are added to itr_l and itr_r.
+        """
+        if tmp is None:
+            tmp = np.empty_like(self.tmp)
+        
+        ncv = min(self.D**2, 40)
+        
+        if calc_l:
+            self.l = np.asarray(self.l)
+            self.l, self.conv_l, itr, self.res_l = self._calc_lr_ARPACK(self.l, 
+                                                        tmp, calc_l=True,
+                                                        tol=self.itr_rtol,
+                                                        ncv=ncv,
+                                                        max_itr=max_itr,
+                                                        warm_start=False)
+            self.itr_l += itr
+            if self.sanity_checks and not self.conv_l:
+                print "Sanity check failed: Left eigenvector did not converge!"
             
-        ev, eVL, eVR = la.eig(E, left=True, right=True)
-        
-        i = np.argmax(ev)
-        
-        self.A *= 1 / sp.sqrt(ev[i])        
-        
-        self.l = eVL[:,i].reshape((self.D, self.D))
-        self.r = eVR[:,i].reshape((self.D, self.D))
-        
-        norm = m.adot(self.l, self.r)
-        self.l *= 1 / sp.sqrt(norm)
-        self.r *= 1 / sp.sqrt(norm)        
-        
-        print "Sledgehammer:"
-        print "Left ok?: " + str(np.allclose(self.eps_l(self.l), self.l))
-        print "Right ok?: " + str(np.allclose(self.eps_r(self.r), self.r))
+        if calc_r:
+            self.r = np.asarray(self.r)
+            self.r, self.conv_r, itr, self.res_r = self._calc_lr_ARPACK(self.r, 
+                                                        tmp, calc_l=False,
+                                                        tol=self.itr_rtol,
+                                                        ncv=ncv,
+                                                        max_itr=max_itr,
+                                                        warm_start=False)
+            self.itr_r += itr
+            if self.sanity_checks and not self.conv_r:
+                print "Sanity check failed: Right eigenvector did not converge!"
         
     def _calc_lr(self, x, eps, tmp, max_itr=2000, rtol=1E-14, atol=1E-14):
         """Power iteration to obtain eigenvector corresponding to largest
@@ -295,8 +559,10 @@ class EvoMPS_TDVP_Uniform:
            The contents of the starting vector x is modifed.
            
            Why do we require more iterations for larger q and D?
+           (The convergence rate is set by the ratio of the two largest
+           eigenvalues of E. See _calc_lr_ARPACK() for an alternative.)
         """
-        norm = la.fblas.dznrm2 #NOTE: assuming complex128
+        norm = la.get_blas_funcs('nrm2', (x,))
         #allclose = np.allclose
         
         x *= 1/norm(x.ravel())
@@ -305,7 +571,8 @@ class EvoMPS_TDVP_Uniform:
             ev = norm(tmp.ravel())
             tmp *= (1 / ev)
             #if allclose(tmp, x, atol=atol, rtol=rtol): #allclose is SLOW!
-            if norm((tmp - x).ravel()) < atol:
+            res = norm((tmp - x).ravel())
+            if res < atol:
                 x[:] = tmp
                 break
             x[:] = tmp
@@ -318,7 +585,110 @@ class EvoMPS_TDVP_Uniform:
                 if not abs(ev - 1) < atol:
                     print "Sanity check failed: Largest ev after re-scale = %g" % ev
         
-        return x, i < max_itr - 1, i
+        return x, i < max_itr - 1, i, res
+        
+    def _calc_lr_ARPACK(self, x, tmp, calc_l=False, tol=1E-14, ncv=None, k=1,
+                        max_itr=None, warm_start=True):
+        """Uses the implicitly restarted Arnoldi method (ARPACK) to obtain the
+           eigenvector corresponding to the largest eigenvalue.
+           
+           The transfer matrix is not formed explicitly. The contents of
+           the starting vector x is used as an initial guess (if warm_start)
+           and is modified. More than one (k) eigenvalue may be requested,
+           which can help convergence when the gap is small.
+           
+           Returns the eigenvector, whether ARPACK converged, the number of 
+           applications of the transfer matrix and the residual 
+           |E(x) / ev - x| (with |x| = 1).
+        """
+        if self.D**2 < 3: #ARPACK requires k < n - 1
+            if calc_l:
+                eps = self._eps_l_noop_blocks
+            else:
+                eps = self._eps_r_noop_blocks
+            return self._calc_lr(x, eps, tmp, rtol=tol, atol=tol)
+        
+        norm = la.get_blas_funcs('nrm2', (x,))
+        
+        opE = tm.EOp(self.A, self.A, calc_l, dtype=self.typ_hp, 
+                     bs=self.charges)
+        
+        if warm_start:
+            x *= 1 / norm(x.ravel())
+            v0 = x.ravel()
+        else:
+            v0 = None
+        
+        try:
+            #E is a positive map, so its spectral radius is an eigenvalue.
+            #There may be others of equal magnitude (e.g. -1 for a state
+            #with period two), so we choose the largest real part.
+            ev, eV = las.eigs(opE, k=k, which='LR', v0=v0, tol=tol, 
+                              ncv=ncv, maxiter=max_itr)
+            conv = True
+        except las.ArpackNoConvergence as e:
+            ev, eV = e.eigenvalues, e.eigenvectors
+            conv = False
+            
+        if len(ev) > 0:
+            i = np.argmax(ev.real)
+            ev = ev[i].real
+            eV = eV[:, i].reshape((self.D, self.D))
+            
+            #The eigenvector is positive definite up to a phase. Remove it.
+            tr = eV.trace()
+            eV *= abs(tr) / tr
+            if not np.iscomplexobj(x):
+                eV = eV.real
+            x[:] = eV / norm(eV.ravel())
+        else:
+            x *= 1 / norm(x.ravel())
+            ev = norm(opE.matvec(x.ravel()))
+        
+        opE.matvec(x.ravel())
+        res = norm((opE.out / ev - x).ravel())
+        
+        #re-scale
+        if not abs(ev - 1) < tol:
+            self.A *= 1 / ma.sqrt(ev)
+            if self.sanity_checks:
+                ev = norm(opE.matvec(x.ravel()))
+                if not abs(ev - 1) < tol:
+                    print "Sanity check failed: Largest ev after re-scale = %g" % ev
+        
+        return x, conv, opE.calls, res
+    
+    def _handle_lr_failure(self):
+        """Called when l or r have not converged in several consecutive
+        calls to calc_lr(), even with the fallback solver.
+        
+        A common cause is a degenerate dominant eigenvalue of the transfer
+        matrix, as for a non-injective (reducible) state. In complex 
+        arithmetic, round-off errors usually break the degeneracy, but for
+        a real state it can persist. In that case, the state is perturbed
+        slightly and True is returned, so that l and r can be recomputed.
+        Otherwise, a warning is printed and False is returned.
+        """
+        ev = self.calc_E_spectrum(k=2)
+        degen = len(ev) > 1 and abs(ev[1] / ev[0]) >= 1 - 1E-8
+        
+        if degen and not np.iscomplexobj(self.A):
+            print ("Warning: l and r did not converge in %u steps and the "
+                   "largest eigenvalue of the transfer matrix is degenerate."
+                   " Perturbing the state." % self.lr_fail_count)
+            dA = m.randomize_cmplx(np.empty_like(self.A), a=-1, b=1)
+            if not self.charges is None:
+                dA = self.charges.project(dA)
+            self.A += (1E-6 * abs(self.A).max()) * dA
+            self.lr_fail_count = 0
+            return True
+        
+        print ("Warning: l and r did not converge in %u steps. "
+               "The state may not be injective%s." 
+               % (self.lr_fail_count, 
+                  "" if np.iscomplexobj(self.A) else 
+                  ", try dtype=complex128"))
+        return False
     
     def calc_lr(self):        
         tmp = np.empty_like(self.tmp)
@@ -327,17 +697,47 @@ class EvoMPS_TDVP_Uniform:
 
         self.r = np.asarray(self.r)
         
-        self.l, self.conv_l, self.itr_l = self._calc_lr(self.l, 
-                                                        self._eps_l_noop_dense_A, 
+        if self.ev_use_arpack:
+            self.l, self.conv_l, self.itr_l, self.res_l = self._calc_lr_ARPACK(
+                                                        self.l, tmp,
+                                                        calc_l=True,
+                                                        tol=self.itr_rtol,
+                                                        ncv=self.ev_arpack_ncv)
+            
+            self.r, self.conv_r, self.itr_r, self.res_r = self._calc_lr_ARPACK(
+                                                        self.r, tmp,
+                                                        calc_l=False,
+                                                        tol=self.itr_rtol,
+                                                        ncv=self.ev_arpack_ncv)
+        else:
+            self.l, self.conv_l, self.itr_l, self.res_l = self._calc_lr(self.l, 
+                                                        self._eps_l_noop_blocks, 
                                                         tmp, 
                                                         rtol=self.itr_rtol, 
                                                         atol=self.itr_atol)
-        
-        self.r, self.conv_r, self.itr_r = self._calc_lr(self.r, 
-                                                        self._eps_r_noop_dense_A, 
+            
+            self.r, self.conv_r, self.itr_r, self.res_r = self._calc_lr(self.r, 
+                                                        self._eps_r_noop_blocks, 
                                                         tmp, 
                                                         rtol=self.itr_rtol, 
                                                         atol=self.itr_atol)
+        
+        if not (self.conv_l and self.conv_r):
+            self._calc_lr_brute(tmp, calc_l=not self.conv_l, 
+                                calc_r=not self.conv_r)
+            
+        if self.conv_l and self.conv_r:
+            self.lr_fail_count = 0
+        else:
+            self.lr_fail_count += 1
+            if self.lr_fail_count == 3 and self._handle_lr_failure():
+                return self.calc_lr()
+            
+        if not self.charges is None:
+            #Remove any (numerically small) parts violating the symmetry
+            self.l = self.charges.left.project(self.l)
+            self.r = self.charges.left.project(self.r)
+            
         #normalize eigenvectors:
 
         if self.symm_gauge:
@@ -401,25 +801,150 @@ class EvoMPS_TDVP_Uniform:
             if not np.allclose(norm, 1.0, atol=1E-13, rtol=0):
                 print "Sanity check failed: Bad norm = " + str(norm)
     
-    def restore_SCF(self):
-        X = la.cholesky(self.r, lower=True)
-        Y = la.cholesky(self.l, lower=False)
+    def calc_E_spectrum(self, k=2, ret_eV=False, tol=0, ncv=None, left=False):
+        """Computes the k largest-magnitude eigenvalues of the transfer 
+        matrix E, in the form of the right epsilon map eps_r().
+        
+        If left is True, the left epsilon map eps_l() is used instead. 
+        This is E^dagger, so that the eigenvalues are conjugated and the 
+        eigenvectors are the left eigenvectors of E.
+        
+        The transfer matrix is not formed explicitly unless D is so small
+        that ARPACK cannot be used (k >= D**2 - 1).
+        
+        The results are cached and reused until the A's change.
+        
+        Parameters
+        ----------
+        k : int
+            The number of eigenvalues to compute.
+        ret_eV : bool
+            Whether to also return the eigenvectors.
+        tol : float
+            Relative accuracy for the eigenvalues (0 = machine precision).
+        ncv : int
+            The number of Lanczos vectors to use (see scipy.sparse.linalg.eigs).
+        left : bool
+            Whether to use eps_l() instead of eps_r().
+            
+        Returns
+        -------
+        ev : ndarray
+            The eigenvalues, sorted by magnitude, largest first.
+        eV : ndarray
+            The corresponding eigenvectors as matrices eV[i] (if ret_eV).
+        """
+        k = min(k, self.D**2)
+        
+        c = self._E_spec_cache.get(left)
+        if (not c is None and c[1] >= k and c[2] <= tol 
+            and (c[4] is not None or not ret_eV) 
+            and np.array_equal(c[0], self.A)):
+            if ret_eV:
+                return c[3][:k], c[4][:k]
+            else:
+                return c[3][:k]
+        
+        conv = True
+        if k >= self.D**2 - 1:
+            E = np.zeros((self.D**2, self.D**2), dtype=self.typ_hp)
+            for s in xrange(self.q):
+                E += np.kron(self.A[s], self.A[s].conj())
+            if left:
+                E = m.H(E)
+            if ret_eV:
+                ev, eV = la.eig(E)
+            else:
+                ev = la.eigvals(E)
+        else:
+            opE = tm.EOp(self.A, self.A, left, dtype=self.typ_hp)
+            try:
+                res = las.eigs(opE, k=k, which='LM', tol=tol, ncv=ncv, 
+                               return_eigenvectors=ret_eV)
+            except las.ArpackNoConvergence as e:
+                print "Warning: Did not converge on transfer matrix eigenvalues!"
+                if ret_eV:
+                    res = (e.eigenvalues, e.eigenvectors)
+                else:
+                    res = e.eigenvalues
+                conv = False
+            if ret_eV:
+                ev, eV = res
+            else:
+                ev = res
+            
+        ind = np.argsort(abs(ev))[::-1][:k]
+        ev = ev[ind]
+        if ret_eV:
+            eV = eV[:, ind].T.reshape((len(ind), self.D, self.D))
+        else:
+            eV = None
+            
+        if conv:
+            self._E_spec_cache[left] = (self.A.copy(), k, tol, ev, eV)
+        
+        if ret_eV:
+            return ev, eV
+        else:
+            return ev
+            
+    def correlation_length(self, tol=1E-12):
+        """Computes the correlation length from the ratio of the two
+        largest-magnitude eigenvalues of the transfer matrix.
+        
+        This also determines the convergence rate of the power iteration
+        in calc_lr() and of the iterative solver in calc_PPinv().
+        
+        Parameters
+        ----------
+        tol : float
+            Ratios within tol of 0 or 1 are treated as exactly 0 or 1.
+        
+        Returns
+        -------
+        xi : float
+            The correlation length in units of the lattice spacing. This is
+            0 for a product state and inf if the dominant eigenvalue is 
+            degenerate (in magnitude), as for a non-injective state.
+        """
+        if self.D == 1:
+            return 0
+        
+        ev = self.calc_E_spectrum(k=2)
+        
+        ratio = abs(ev[1] / ev[0])
+        if ratio <= tol:
+            return 0
+        elif ratio >= 1 - tol:
+            return np.inf
         
-        U, sv, Vh = la.svd(Y.dot(X))
+        return -1 / ma.log(ratio)
+        
+    def restore_SCF(self, ret_g=False):
+        if self.charges is None:
+            X = la.cholesky(self.r, lower=True)
+            Y = la.cholesky(self.l, lower=False)
+            
+            U, sv, Vh = la.svd(Y.dot(X))
+        else:
+            ci = self.charges.left
+            X = sy.blockwise(lambda x: la.cholesky(x, lower=True), ci, self.r)
+            Y = sy.blockwise(la.cholesky, ci, self.l)
+            
+            U, sv, Vh = sy.svd(Y.dot(X), ci)
         
         #s contains the Schmidt coefficients,
         lam = sv**2
         self.S_hc = - np.sum(lam * sp.log2(lam))
         
-        S = m.simple_diag_matrix(sv, dtype=self.typ)
+        S = m.simple_diag_matrix(sv, dtype=self.typ_hp)
         Srt = S.sqrt()
         
         g = m.mmul(Srt, Vh, m.invtr(X, lower=True))
         
         g_i = m.mmul(m.invtr(Y, lower=False), U, Srt)
         
-        for s in xrange(self.q):
-            self.A[s] = m.mmul(g, self.A[s], g_i)
+        self._gauge_transform_A(g, g_i)
                 
         if self.sanity_checks:
             Sfull = np.asarray(S)
@@ -449,30 +974,52 @@ class EvoMPS_TDVP_Uniform:
 
         self.l = S
         self.r = S
+        
+        if ret_g:
+            return g, g_i
+        else:
+            return
     
     def restore_CF(self, ret_g=False):
+        """Restores canonical form using a gauge transformation, so that
+        r = eye and l is diagonal (or, if symm_gauge, l = r = diagonal).
+        
+        The transformation is also applied to K and K_left (and to any 
+        vectors kept for reuse by calc_PPinv()), so that they remain good
+        initial guesses for the next calc_K() and calc_K_l().
+        
+        If ret_g is True, the gauge transformation matrices G, G_i are 
+        returned, where A[s] -> G_i A[s] G.
+        """
         if self.symm_gauge:
-            self.restore_SCF()
+            G_i, G = self.restore_SCF(ret_g=True)
         else:
             #First get G such that r = eye
-            G = la.cholesky(self.r, lower=True)
+            if self.charges is None:
+                G = la.cholesky(self.r, lower=True)
+            else:
+                G = sy.blockwise(lambda x: la.cholesky(x, lower=True),
+                                 self.charges.left, self.r)
             G_i = m.invtr(G, lower=True)
 
             self.l = m.mmul(m.H(G), self.l, G)
             
             #Now bring l into diagonal form, trace = 1 (guaranteed by r = eye..?)
-            ev, EV = la.eigh(self.l)
+            if self.charges is None:
+                ev, EV = la.eigh(self.l)
+            else:
+                #The sectors must not be mixed in case of degeneracies
+                ev, EV = sy.eigh(self.l, self.charges.left)
             
             G = G.dot(EV)
             G_i = m.H(EV).dot(G_i)
             
-            for s in xrange(self.q):
-                self.A[s] = m.mmul(G_i, self.A[s], G)
+            self._gauge_transform_A(G_i, G)
                 
             #ev contains the squares of the Schmidt coefficients,
             self.S_hc = - np.sum(ev * sp.log2(ev))
             
-            self.l = m.simple_diag_matrix(ev, dtype=self.typ)
+            self.l = m.simple_diag_matrix(ev, dtype=self.typ_hp)
 
             if self.sanity_checks:
                 M = np.zeros_like(self.r)
@@ -508,32 +1055,228 @@ class EvoMPS_TDVP_Uniform:
                     print "Sanity check failed: Restore_RCF, bad l!"
                     print "Off by: " + str(la.norm(l - self.l))
         
-            self.r = m.eyemat(self.D, dtype=self.typ)
+            self.r = m.eyemat(self.D, dtype=self.typ_hp)
+        
+        #K transforms like r, K_left like l.
+        self.K = np.asarray(m.mmul(G_i, self.K, m.H(G_i)), dtype=self.typ)
+        self._K_outer_v[:] = [(m.mmul(G_i, v.reshape((self.D, self.D)), 
+                                      m.H(G_i)).ravel(), None) 
+                              for v, Av in self._K_outer_v]
+        if not self.K_left is None:
+            self.K_left = np.asarray(m.mmul(m.H(G), self.K_left, G), 
+                                     dtype=self.typ)
+        self._K_l_outer_v[:] = [(m.mmul(m.H(G), v.reshape((self.D, self.D)), 
+                                        G).ravel(), None) 
+                                for v, Av in self._K_l_outer_v]
         
         if ret_g:
             return G, G_i
         else:
             return
     
+    def _gauge_transform_A(self, G_i, G):
+        """Transforms A[s] -> G_i A[s] G (blockwise, if charges are set).
+        """
+        if self.charges is None:
+            for s in xrange(self.q):
+                self.A[s] = m.mmul(G_i, self.A[s], G)
+        else:
+            bs = self.charges
+            self.A[:] = sy.mmul_stack_left(G_i, sy.mmul_stack_right(self.A, G, 
+                                                                    bs), bs)
+    
+    def _get_h_nn_array(self, dtype=None):
+        """Returns h_nn in array form (see tdvp_common.get_op_array()).
+        
+        The array form is cached, so that a callable h_nn is evaluated only 
+        once. It is rebuilt when h_nn is reassigned.
+        """
+        shape = (self.q, self.q, self.q, self.q)
+        
+        c = self._h_nn_arr_cache
+        if c is None or not c[0] is self.h_nn:
+            c = (self.h_nn, tm.get_op_array(self.h_nn, shape))
+            self._h_nn_arr_cache = c
+        
+        return tm.get_op_array(c[1], shape, dtype=dtype)
+    
+    def _get_h_nn_sparse(self, h_nn):
+        """Returns the sparse form of h_nn (see tdvp_common.get_op_sparse()).
+        
+        The result is cached and reused as long as the contents of h_nn 
+        are unchanged.
+        """
+        c = self._h_nn_sparse_cache
+        if not c is None and np.array_equal(c[0], h_nn):
+            return c[1]
+        
+        h_nn_sp = tm.get_op_sparse(h_nn)
+        self._h_nn_sparse_cache = (np.array(h_nn), h_nn_sp)
+        
+        return h_nn_sp
+    
     def calc_C(self):
-        if not tc is None and not self.h_nn_cptr is None:
+        if not self.charges is None:
+            h_nn = self._get_h_nn_array(dtype=self.typ)
+            qn = self.charges.qn_phys
+            sy.check_op(h_nn, [qn, qn], modulus=self.charges.modulus)
+            self.C = sy.calc_C_mat_op_AA(h_nn, self.AA, self.charges, 
+                                         self.charges, out=self.C)
+        elif (not tc is None and not self.h_nn_cptr is None 
+            and self.typ == np.complex128):
             self.C = tc.calc_C(self.AA, self.h_nn_cptr, self.C)
         else:
-            self.C.fill(0)
-            
-            for u in xrange(self.q): #ndindex is just too slow..
-                for v in xrange(self.q):
-                    for s in xrange(self.q):
-                        for t in xrange(self.q):
-                            h = self.h_nn(s, t, u, v) #for large q, this executes a lot..
-                            if h != 0:
-                                self.C[s, t] += h * self.AA[u, v]
+            h_nn = self._get_h_nn_array(dtype=self.typ)
+            self.C = tm.calc_C_mat_op_AA(self._get_h_nn_sparse(h_nn), self.AA,
+                                         out=self.C)
     
-    def calc_PPinv(self, x, p=0, out=None, left=False):
-        if out is None:
-            out = np.ones_like(self.A[0])
+    def _get_PPinv_precond(self, p=0, left=False):
+        """Builds a preconditioner for calc_PPinv() from the eigenpairs of
+        the transfer matrix with the next-to-largest eigenvalues, 
+        which are responsible for slow convergence of the iterative solvers
+        (see PPInvPrecondOp).
+        
+        The number of eigenpairs used is set by PPinv_precond_k, which is
+        0 (no preconditioning) by default.
+        
+        The eigenpairs are cached by calc_E_spectrum() only for the current
+        A. They cannot be reused after a time step, since A changes, nor 
+        even after another call to update(), since this also changes the
+        gauge and hence the eigenvectors. During time evolution, each call
+        to calc_PPinv() (two per step) thus costs two ARPACK solves, which 
+        generally outweighs the iterations saved. The preconditioner is 
+        only worth trying for many solves at a fixed A, as in 
+        calc_excitations(), and it helps there only if the next-to-largest
+        eigenvalues are well separated from the rest of the spectrum.
+        """
+        k = self.PPinv_precond_k + 1
+        
+        ev_r, V = self.calc_E_spectrum(k=k, ret_eV=True)
+        ev_l, W = self.calc_E_spectrum(k=k, ret_eV=True, left=True)
+        ev_l = ev_l.conj()
         
-        op = PPInvOp(self, p, left)
+        #Drop the largest eigenvalue, which is projected out.
+        #(There may be others of the same magnitude, so look at the real part.)
+        i_r = np.arange(len(ev_r)) != np.argmax(ev_r.real)
+        i_l = np.arange(len(ev_l)) != np.argmax(ev_l.real)
+        ev_r, V = ev_r[i_r], V[i_r]
+        ev_l, W = ev_l[i_l], W[i_l]
+        
+        #Pair up left and right eigenvectors
+        W = W[[np.argmin(abs(ev_l - ev)) for ev in ev_r]]
+        
+        if left: #Left and right swap roles. See PPInvOp.
+            return PPInvPrecondOp(ev_r.conj(), W, V, p=p)
+        else:
+            return PPInvPrecondOp(ev_r, V, W, p=p)
+    
+    def _calc_PPinv_dense(self, x, p=0, left=False):
+        """Solves the problem of calc_PPinv() using a dense factorization 
+        of the D**2 x D**2 matrix 1 - QEQ.
+        
+        The factorization is cached and reused until A, l or r change.
+        For p = 0, an LU decomposition serves both the right and the left
+        problem, since the latter involves just the adjoint matrix. 
+        For p != 0, a Schur decomposition QEQ = Z T Z^dagger is computed
+        (once), after which each momentum needs only a triangular solve.
+        
+        x is expected in the form used by PPInvOp (raveled).
+        """
+        l = np.asarray(self.l)
+        r = np.asarray(self.r)
+        
+        c = self._PPinv_dense_cache
+        if (c is None or not np.array_equal(c[0], self.A) 
+            or not np.array_equal(c[1], l) or not np.array_equal(c[2], r)):
+            #Build in high precision, since M is factorized and reused
+            M = PPInvOp(self, 0, False, dtype=self.typ_hp).todense()
+            c = [self.A.copy(), l.copy(), r.copy(), M, la.lu_factor(M), None]
+            self._PPinv_dense_cache = c
+            
+        if p == 0:
+            if left:
+                return la.lu_solve(c[4], x, trans=2)
+            else:
+                return la.lu_solve(c[4], x)
+        
+        if c[5] is None:
+            I = np.eye(c[3].shape[0], dtype=c[3].dtype)
+            c[5] = la.schur(I - c[3], output='complex') #QEQ = Z T Z^dagger
+        T, Z = c[5]
+        I = np.eye(T.shape[0], dtype=T.dtype)
+        
+        Zhx = Z.conj().T.dot(x)
+        if left: #(1 - e^(ip) QEQ^dagger) = Z (1 - e^(-ip) T)^dagger Z^dagger
+            y = la.solve_triangular(I - np.exp(-1.j * p) * T, Zhx, trans=2)
+        else:
+            y = la.solve_triangular(I - np.exp(1.j * p) * T, Zhx)
+        
+        return Z.dot(y)
+    
+    def calc_PPinv(self, x, p=0, out=None, left=False, ret_itr=False, 
+                   outer_v=None, blocks=False):
+        """Solves (1 - e^(ip) QEQ) y = x for y, or the equivalent for
+        the left epsilon map (if left).
+        
+        The solver used is set by PPinv_solver, which can be one of
+        'bicgstab', 'gmres', 'lgmres' (from scipy.sparse.linalg), 'dense'
+        or 'auto'. 'dense' builds the full D**2 x D**2 matrix and factorizes
+        it (see _calc_PPinv_dense()), which is only sensible for small D.
+        'auto' uses 'dense' for D <= PPinv_dense_max_D and 'bicgstab' 
+        otherwise. The default is 'bicgstab', so the dense factorization is
+        only used if 'dense' or 'auto' is chosen.
+        
+        The preconditioner is opt-in and off by default (PPinv_precond_k 
+        = 0). If PPinv_precond_k > 0, the iterative solvers are 
+        preconditioned using that many eigenpairs of the transfer matrix 
+        (see _get_PPinv_precond()). These cost two ARPACK solves and are 
+        recomputed whenever A changes, so this is only useful for repeated 
+        solves at a fixed A (excitations). For time evolution, it increases
+        the total time.
+        
+        With lgmres, a list outer_v can be supplied, which is used to 
+        augment the Krylov subspace and is updated with the new 
+        approximate error vectors. Reusing it for a sequence of similar
+        problems can reduce the number of iterations needed considerably.
+        
+        Parameters
+        ----------
+        x : ndarray
+            The right-hand side.
+        p : float
+            The momentum.
+        out : ndarray
+            A matrix to hold the result. Its contents is used as the 
+            initial guess for iterative solvers. May be None.
+        left : bool
+            Whether to use the left epsilon map.
+        ret_itr : bool
+            Whether to also return the number of operator applications.
+        outer_v : list
+            Vectors to augment the Krylov subspace with (lgmres only).
+        blocks : bool
+            Whether x and the solution are known to carry no charge, so that
+            the transfer maps can be applied blockwise if charges are set 
+            (see _eps_r_noop_blocks()). This holds for K and K_left.
+            
+        Returns
+        -------
+        out : ndarray
+            The solution y.
+        itr : int
+            The number of operator applications made by the solver (if 
+            ret_itr). The sanity check, if enabled, is not counted.
+        """
+        #The solution is real only if the state, x and p are. It is computed
+        #in double precision, even if out has single precision.
+        typ = np.result_type(self.typ_hp, x.dtype)
+        if not p == 0:
+            typ = np.result_type(typ, np.complex64)
+        
+        if out is None or not np.can_cast(typ, out.dtype, casting='same_kind'):
+            out = np.ones((self.D, self.D), dtype=typ)
+        
+        op = PPInvOp(self, p, left, dtype=typ, blocks=blocks)
         
         if left:
             res = m.H(out).ravel()
@@ -542,12 +1285,46 @@ class EvoMPS_TDVP_Uniform:
             res = out.ravel()
             x = x.ravel()
         
-        res, info = las.bicgstab(op, x, x0=res, maxiter=1000, 
-                                 tol=self.itr_rtol)
+        solver_name = self.PPinv_solver
+        if solver_name == 'auto':
+            if self.D <= self.PPinv_dense_max_D:
+                solver_name = 'dense'
+            else:
+                solver_name = 'bicgstab'
+        
+        if solver_name == 'dense':
+            res = self._calc_PPinv_dense(x, p=p, left=left)
+            info = 0
+        else:
+            if self.PPinv_precond_k > 0:
+                M = self._get_PPinv_precond(p=p, left=left)
+            else:
+                M = None
+                
+            if solver_name == 'bicgstab':
+                solver = las.bicgstab
+            elif solver_name == 'gmres':
+                solver = las.gmres
+            elif solver_name == 'lgmres':
+                solver = las.lgmres
+            else:
+                raise ValueError("Unknown PPinv_solver: " + str(solver_name))
+        
+            if solver_name == 'lgmres' and not outer_v is None:
+                #The operator generally changes between calls, so we do not 
+                #store the products A * v.
+                res, info = solver(op, x, x0=res, maxiter=1000, 
+                                   tol=self.itr_rtol, M=M, outer_v=outer_v,
+                                   store_outer_Av=False)
+            else:
+                res, info = solver(op, x, x0=res, maxiter=1000, 
+                                   tol=self.itr_rtol, M=M)
         
         if info > 0:
             print "Warning: Did not converge on solution for ppinv!"
         
+        itr = op.calls
+        
         #Test
         if self.sanity_checks:
             RHS_test = op.matvec(res)
@@ -561,22 +1338,112 @@ class EvoMPS_TDVP_Uniform:
         if left:
             res = m.H(res)
         
+        if not np.iscomplexobj(out):
+            res = res.real #the dense solvers work in complex arithmetic
+        
         out[:] = res
         
-        return out
+        if ret_itr:
+            return out, itr
+        else:
+            return out
+        
+    def calc_PPinv_batch(self, x, ps, left=False, ret_itr=False):
+        """Solves (1 - e^(ip) QEQ) y = x for y, for a set of momenta p, or 
+        the equivalent for the left epsilon map (if left).
+        
+        The dense solver (see calc_PPinv()) computes one Schur 
+        decomposition and then needs only a triangular solve per momentum.
+        
+        The iterative solver exploits the fact that, after multiplying by 
+        e^(-ip), the problems differ only by a shift of the identity. They 
+        are solved simultaneously using a multi-shift FOM (see 
+        matmul.fom_multishift()), which builds a single Krylov subspace for 
+        all momenta, so that the cost in applications of QEQ is roughly that 
+        of a single solve.
+        
+        Parameters
+        ----------
+        x : ndarray
+            The right-hand side.
+        ps : sequence of float
+            The momenta.
+        left : bool
+            Whether to use the left epsilon map.
+        ret_itr : bool
+            Whether to also return the number of operator applications.
+            
+        Returns
+        -------
+        ys : ndarray
+            The solutions, with ys[i] corresponding to ps[i].
+        itr : int
+            The number of operator applications (if ret_itr).
+        """
+        ps = np.asarray(ps, dtype=float)
+        
+        if left:
+            x = m.H(x).ravel()
+        else:
+            x = np.asarray(x).ravel()
+        
+        solver_name = self.PPinv_solver
+        if solver_name == 'auto':
+            if self.D <= self.PPinv_dense_max_D:
+                solver_name = 'dense'
+            else:
+                solver_name = 'bicgstab'
+        
+        if solver_name == 'dense':
+            res = np.array([self._calc_PPinv_dense(x, p=p, left=left) 
+                            for p in ps])
+            itr = 0
+        else:
+            op = PPInvOp(self, 0, left, 
+                         dtype=np.result_type(self.typ_hp, np.complex64))
+            QEQ_mv = lambda v: v - op.matvec(v)
+            sigmas = np.exp(-1.j * ps)
+            
+            res, convg, itr = m.fom_multishift(QEQ_mv, x, sigmas, 
+                                               tol=self.itr_rtol)
+            res *= sigmas[:, None]
+            
+            if not convg:
+                print "Warning: Did not converge on solution for ppinv!"
+        
+        res = res.reshape((len(ps), self.D, self.D))
+        
+        if left:
+            res = res.transpose((0, 2, 1)).conj()
+            
+        if ret_itr:
+            return res, itr
+        else:
+            return res
         
     def calc_K(self):
-        Hr = np.zeros_like(self.A[0])
+        if self.charges is None:
+            Hr = tm.eps_r_op_2s_C12_AA34(self.r, self.C, self.AA)
+        else:
+            Hr = sy.eps_r_op_2s_C12_AA34(self.r, self.C, self.AA, 
+                                         self.charges, self.charges)
         
-        for s in xrange(self.q):
-            for t in xrange(self.q):
-                Hr += m.mmul(self.C[s, t], self.r, m.H(self.AA[s, t]))
+        #Both are real for a real state. In single precision, they are kept 
+        #in double precision, like r (see __init__()).
+        self.h = self.typ_hp.type(m.adot(self.l, Hr))
         
-        self.h = m.adot(self.l, Hr)
+        QHr = np.asarray(Hr - self.r * self.h, dtype=self.typ_hp)
+        
+        if self.PPinv_recycle:
+            outer_v = self._K_outer_v
+        else:
+            outer_v = None
         
-        QHr = Hr - self.r * self.h
+        self.K, self.itr_K = self.calc_PPinv(QHr, out=self.K, ret_itr=True,
+                                             outer_v=outer_v, blocks=True)
         
-        self.calc_PPinv(QHr, out=self.K)
+        if not self.charges is None:
+            self.K = self.charges.left.project(self.K)
         
         if self.sanity_checks:
             Ex = self.eps_r(self.K)
@@ -587,17 +1454,29 @@ class EvoMPS_TDVP_Uniform:
                 print "Off by: " + str(la.norm(res - QHr))
         
     def calc_K_l(self):
-        lH = np.zeros_like(self.A[0])
-        
-        for s in xrange(self.q):
-            for t in xrange(self.q):
-                lH += m.mmul(m.H(self.AA[s, t]), self.l, self.C[s, t])
+        if self.charges is None:
+            lH = tm.eps_l_op_2s_AA12_C34(self.l, self.AA, self.C)
+        else:
+            lH = sy.eps_l_op_2s_AA12_C34(self.l, self.AA, self.C, 
+                                         self.charges, self.charges)
         
         h = m.adot(lH, self.r)
         
         lHQ = lH - self.l * h
         
-        self.K_left = self.calc_PPinv(lHQ, left=True, out=self.K_left)
+        if self.PPinv_recycle:
+            outer_v = self._K_l_outer_v
+        else:
+            outer_v = None
+        
+        self.K_left, self.itr_K_l = self.calc_PPinv(lHQ, left=True, 
+                                                    out=self.K_left, 
+                                                    ret_itr=True,
+                                                    outer_v=outer_v,
+                                                    blocks=True)
+        
+        if not self.charges is None:
+            self.K_left = self.charges.left.project(self.K_left)
         
         if self.sanity_checks:
             xE = self.eps_l(self.K_left)
@@ -611,75 +1490,186 @@ class EvoMPS_TDVP_Uniform:
         return self.K_left, h
             
     def calc_Vsh(self, r_sqrt):
-        R = np.zeros((self.D, self.q, self.D), dtype=self.typ, order='C')
+        """Computes Vsh (see nullspace.calc_Vsh()).
         
-        for s in xrange(self.q):
-            R[:,s,:] = m.mmul(r_sqrt, m.H(self.A[s]))
+        The result is cached and reused as long as A and r_sqrt are 
+        unchanged. Hits and misses are counted in Vsh_cache_hits and 
+        Vsh_cache_misses.
+        """
+        r_sqrt_arr = np.asarray(r_sqrt)
+        
+        c = self._roots_cache.get('Vsh')
+        if (not c is None and np.array_equal(c[0], self.A) 
+            and np.array_equal(c[1], r_sqrt_arr)):
+            self.Vsh_cache_hits += 1
+            return c[2]
+            
+        self.Vsh_cache_misses += 1
         
-        R = R.reshape((self.q * self.D, self.D))
+        if self.charges is None:
+            Vsh = ns.calc_Vsh(self.A, r_sqrt)
+        else:
+            Vsh = sy.calc_Vsh(self.A, r_sqrt, self.charges)
         
-        Vconj = ns.nullspace_qr(m.H(R)).T
-        #R can be pretty huge for large q and D. The decomp. can take a long time...
+        self._roots_cache['Vsh'] = (self.A.copy(), np.array(r_sqrt_arr), Vsh)
 
         if self.sanity_checks:
-            if not np.allclose(np.dot(Vconj, m.H(Vconj)), np.eye(self.q*self.D - self.D)):
+            Vconj = Vsh.T.reshape((Vsh.shape[2], self.D * self.q))
+            if not np.allclose(np.dot(Vconj, m.H(Vconj)), np.eye(Vsh.shape[2])):
                 print "Sanity check failed: V . H(V) not eye!"
-            if not np.allclose(np.dot(Vconj.conj(), R), 0):
+            M = np.zeros((Vsh.shape[2], self.D), dtype=self.typ)
+            for s in xrange(self.q):
+                M += m.mmul(m.H(Vsh[s]), r_sqrt, m.H(self.A[s]))
+            if not np.allclose(M, 0):
                 print "Sanity check failed: V . R not zero!"
-        Vconj = Vconj.reshape(((self.q - 1) * self.D, self.D, self.q))
-        
-        #prepare for using V[s] and already take the adjoint, since we use it more often
-        Vsh = Vconj.T
-        Vsh = np.asarray(Vsh, order='C')
 
         return Vsh
         
     def calc_x(self, l_sqrt, l_sqrt_i, r_sqrt, r_sqrt_i, Vsh, out=None):
         if out is None:
-            out = np.zeros((self.D, (self.q - 1) * self.D), dtype=self.typ, 
+            out = np.zeros((self.D, Vsh.shape[2]), dtype=self.typ_hp, 
                            order=self.odr)
+            
+        if not self.charges is None:
+            bs = self.charges
+            
+            X = sy.calc_C_r_AH(self.C, self.r, self.A, bs, bs)
+            X += sy.mmul_stack_right(self.A, self.K, bs)
+            X = sy.mmul_stack_right(X, r_sqrt_i, bs)
+            out += sy.contract_Vsh(sy.mmul_stack_left(l_sqrt, X, bs), Vsh, bs)
+            
+            X = sy.calc_AH_l_C(self.A, self.l, self.C, bs, bs)
+            X = sy.mmul_stack_right(X, r_sqrt, bs)
+            out += sy.contract_Vsh(sy.mmul_stack_left(l_sqrt_i, X, bs), Vsh,
+                                   bs)
+            
+            return out
         
-        tmp = np.zeros_like(out)
-        for s in xrange(self.q):
-            tmp2 = m.mmul(self.A[s], self.K)
-            for t in xrange(self.q):
-                tmp2 += m.mmul(self.C[s, t], self.r, m.H(self.A[t]))
-            tmp += m.mmul(tmp2, r_sqrt_i, Vsh[s])
-        out += l_sqrt.dot(tmp)
+        X = tm.calc_C_r_AH(self.C, self.r, self.A)
+        X += tm.mmul_stack_right(self.A, self.K)
+        X = tm.mmul_stack_right(X, r_sqrt_i)
+        out += m.mmul(l_sqrt, tm.contract_Vsh(X, Vsh))
         
-        tmp.fill(0)
-        for s in xrange(self.q):
-            tmp2.fill(0)
-            for t in xrange(self.q):
-                tmp2 += m.mmul(m.H(self.A[t]), self.l, self.C[t, s])
-            tmp += m.mmul(tmp2, r_sqrt, Vsh[s])
-        out += l_sqrt_i.dot(tmp)
+        X = tm.calc_AH_l_C(self.A, self.l, self.C)
+        X = tm.mmul_stack_right(X, r_sqrt)
+        out += m.mmul(l_sqrt_i, tm.contract_Vsh(X, Vsh))
         
         return out
         
     def get_B_from_x(self, x, Vsh, l_sqrt_i, r_sqrt_i, out=None):
+        return tm.calc_B_from_x(x, Vsh, l_sqrt_i, r_sqrt_i, out=out)
+        
+    def calc_Y(self, l_sqrt, l_sqrt_i, r_sqrt, r_sqrt_i, out=None):
+        """Computes the matrices Y[s] such that the x of calc_x() is
+        x = sum_s Y[s] Vsh[s].
+        
+        This is calc_x() without the final contraction with Vsh.
+        """
         if out is None:
-            out = np.zeros_like(self.A)
+            out = np.zeros(self.A.shape, dtype=self.typ_hp)
             
-        for s in xrange(self.q):
-            out[s] = m.mmul(l_sqrt_i, x, m.H(Vsh[s]), r_sqrt_i)
+        if not self.charges is None:
+            bs = self.charges
+            
+            X = sy.calc_C_r_AH(self.C, self.r, self.A, bs, bs)
+            X += sy.mmul_stack_right(self.A, self.K, bs)
+            out += sy.mmul_stack_left(l_sqrt, 
+                                      sy.mmul_stack_right(X, r_sqrt_i, bs), bs)
+            
+            X = sy.calc_AH_l_C(self.A, self.l, self.C, bs, bs)
+            out += sy.mmul_stack_left(l_sqrt_i, 
+                                      sy.mmul_stack_right(X, r_sqrt, bs), bs)
+            
+            return out
+        
+        X = tm.calc_C_r_AH(self.C, self.r, self.A)
+        X += tm.mmul_stack_right(self.A, self.K)
+        out += tm.mmul_stack_left(l_sqrt, tm.mmul_stack_right(X, r_sqrt_i))
+        
+        X = tm.calc_AH_l_C(self.A, self.l, self.C)
+        out += tm.mmul_stack_left(l_sqrt_i, tm.mmul_stack_right(X, r_sqrt))
             
         return out
         
-    def calc_l_r_roots(self):
-        try:
-            self.l_sqrt = self.l.sqrt()
-            self.l_sqrt_i = self.l_sqrt.inv()
-        except AttributeError:
-            self.l_sqrt, evd = m.sqrtmh(self.l, ret_evd=True)
-            self.l_sqrt_i = m.invmh(self.l_sqrt, evd=evd)
+    def proj_Vsh(self, Y, r_sqrt, out=None):
+        """Applies the projector Vsh Vsh^dagger onto the gauge-fixed tangent 
+        space to Y without constructing Vsh.
+        
+        Vsh spans the null space of R^dagger, where R is the (q * D, D) 
+        matrix with blocks R[s] = r_sqrt A[s]^dagger (see calc_Vsh()), so 
+        that the projector is 1 - R (R^dagger R)^-1 R^dagger. Here, 
+        R^dagger R = eps_r(r), which is just r for a normalized state. 
+        Applying the projector costs O(q D**3), compared with O(q**3 D**3)
+        for the QR decomposition needed to compute Vsh.
+        
+        With this, B = l_sqrt_i proj_Vsh(Y) r_sqrt_i and
+        eta = norm(proj_Vsh(Y)), where Y is the result of calc_Y().
+        """
+        if out is None:
+            out = np.empty_like(Y)
+            
+        RR = self._eps_r_noop_blocks(self.r, None)
+        
+        if not self.charges is None:
+            bs = self.charges
+            
+            Z = sy.eps_r_noop(r_sqrt, Y, self.A, bs)
+            Z = sy.blockwise(lambda z, rr: m.H(la.cho_solve(la.cho_factor(rr), 
+                                                            m.H(z))),
+                             bs.left, Z, RR) #Z RR^-1
             
+            out[:] = Y - sy.mmul_stack_right(sy.mmul_stack_left(Z, self.A, bs),
+                                             r_sqrt, bs)
+            
+            return out
+        
+        Z = np.tensordot(tm.mmul_stack_right(Y, r_sqrt), self.A.conj(), 
+                         ((0, 2), (0, 2)))
+        
+        Z = m.H(la.cho_solve(la.cho_factor(RR), m.H(Z))) #Z RR^-1
+        
+        out[:] = Y - tm.mmul_stack_right(tm.mmul_stack_left(Z, self.A), r_sqrt)
+        
+        return out
+        
+    def _calc_sqrt_inv(self, x, key):
+        """Returns the square root of the hermitian matrix x and its inverse.
+        
+        The results are cached under key and reused, as long as x is 
+        unchanged. Hits and misses are counted in roots_cache_hits and 
+        roots_cache_misses.
+        """
+        x_arr = np.asarray(x)
+        
+        c = self._roots_cache.get(key)
+        if not c is None and np.array_equal(c[0], x_arr):
+            self.roots_cache_hits += 1
+            return c[1], c[2]
+        
+        self.roots_cache_misses += 1
+        
         try:
-            self.r_sqrt = self.r.sqrt()
-            self.r_sqrt_i = self.r_sqrt.inv()
+            x_sqrt = x.sqrt()
+            x_sqrt_i = x_sqrt.inv()
         except AttributeError:
-            self.r_sqrt, evd = m.sqrtmh(self.r, ret_evd=True)
-            self.r_sqrt_i = m.invmh(self.r_sqrt, evd=evd)
+            if self.charges is None:
+                x_sqrt, evd = m.sqrtmh(x, ret_evd=True)
+                x_sqrt_i = m.invmh(x_sqrt, evd=evd)
+            else:
+                x_sqrt, x_sqrt_i = sy.sqrtmh_inv(x, self.charges.left)
+            
+        self._roots_cache[key] = (np.array(x_arr), x_sqrt, x_sqrt_i)
+        
+        return x_sqrt, x_sqrt_i
+    
+    def calc_l_r_roots(self):
+        """Computes the matrix square roots of l and r and their inverses.
+        
+        These are reused from previous calls if l and r have not changed
+        (see _calc_sqrt_inv()).
+        """
+        self.l_sqrt, self.l_sqrt_i = self._calc_sqrt_inv(self.l, 'l')
+        self.r_sqrt, self.r_sqrt_i = self._calc_sqrt_inv(self.r, 'r')
         
         if self.sanity_checks:
             if not np.allclose(self.l_sqrt.dot(self.l_sqrt), self.l):
@@ -692,17 +1682,54 @@ class EvoMPS_TDVP_Uniform:
                 print "Sanity check failed: r_sqrt_i is bad!"
         
     def calc_B(self, set_eta=True):
-        self.calc_l_r_roots()
-                
-        self.Vsh = self.calc_Vsh(self.r_sqrt)
+        """Computes the gauge-fixed tangent vector B for the current step.
         
-        self.x = self.calc_x(self.l_sqrt, self.l_sqrt_i, self.r_sqrt, 
-                        self.r_sqrt_i, self.Vsh)
+        By default, Vsh is computed using calc_Vsh() and the parameter 
+        matrix x is stored in self.x.
         
-        if set_eta:
-            self.eta = sp.sqrt(m.adot(self.x, self.x))
+        If Vsh_implicit is set (it is off by default), the projection onto 
+        the gauge-fixed tangent space is instead done using proj_Vsh(), 
+        which avoids the QR decomposition in calc_Vsh(). Neither Vsh nor x 
+        are then computed, and self.Vsh and self.x are set to None, so that
+        this mode cannot be used with calc_B_CG(), which needs x.
+        """
+        self.calc_l_r_roots()
         
-        B = self.get_B_from_x(self.x, self.Vsh, self.l_sqrt_i, self.r_sqrt_i)
+        if self.Vsh_implicit:
+            self.Vsh = None
+            self.x = None
+            
+            Y = self.calc_Y(self.l_sqrt, self.l_sqrt_i, self.r_sqrt, 
+                            self.r_sqrt_i)
+            PY = self.proj_Vsh(Y, self.r_sqrt)
+            
+            if set_eta:
+                self.eta = sp.sqrt(m.adot(PY, PY))
+            
+            if self.charges is None:
+                B = tm.mmul_stack_right(tm.mmul_stack_left(self.l_sqrt_i, PY), 
+                                        self.r_sqrt_i)
+            else:
+                B = sy.mmul_stack_right(sy.mmul_stack_left(self.l_sqrt_i, PY,
+                                                           self.charges), 
+                                        self.r_sqrt_i, self.charges)
+        else:
+            self.Vsh = self.calc_Vsh(self.r_sqrt)
+            
+            self.x = self.calc_x(self.l_sqrt, self.l_sqrt_i, self.r_sqrt, 
+                            self.r_sqrt_i, self.Vsh)
+            
+            if set_eta:
+                self.eta = sp.sqrt(m.adot(self.x, self.x))
+            
+            if self.charges is None:
+                B = self.get_B_from_x(self.x, self.Vsh, self.l_sqrt_i, 
+                                      self.r_sqrt_i)
+            else:
+                B = sy.calc_B_from_x(self.x, self.Vsh, self.l_sqrt_i, 
+                                     self.r_sqrt_i, self.charges)
+        
+        B = np.asarray(B, dtype=self.typ)
         
         if self.sanity_checks:
             #Test gauge-fixing:
@@ -722,6 +1749,8 @@ class EvoMPS_TDVP_Uniform:
         self.calc_K()
         
     def take_step(self, dtau, B=None):
+        dtau = tm.get_dtau(dtau, self.typ)
+        
         if B is None:
             B = self.calc_B()
         
@@ -735,6 +1764,8 @@ class EvoMPS_TDVP_Uniform:
             self.calc_C()
             self.calc_K()            
 
+        dtau = tm.get_dtau(dtau, self.typ)
+        
         A0 = self.A.copy()
             
         B_fin = np.empty_like(self.A)
@@ -762,21 +1793,425 @@ class EvoMPS_TDVP_Uniform:
         
         B = self.calc_B(set_eta=False) #k4
         B_fin += B
-            
+
         self.A = A0 - dtau /6 * B_fin
+
+    def take_step_adaptive(self, dtau, tol=1E-8, method='BS23',
+                           max_rejects=10, B_i=None):
+        """Takes a step using an embedded Runge-Kutta method with step size
+        control.
+
+        Two solutions of different order are computed from the same stages
+        and their difference is used as an estimate of the local error,
+        measured in the norm of the tangent space (given by l and r). If the
+        error exceeds tol, the step is rejected and retried with a smaller
+        dtau. A step size for the next step is then proposed based on the
+        error, so that dtau grows where the evolution is slow.
+
+        As for take_step_RK4(), update() should be called before each step.
+        Accepted and rejected steps are counted in rk_accepted and
+        rk_rejected. The error estimate for the last step is stored in
+        rk_err.
+
+        Parameters
+        ----------
+        dtau : complex
+            The (imaginary or real) amount of imaginary time (tau) to try
+            to step. Usually, this is dtau_next from the previous step.
+        tol : float
+            The tolerance for the local error of each step.
+        method : str
+            The embedded method. Either 'BS23' (Bogacki-Shampine 3(2), four
+            stages) or 'DP54' (Dormand-Prince 5(4), seven stages). See
+            tdvp_common.rk_tableaux.
+        max_rejects : int
+            The maximum number of times the step is retried. The last try
+            is accepted regardless of the error.
+        B_i : ndarray
+            The tangent vector for the current state, if already computed.
+
+        Returns
+        -------
+        dtau_taken : complex
+            The step size actually used.
+        dtau_next : complex
+            The proposed step size for the next step.
+        """
+        def calc_B():
+            return [self.calc_B(set_eta=False)]
+
+        def restore(A):
+            self.A = A[0]
+            self.calc_lr()
+            self.calc_AA()
+            self.calc_C()
+            self.calc_K()
+
+        l0 = np.array(self.l)
+        r0 = np.array(self.r)
+
+        def tangent_norm(dA):
+            return sp.sqrt(abs(m.adot(l0, tm.eps_r_noop(r0, dA[0], dA[0]))))
+
+        dtau = tm.get_dtau(dtau, self.typ)
+
+        if B_i is None:
+            B_i = self.calc_B()
+
+        A, dtau, dtau_next, self.rk_err, rejects = tm.rk_adaptive_step(
+            [self.A.copy()], dtau, [B_i], calc_B, restore, tangent_norm, tol,
+            method=method, max_rejects=max_rejects)
+
+        self.A = A[0]
+        self.rk_accepted += 1
+        self.rk_rejected += rejects
+
+        return dtau, dtau_next
+
+    def take_step_krylov(self, dtau, tol=1E-12, max_itr=30):
+        """Takes a step using Krylov exponentials of the effective 
+        Hamiltonians for a single site and for a single bond.
+        
+        This is the integrator for uniform MPS described in 
+        arXiv:1408.5056 [quant-ph], using the mixed gauge with 
+        AC = l^(1/2) A r^(1/2), C = l^(1/2) r^(1/2), as well as AL and AR 
+        (the A of the left and right canonical forms). AC and C are evolved 
+        independently by exp(-dtau * H_AC) and exp(-dtau * H_C), where the 
+        effective Hamiltonians are applied matrix-free (see _apply_H_AC() and
+        _apply_H_C()) using expmv_lanczos() from tdvp_common, usually with 
+        only a few matrix-vector products each. The new A is then the AR 
+        that best fits both, obtained from the polar decompositions of AC 
+        and C.
+        
+        Doing this once, with the effective Hamiltonians of the current 
+        state, is only first-order accurate. Instead, it is used to obtain
+        AC and C at dtau / 2, after which the original AC and C are evolved 
+        by the full dtau using the effective Hamiltonians at this midpoint.
+        For these, AL and AR are obtained from the midpoint AC and C using 
+        polar decompositions, rather than from a new canonical form, since
+        AC and C must remain in the same gauge throughout. This is 
+        second-order accurate. Per step, it requires K and K_left to be 
+        computed twice, compared to four times K for take_step_RK4().
+        
+        The effective Hamiltonians are hermitian, so that the step is 
+        unitary for real time evolution. It does not become unstable for 
+        large real time steps, but its error constant is larger than that
+        of take_step_RK4(), which is generally the more accurate for small
+        steps.
+        
+        As for take_step_RK4(), update() should be called before each step.
+        On return, l, r, AA, C and K (and h) have been recomputed for the 
+        new A, although canonical form is not restored. The total number of 
+        matrix-vector products used is stored in itr_krylov.
+        
+        Parameters
+        ----------
+        dtau : complex
+            The (imaginary or real) amount of imaginary time (tau) to step.
+        tol : float
+            Tolerance for the Krylov approximations of the exponentials.
+        max_itr : int
+            The maximum dimension of the Krylov subspaces.
+        """
+        dtau = tm.get_dtau(dtau, self.typ)
+        
+        self.itr_krylov = 0
+        
+        h_nn = self._get_h_nn_sparse(self._get_h_nn_array())
+        
+        self.calc_K_l()
+        self.calc_l_r_roots()
+        
+        A = self.A
+        AL = tm.mmul_stack_right(tm.mmul_stack_left(self.l_sqrt, A), 
+                                 self.l_sqrt_i)
+        AR = tm.mmul_stack_right(tm.mmul_stack_left(self.r_sqrt_i, A), 
+                                 self.r_sqrt)
+        AC = tm.mmul_stack_right(tm.mmul_stack_left(self.l_sqrt, A), 
+                                 self.r_sqrt)
+        C = np.asarray(m.mmul(self.l_sqrt, self.r_sqrt)).astype(self.typ)
+        
+        #The environments in the left and right canonical gauges
+        L_H = np.asarray(m.mmul(self.l_sqrt_i, self.K_left, self.l_sqrt_i))
+        R_H = np.asarray(m.mmul(self.r_sqrt_i, self.K, self.r_sqrt_i))
+        
+        AC_h, C_h = self._expm_AC_C(AC, C, AL, AR, L_H, R_H, h_nn, dtau / 2,
+                                    tol, max_itr)
+        AL, AR = self._calc_AL_AR(AC_h, C_h)
+        
+        #The environments for the midpoint AL and AR. These are computed as
+        #in update(), but without restoring canonical form, which would 
+        #change the gauge (cf. take_step_RK4()).
+        self.A = AR
+        self.calc_lr()
+        self.calc_AA()
+        self.calc_C()
+        self.calc_K()
+        self.calc_l_r_roots()
+        AR = self.A #calc_lr() may have rescaled it
+        R_H = np.asarray(m.mmul(self.r_sqrt_i, self.K, self.r_sqrt_i))
+        
+        self.A = AL
+        self.calc_lr()
+        self.calc_AA()
+        self.calc_C()
+        self.calc_K_l()
+        self.calc_l_r_roots()
+        AL = self.A
+        L_H = np.asarray(m.mmul(self.l_sqrt_i, self.K_left, self.l_sqrt_i))
+        
+        AC, C = self._expm_AC_C(AC, C, AL, AR, L_H, R_H, h_nn, dtau, tol, 
+                                max_itr)
+        self.A = self._calc_AL_AR(AC, C)[1]
+        
+        #Leave l, r, C and K (and hence h) consistent with the new A, rather
+        #than with the midpoint.
+        self.calc_lr()
+        self.calc_AA()
+        self.calc_C()
+        self.calc_K()
+        
+    def _expm_AC_C(self, AC, C, AL, AR, L_H, R_H, h_nn, dtau, tol, max_itr):
+        """Returns exp(-dtau * H_AC) AC and exp(-dtau * H_C) C (see 
+        take_step_krylov()).
+        """
+        AC, itr_AC = tm.expmv_lanczos(
+            lambda x: self._apply_H_AC(x, AL, AR, L_H, R_H, h_nn), 
+            AC, -dtau, tol=tol, max_itr=max_itr)
+        C, itr_C = tm.expmv_lanczos(
+            lambda x: self._apply_H_C(x, AL, AR, L_H, R_H, h_nn), 
+            C, -dtau, tol=tol, max_itr=max_itr)
+        self.itr_krylov += itr_AC + itr_C
+        
+        return AC, C
+        
+    def _calc_AL_AR(self, AC, C):
+        """Returns the AL and AR that best fit AC = AL C = C AR.
+        
+        These are AL = W_AC W_C^dagger and AR = W_C^dagger W_AC, using the 
+        polar decompositions AC = W_AC P_AC and C = W_C P_C (for AL) or 
+        AC = P_AC W_AC and C = P_C W_C (for AR).
+        """
+        D, q = self.D, self.q
+        
+        W_AC = la.polar(AC.reshape((q * D, D)), side='right')[0]
+        W_C = la.polar(C, side='right')[0]
+        AL = W_AC.dot(m.H(W_C)).reshape((q, D, D))
+        
+        W_AC = la.polar(AC.transpose((1, 0, 2)).reshape((D, q * D)),
+                        side='left')[0]
+        W_C = la.polar(C, side='left')[0]
+        AR = m.H(W_C).dot(W_AC).reshape((D, q, D)).transpose((1, 0, 2))
+        
+        AL = np.ascontiguousarray(AL, dtype=self.typ)
+        AR = np.ascontiguousarray(AR, dtype=self.typ)
+        if not self.charges is None:
+            AL = self.charges.project(AL)
+            AR = self.charges.project(AR)
+        
+        return AL, AR
+        
+    def _apply_H_AC(self, AC, AL, AR, L_H, R_H, h_nn):
+        """Applies the effective Hamiltonian for a single site in the mixed 
+        gauge (see take_step_krylov()) to AC.
+        
+        The energy density h is subtracted from each term, as for K and 
+        K_left.
+        """
+        D = self.D
+        res = tm.mmul_stack_left(L_H, AC) + tm.mmul_stack_right(AC, R_H)
+        
+        C_AL_AC = tm.calc_C_mat_op_AA(h_nn, tm.calc_AA(AL, AC))
+        res += tm.calc_AH_l_C(AL, np.eye(D, dtype=AC.dtype), C_AL_AC)
+        
+        C_AC_AR = tm.calc_C_mat_op_AA(h_nn, tm.calc_AA(AC, AR))
+        res += tm.calc_C_r_AH(C_AC_AR, np.eye(D, dtype=AC.dtype), AR)
+        
+        res -= (2 * self.h) * AC
+        
+        return res
+        
+    def _apply_H_C(self, C, AL, AR, L_H, R_H, h_nn):
+        """Applies the effective Hamiltonian for a single bond in the mixed 
+        gauge (see take_step_krylov()) to C.
+        """
+        res = L_H.dot(C) + C.dot(R_H)
+        
+        C_AL_CAR = tm.calc_C_mat_op_AA(h_nn, 
+                                       tm.calc_AA(AL, tm.mmul_stack_left(C, AR)))
+        X = tm.calc_AH_l_C(AL, np.eye(self.D, dtype=C.dtype), C_AL_CAR)
+        res += np.tensordot(X, AR.conj(), ((0, 2), (0, 2)))
+        
+        res -= self.h * C
+        
+        return res
+        
+    def calc_BHB(self, x, p, h_nn=None):
+        """Applies the effective Hamiltonian for momentum p (minus the 
+        ground state energy) to the tangent vector parametrized by x.
+        
+        This is the quasi-particle ansatz for excitations on top of the
+        current (ground) state, where the tangent vector B (see 
+        get_B_from_x()) replaces A on a single site, summed over all sites 
+        with phases e^(ipn). Terms proportional to delta(p) are discarded.
+        
+        The state must be in canonical form and the quantities computed by 
+        update(), calc_K_l(), calc_l_r_roots() and calc_Vsh() must be up to
+        date (see calc_excitations()).
+        
+        Parameters
+        ----------
+        x : ndarray
+            The parameter matrix, with shape (D, (q - 1) * D).
+        p : float
+            The momentum.
+        h_nn : ndarray
+            The Hamiltonian term as an array (see tdvp_common.get_op_array()).
+            Computed from self.h_nn if None.
             
-    def calc_BHB(self, x):
-        assert False
+        Returns
+        -------
+        res : ndarray
+            The parameter matrix of the resulting tangent vector.
+        """
+        if not self.charges is None:
+            raise NotImplementedError("Excitations are not supported for "
+                                      "states with charges set.")
+            
+        if h_nn is None:
+            h_nn = self._get_h_nn_array()
         
-        B = self.B_from_x(x, self.Vsh, self.l_sqrt_i, self.r_sqrt_i)
+        A = self.A
+        l = np.asarray(self.l)
+        r = np.asarray(self.r)
+        K = self.K
+        K_l = self.K_left
         
-        rVsh = self.Vsh.copy()
-        for s in xrange(self.q):
-            rVsh[s] = self.r_sqrt_i.dot(rVsh[s])
+        B = self.get_B_from_x(x, self.Vsh, self.l_sqrt_i, self.r_sqrt_i)
+        
+        ph = np.exp(1.j * p)
         
-        res = self.l_sqrt.dot(self.eps_r_2ss(self.r, op=self.h_nn, A1=B, A3=rVsh))
+        #Two-site terms with the ground state energy subtracted
+        AB = tm.calc_AA(A, B)
+        BA = tm.calc_AA(B, A)
+        h_nn_sp = self._get_h_nn_sparse(h_nn)
+        C_AB = tm.calc_C_mat_op_AA(h_nn_sp, AB) - self.h * AB
+        C_BA = tm.calc_C_mat_op_AA(h_nn_sp, BA) - self.h * BA
+        C_AA = self.C - self.h * self.AA
         
-        return None
+        #Right environment for B to the right of the site, summed over
+        #positions: (1 - e^(ip) E)^-1 with the dominant part projected out.
+        x_R = (tm.eps_r_noop(K, B, A) 
+               + tm.eps_r_op_2s_C12_AA34(r, C_BA, self.AA)
+               + ph * tm.eps_r_op_2s_C12_AA34(r, C_AB, self.AA))
+        x_R -= r * m.adot(l, x_R)
+        R_B = ph * self.calc_PPinv(x_R, p=p)
+        
+        #Left environment for B to the left of the site. The gauge-fixing 
+        #condition ensures tr(x_L r) = 0.
+        x_L = tm.eps_l_noop(l, A, B)
+        x_L -= l * m.adot(r, x_L)
+        L_B = self.calc_PPinv(x_L, p=p, left=True) / ph
+        
+        C_1 = C_BA + ph * C_AB
+        C_2 = C_AB + C_BA / ph
+        
+        #G[s] = K_l B[s] r + l (B[s] K + A[s] R_B + sum_t C_1[s, t] r H(A[t]))
+        #       + L_B (A[s] K + sum_t C_AA[s, t] r H(A[t]))
+        #       + sum_t H(A[t]) (l C_2[t, s] + L_B C_AA[t, s] / ph) r
+        X = tm.mmul_stack_right(B, K) + tm.mmul_stack_right(A, R_B)
+        X += tm.calc_C_r_AH(C_1, r, A)
+        G = tm.mmul_stack_left(l, X)
+        
+        X = tm.mmul_stack_right(A, K) + tm.calc_C_r_AH(C_AA, r, A)
+        G += tm.mmul_stack_left(L_B, X)
+        
+        G += tm.mmul_stack_left(K_l, tm.mmul_stack_right(B, r))
+        
+        X = tm.calc_AH_l_C(A, l, C_2) + tm.calc_AH_l_C(A, L_B, C_AA) / ph
+        G += tm.mmul_stack_right(X, r)
+        
+        G = tm.mmul_stack_right(G, self.r_sqrt_i)
+        
+        return m.mmul(self.l_sqrt_i, tm.contract_Vsh(G, self.Vsh))
+        
+    def calc_excitations(self, ps, k=1, tol=0, ncv=None, ret_x=False):
+        """Computes the lowest excitation energies, relative to the ground 
+        state energy, for a list of momenta, using the quasi-particle ansatz.
+        
+        The current state is assumed to be the ground state. The effective
+        Hamiltonian for each momentum is applied matrix-free (see 
+        HTangentOp) and the eigenvalues are found using ARPACK (eigsh). 
+        For very small D, the effective Hamiltonian is instead built as a 
+        dense matrix.
+        
+        This is not supported for states with charges set, since the 
+        excitations may carry charge, so that the tangent vectors and the 
+        transfer-map arguments are not block-diagonal.
+        
+        Parameters
+        ----------
+        ps : sequence of float
+            The momenta.
+        k : int
+            The number of excitation energies to compute for each momentum.
+        tol : float
+            Tolerance for ARPACK (0 means machine precision).
+        ncv : int
+            Number of Lanczos vectors used by ARPACK (may be None).
+        ret_x : bool
+            Whether to also return the parameter matrices x of the 
+            excitations (see get_B_from_x()).
+            
+        Returns
+        -------
+        ev : ndarray
+            The excitation energies, with ev[i] corresponding to ps[i], 
+            in ascending order.
+        xs : ndarray
+            The parameter matrices, with xs[i, j] corresponding to ev[i, j]
+            (if ret_x).
+        """
+        if not self.charges is None:
+            raise NotImplementedError("Excitations are not supported for "
+                                      "states with charges set.")
+            
+        self.update()
+        self.calc_K_l()
+        self.calc_l_r_roots()
+        self.Vsh = self.calc_Vsh(self.r_sqrt)
+        
+        ev = np.empty((len(ps), k), dtype=float)
+        if ret_x:
+            xs = np.empty((len(ps), k, self.D, (self.q - 1) * self.D), 
+                          dtype=np.result_type(self.typ_hp, np.complex64))
+        
+        for i in xrange(len(ps)):
+            op = HTangentOp(self, ps[i])
+            n = op.shape[0]
+            
+            if k >= n - 1:
+                H = np.empty(op.shape, dtype=op.dtype)
+                for j in xrange(n):
+                    H[:, j] = op.matvec(np.eye(1, n, j, dtype=op.dtype).ravel())
+                H = (H + m.H(H)) / 2 #Hermitian up to rounding errors
+                evi, eVi = la.eigh(H)
+                evi = evi[:k]
+                eVi = eVi[:, :k]
+            else:
+                evi, eVi = las.eigsh(op, k=k, which='SA', tol=tol, ncv=ncv)
+                ind = evi.argsort()
+                evi = evi[ind]
+                eVi = eVi[:, ind]
+                
+            ev[i] = evi.real
+            if ret_x:
+                xs[i] = eVi.T.reshape((k,) + op.x_shape)
+        
+        if ret_x:
+            return ev, xs
+        else:
+            return ev
             
     def find_min_h(self, B, dtau_init, tol=5E-2):
         dtau = dtau_init
@@ -972,13 +2407,10 @@ class EvoMPS_TDVP_Uniform:
         return rho
         
     def apply_op_1s(self, o):
-        newA = sp.zeros_like(self.A)
+        o = tm.get_op_array(o, (self.q, self.q))
         
-        for s in xrange(self.q):
-            for t in xrange(self.q):
-                newA[s] += self.A[t] * o(s, t)
-                
-        self.A = newA
+        self.A = np.asarray(tm.apply_op_1s(o, self.A), dtype=self.typ, 
+                            order=self.odr)
             
     def save_state(self, file, userdata=None):
         if userdata is None:
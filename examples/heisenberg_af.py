@@ -90,6 +90,16 @@ Tell evoMPS about our Hamiltonian.
 """
 s.h_nn = h_nn
 
+"""
+Optionally, make use of the conservation of S_z, restricting to the sector
+with total S_z = 0. The charge of basis state s is the number of up spins
+(s = 0 is up). This makes each step cheaper by roughly the number of charge 
+sectors.
+"""
+use_charges = False
+if use_charges:
+    s.set_charges([1, 0], total=N / 2)
+
 """
 Set the initial Hamiltonian parameters.
 """
@@ -164,7 +174,7 @@ print
 col_heads = ["Step", "t", "l[N]", "Restore CF?", "Renorm?", "K[1]", "dK[1]", 
              "sig_x_3", "sig_y_3", "sig_z_3",
              "E_vn_3,4", "M_x", "Next step",
-             "(itr", "delta", "delta_chk)"] #These last three are for testing the midpoint method.
+             "(itr", "delta)"] #These last two are for the implicit midpoint method.
 print "\t".join(col_heads)
 print
 
@@ -253,11 +263,10 @@ for i in xrange(total_steps):
         print "\t".join(row)
         s.take_step(step)     
         imsteps += 1
-    elif False: #Midpoint method. Currently disabled. Change to True to test!
-        itr, delta, delta_check = s.take_step_implicit(step)
+    elif False: #Implicit midpoint method. Change to True to use it.
+        itr, delta = s.take_step_implicit(step)
         row.append(str(itr))
-        row.append("%.3g" % delta.real)
-        row.append("%.3g" % delta_check.real)
+        row.append("%.3g" % delta)
         print "\t".join(row)
     else:
         print "\t".join(row)
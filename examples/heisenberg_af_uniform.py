@@ -121,6 +121,16 @@ Initialize the simulation object:
 s = tdvp.EvoMPS_TDVP_Uniform(D, q)
 s.h_nn = h_nn
 
+"""
+Optionally, make use of the conservation of S_z (spin-1 only). The charges
+are 2 S_z. The virtual spins of the spin-1 ground state are half-integers,
+so the virtual charges are odd.
+"""
+use_charges = False
+if use_charges and S == 1:
+    s.set_charges([2, 0, -2], [-3] * (D / 8) + [-1] * (3 * D / 8) 
+                              + [1] * (3 * D / 8) + [3] * (D / 8))
+
 """
 Set the Hamiltonian parameters.
 """
@@ -182,7 +182,7 @@ print
 col_heads = ["Step", "t", "l[N]", "Restore CF?", "Renorm?", "K[1]", "dK[1]", 
              "sig_x_3", "sig_y_3", "sig_z_3",
              "E_vn_3,4", "M_x", "Next step",
-             "(itr", "delta", "delta_chk)"] #These last three are for testing the midpoint method.
+             "(itr", "delta)"] #These last two are for the implicit midpoint method.
 print "\t".join(col_heads)
 print
 
@@ -290,11 +290,10 @@ for i in xrange(total_steps):
         print "\t".join(row)
         s.take_step(step)     
         imsteps += 1
-    elif False: #Midpoint method. Currently disabled. Change to True to test!
-        itr, delta, delta_check = s.take_step_implicit(step)
+    elif False: #Implicit midpoint method. Change to True to use it.
+        itr, delta = s.take_step_implicit(step)
         row.append(str(itr))
-        row.append("%.3g" % delta.real)
-        row.append("%.3g" % delta_check.real)
+        row.append("%.3g" % delta)
         print "\t".join(row)
     else:
         print "\t".join(row)
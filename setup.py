@@ -10,11 +10,36 @@ except ImportError:
 else:
     use_cython = True
 
+openmp_flags = ["-fopenmp"]
+
 if use_cython:
+    from distutils.errors import CompileError, LinkError
+    
+    class build_ext_openmp(build_ext):
+        """Builds extensions using OpenMP flags, falling back to building
+        them without if the compiler does not support these.
+        """
+        def build_extension(self, ext):
+            try:
+                build_ext.build_extension(self, ext)
+            except (CompileError, LinkError):
+                if not openmp_flags[0] in ext.extra_compile_args:
+                    raise
+                print ("OpenMP not available: Building %s without it." 
+                       % ext.name)
+                ext.extra_compile_args = [a for a in ext.extra_compile_args
+                                          if not a in openmp_flags]
+                ext.extra_link_args = [a for a in ext.extra_link_args
+                                       if not a in openmp_flags]
+                build_ext.build_extension(self, ext)
+    
     ext_modules = [Extension("evoMPS.matmul", ["evoMPS/matmul.py"]),
-                   Extension("evoMPS.tdvp_common", ["evoMPS/tdvp_common.pyx"]),
+                   Extension("evoMPS.tdvp_calc_C", ["evoMPS/tdvp_calc_C.pyx"],
+                             extra_compile_args=openmp_flags,
+                             extra_link_args=openmp_flags),
+                   Extension("evoMPS.tdvp_kernels", ["evoMPS/tdvp_kernels.pyx"]),
                    Extension("evoMPS.tdvp_uniform", ["evoMPS/tdvp_uniform.py"])]
-    cmdclass = {"build_ext": build_ext}
+    cmdclass = {"build_ext": build_ext_openmp}
 else:
     ext_modules = []
     cmdclass = {}